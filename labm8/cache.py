@@ -16,15 +16,421 @@
 """
 Transient and persistent caching mechanisms.
 """
+from __future__ import division
+
 import atexit
+import codecs
+import functools
+import hashlib
 import json
+import mmap
+import os
 import re
+import shutil
 import six
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+
+from collections import OrderedDict
+from six.moves import cPickle as pickle
+from time import time
 
 import labm8 as lab
 from labm8 import crypto
+from labm8 import db
 from labm8 import fs
 from labm8 import io
+from labm8 import prof
+
+
+# Sentinel for missing values.
+_MISSING = object()
+
+
+def _pairs(items):
+    """
+    Return an iterable of (key, value) pairs from a dict or iterable.
+    """
+    return six.iteritems(items) if isinstance(items, dict) else items
+
+
+class Compressor(object):
+    """
+    A compression format.
+
+    Compressed data is identified by the magic number at the start of
+    the format, so compressed and uncompressed data can be told apart.
+
+    Members:
+        name (str): Name of the format.
+        magic (bytes): Magic number which starts compressed data.
+    """
+    name = None
+    magic = None
+
+    def compress(self, data):
+        """
+        Compress bytes.
+        """
+        raise NotImplementedError
+
+    def decompress(self, data):
+        """
+        Decompress bytes.
+        """
+        raise NotImplementedError
+
+    def open(self, path, mode="rb"):
+        """
+        Open a compressed file for streaming reads or writes.
+
+        Arguments:
+            path (str or file): Path to file, or a binary file object,
+              which is closed along with the stream.
+            mode (str, optional): Either "rb" or "wb".
+
+        Returns:
+            file: Binary file object.
+        """
+        raise NotImplementedError
+
+
+class GzipCompressor(Compressor):
+    """
+    gzip compression, using the standard library.
+    """
+    name = "gzip"
+    magic = b"\x1f\x8b"
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        import gzip
+
+        buf = six.BytesIO()
+        # A fixed mtime, so that equal data compresses to equal bytes.
+        with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=self.level,
+                           mtime=0) as outfile:
+            outfile.write(data)
+        return buf.getvalue()
+
+    def decompress(self, data):
+        import gzip
+
+        with gzip.GzipFile(fileobj=six.BytesIO(data), mode="rb") as infile:
+            return infile.read()
+
+    def open(self, path, mode="rb"):
+        import gzip
+
+        # Omit the file name from the header, so that equal data
+        # compresses to equal bytes wherever it is written.
+        if isinstance(path, six.string_types):
+            fileobj = open(path, mode)
+        else:
+            fileobj = path
+        gzfile = gzip.GzipFile(filename="", mode=mode, fileobj=fileobj,
+                               compresslevel=self.level, mtime=0)
+        # Close the underlying file along with the gzip stream.
+        gzfile.myfileobj = fileobj
+        return gzfile
+
+
+class ZstdCompressor(Compressor):
+    """
+    Zstandard compression. Requires the "zstandard" package.
+    """
+    name = "zstd"
+    magic = b"\x28\xb5\x2f\xfd"
+
+    def __init__(self, level=3):
+        self.level = level
+
+    def compress(self, data):
+        import zstandard
+
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data):
+        import zstandard
+
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+    def open(self, path, mode="rb"):
+        import zstandard
+
+        cctx = zstandard.ZstdCompressor(level=self.level)
+        return zstandard.open(path, mode, cctx=cctx, closefd=True)
+
+
+class LZ4Compressor(Compressor):
+    """
+    LZ4 frame compression. Requires the "lz4" package.
+    """
+    name = "lz4"
+    magic = b"\x04\x22\x4d\x18"
+
+    def compress(self, data):
+        import lz4.frame
+
+        return lz4.frame.compress(data)
+
+    def decompress(self, data):
+        import lz4.frame
+
+        return lz4.frame.decompress(data)
+
+    def open(self, path, mode="rb"):
+        import lz4.frame
+
+        lzfile = lz4.frame.open(path, mode)
+        # Close the underlying file along with the lz4 stream.
+        lzfile._closefp = True
+        return lzfile
+
+
+# Compressors which can be selected by name.
+COMPRESSORS = {
+    "gzip": GzipCompressor,
+    "zstd": ZstdCompressor,
+    "lz4": LZ4Compressor,
+}
+
+
+def _compressor(compression):
+    """
+    Return a compressor from a name, compressor, or None.
+
+    Raises:
+        ValueError: If the compression format is not recognised.
+    """
+    if compression is None or isinstance(compression, Compressor):
+        return compression
+    if compression not in COMPRESSORS:
+        raise ValueError("Unknown compression format '{0}'"
+                         .format(compression))
+    return COMPRESSORS[compression]()
+
+
+def _detect_compression(header):
+    """
+    Return the compressor for data starting with "header", or None.
+    """
+    for compressor in COMPRESSORS.values():
+        if header.startswith(compressor.magic):
+            return compressor()
+    return None
+
+
+def _detect_file_compression(path):
+    """
+    Return the compressor for the file at "path", or None.
+    """
+    with open(path, "rb") as infile:
+        return _detect_compression(infile.read(4))
+
+
+class Serializer(object):
+    """
+    A file format for the contents of a cache.
+
+    Binary formats start with a magic number, so that files can be read
+    regardless of the format they were written in.
+
+    Members:
+        name (str): Name of the format.
+        magic (bytes): Magic number which starts serialized data.
+    """
+    name = None
+    magic = None
+
+    def dump(self, data, file):
+        """
+        Serialize a dict to a binary file.
+        """
+        raise NotImplementedError
+
+    def load(self, buf):
+        """
+        Deserialize a dict from a bytes-like object.
+        """
+        raise NotImplementedError
+
+
+class JsonSerializer(Serializer):
+    """
+    Human-readable JSON. Keys are converted to strings.
+    """
+    name = "json"
+
+    def dump(self, data, file):
+        encoded = json.dumps(data, sort_keys=True, indent=2,
+                             separators=(',', ': '))
+        file.write(encoded.encode("utf-8"))
+
+    def load(self, buf):
+        return json.loads(bytes(buf).decode("utf-8"))
+
+
+class PickleSerializer(Serializer):
+    """
+    Pickle, using protocol 5 where available.
+
+    With protocol 5, large buffers such as NumPy arrays are stored
+    out-of-band, after the pickle stream and aligned to 64 bytes. When
+    loaded from a memory-mapped file, arrays are views of the file
+    rather than copies. Pages are only copied when an array is
+    modified, and modifications are not written back to the file.
+
+    Only load trusted files, since unpickling can execute arbitrary
+    code.
+    """
+    name = "pickle"
+    magic = b"\x93PKL"
+
+    # Header of pickle length and number of buffers.
+    _header = struct.Struct("<QI")
+    _alignment = 64
+
+    def __init__(self, protocol=5):
+        self.protocol = min(protocol, pickle.HIGHEST_PROTOCOL)
+
+    def _padding(self, offset):
+        return -offset % self._alignment
+
+    def dump(self, data, file):
+        buffers = []
+        if self.protocol >= 5:
+            payload = pickle.dumps(data, protocol=self.protocol,
+                                   buffer_callback=buffers.append)
+            buffers = [buf.raw() for buf in buffers]
+        else:
+            payload = pickle.dumps(data, protocol=self.protocol)
+
+        file.write(self.magic)
+        file.write(self._header.pack(len(payload), len(buffers)))
+        for buf in buffers:
+            file.write(struct.pack("<Q", buf.nbytes))
+        file.write(payload)
+
+        offset = (len(self.magic) + self._header.size + 8 * len(buffers) +
+                  len(payload))
+        for buf in buffers:
+            padding = self._padding(offset)
+            file.write(b"\0" * padding)
+            file.write(buf)
+            offset += padding + buf.nbytes
+
+    def load(self, buf):
+        offset = len(self.magic)
+        length, nbuffers = self._header.unpack_from(buf, offset)
+        offset += self._header.size
+        sizes = struct.unpack_from("<{0}Q".format(nbuffers), buf, offset)
+        offset += 8 * nbuffers
+        payload = buf[offset:offset + length]
+        offset += length
+
+        if not nbuffers:
+            return pickle.loads(payload)
+
+        view = memoryview(buf)
+        buffers = []
+        for size in sizes:
+            offset += self._padding(offset)
+            buffers.append(view[offset:offset + size])
+            offset += size
+        return pickle.loads(payload, buffers=buffers)
+
+
+class MsgpackSerializer(Serializer):
+    """
+    MessagePack. Requires the "msgpack" package.
+
+    NumPy arrays are stored as raw data, and loaded as read-only views
+    of the decoded data. Tuples are loaded as lists.
+    """
+    name = "msgpack"
+    magic = b"\x93MPK"
+
+    # Extension type code for NumPy arrays.
+    _NDARRAY = 1
+
+    @classmethod
+    def _default(cls, obj):
+        import msgpack
+
+        if type(obj).__module__ == "numpy" and hasattr(obj, "dtype"):
+            import numpy as np
+
+            obj = np.ascontiguousarray(obj)
+            header = msgpack.packb([obj.dtype.str, obj.shape])
+            return msgpack.ExtType(cls._NDARRAY, header + obj.tobytes())
+        raise TypeError("Cannot serialize {0}".format(type(obj)))
+
+    @classmethod
+    def _ext_hook(cls, code, data):
+        import msgpack
+
+        if code == cls._NDARRAY:
+            import numpy as np
+
+            unpacker = msgpack.Unpacker(raw=False)
+            unpacker.feed(data)
+            dtype, shape = unpacker.unpack()
+            return np.frombuffer(data, dtype=dtype,
+                                 offset=unpacker.tell()).reshape(shape)
+        return msgpack.ExtType(code, data)
+
+    def dump(self, data, file):
+        import msgpack
+
+        file.write(self.magic)
+        msgpack.pack(data, file, default=self._default, use_bin_type=True)
+
+    def load(self, buf):
+        import msgpack
+
+        return msgpack.unpackb(memoryview(buf)[len(self.magic):], raw=False,
+                               strict_map_key=False, ext_hook=self._ext_hook)
+
+
+# Serializers which can be selected by name.
+SERIALIZERS = {
+    "json": JsonSerializer,
+    "pickle": PickleSerializer,
+    "msgpack": MsgpackSerializer,
+}
+
+
+def _serializer(serializer):
+    """
+    Return a serializer from a name or serializer.
+
+    Raises:
+        ValueError: If the serialization format is not recognised.
+    """
+    if isinstance(serializer, Serializer):
+        return serializer
+    if serializer not in SERIALIZERS:
+        raise ValueError("Unknown serialization format '{0}'"
+                         .format(serializer))
+    return SERIALIZERS[serializer]()
+
+
+def _detect_serializer(header):
+    """
+    Return the serializer for data starting with "header".
+
+    Data without a recognised magic number is assumed to be JSON.
+    """
+    for serializer in SERIALIZERS.values():
+        if serializer.magic and header.startswith(serializer.magic):
+            return serializer()
+    return JsonSerializer()
 
 
 class Cache(object):
@@ -75,6 +481,48 @@ class Cache(object):
         """
         raise NotImplementedError
 
+    def get_many(self, keys, default=None):
+        """
+        Retrieve multiple items from cache.
+
+        Arguments:
+            keys (iterable): Item keys.
+            default (optional): Value for items not found.
+
+        Returns:
+            list: Values, in the same order as keys.
+        """
+        return [self.get(key, default) for key in keys]
+
+    def set_many(self, items):
+        """
+        Set multiple (key, value) pairs.
+
+        Arguments:
+            items (dict or iterable of (key, value) tuples): Pairs to set.
+        """
+        for key, value in _pairs(items):
+            self[key] = value
+
+    def delete_many(self, keys):
+        """
+        Remove multiple (key, value) pairs.
+
+        Keys which are not in the cache are ignored.
+
+        Arguments:
+            keys (iterable): Item keys.
+
+        Returns:
+            int: Number of pairs removed.
+        """
+        removed = 0
+        for key in keys:
+            if key in self:
+                del self[key]
+                removed += 1
+        return removed
+
     def __contains__(self, key):
         """
         Returns whether key is in cache.
@@ -141,6 +589,22 @@ class TransientCache(Cache):
         self._data[key] = value
         return value
 
+    def get_many(self, keys, default=None):
+        data = self._data
+        return [data.get(key, default) for key in keys]
+
+    def set_many(self, items):
+        self._data.update(_pairs(items))
+
+    def delete_many(self, keys):
+        data = self._data
+        removed = 0
+        for key in keys:
+            if key in data:
+                del data[key]
+                removed += 1
+        return removed
+
     def __contains__(self, key):
         return key in self._data
 
@@ -167,129 +631,1717 @@ class TransientCache(Cache):
         return len(list(self._data.keys()))
 
 
-class JsonCache(TransientCache):
+class EvictionPolicy(object):
     """
-    A persistent, JSON-backed cache.
+    Strategy for choosing which entry to evict from a bounded cache.
 
-    Requires that (key, value) pairs are JSON serialisable.
+    A policy tracks the keys of a cache, and is notified of every
+    insertion, access, and removal. All operations are O(1).
     """
 
-    def __init__(self, path, basecache=None):
+    def insert(self, key):
         """
-        Create a new JSON cache.
-
-        Optionally supports populating the cache with values of an
-        existing cache.
+        Record that key has been inserted or overwritten.
+        """
+        raise NotImplementedError
 
-        Arguments:
-           basecache (TransientCache, optional): Cache to populate this new
-             cache with.
+    def access(self, key):
         """
+        Record that key has been read.
+        """
+        raise NotImplementedError
 
-        super(JsonCache, self).__init__()
-        self.path = fs.abspath(path)
+    def remove(self, key):
+        """
+        Stop tracking key.
+        """
+        raise NotImplementedError
 
-        if fs.exists(self.path):
-            io.debug(("Loading cache '{0}'".format(self.path)))
-            with open(self.path) as file:
-                self._data = json.load(file)
+    def victim(self):
+        """
+        Return the key which should be evicted next.
+        """
+        raise NotImplementedError
 
-        if basecache is not None:
-            for key,val in basecache.items():
-                self._data[key] = val
+    def clear(self):
+        """
+        Stop tracking all keys.
+        """
+        raise NotImplementedError
 
-        # Register exit handler
-        atexit.register(self.write)
+    def expired(self, key):
+        """
+        Return whether key has outlived its lifetime.
+        """
+        return False
 
-    def write(self):
+    def expired_keys(self):
         """
-        Write contents of cache to disk.
+        Return a list of all keys which have outlived their lifetime.
         """
-        io.debug("Storing cache '{0}'".format(self.path))
-        with open(self.path, "w") as file:
-            json.dump(self._data, file, sort_keys=True, indent=2,
-                      separators=(',', ': '))
+        return []
 
 
-def hash_key(key):
+class LRUPolicy(EvictionPolicy):
     """
-    Convert a key to a filename by hashing its value.
+    Evict the least recently used entry.
     """
-    return crypto.sha1_str(json.dumps(key, sort_keys=True))
 
+    def __init__(self):
+        self._order = OrderedDict()
 
-def escape_path(key):
+    def insert(self, key):
+        self._order.pop(key, None)
+        self._order[key] = None
+
+    def access(self, key):
+        self.insert(key)
+
+    def remove(self, key):
+        self._order.pop(key, None)
+
+    def victim(self):
+        return next(iter(self._order))
+
+    def clear(self):
+        self._order.clear()
+
+
+class LFUPolicy(EvictionPolicy):
     """
-    Convert a key to a filename by escaping invalid characters.
+    Evict the least frequently used entry.
+
+    Ties between entries of equal frequency are broken by evicting the
+    least recently used.
     """
-    return re.sub(r'[ \\/]+', '_', key)
 
+    def __init__(self):
+        self._freqs = {}
+        self._buckets = {}
+        self._min_freq = 0
+
+    def _bump(self, key, freq):
+        bucket = self._buckets[freq]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[freq]
+            if self._min_freq == freq:
+                self._min_freq = freq + 1
+        self._freqs[key] = freq + 1
+        self._buckets.setdefault(freq + 1, OrderedDict())[key] = None
+
+    def insert(self, key):
+        if key in self._freqs:
+            self._bump(key, self._freqs[key])
+        else:
+            self._freqs[key] = 1
+            self._buckets.setdefault(1, OrderedDict())[key] = None
+            self._min_freq = 1
+
+    def access(self, key):
+        self._bump(key, self._freqs[key])
+
+    def remove(self, key):
+        freq = self._freqs.pop(key, None)
+        if freq is None:
+            return
+        bucket = self._buckets[freq]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[freq]
+            if self._min_freq == freq:
+                # There are few distinct frequencies in practice, so
+                # this scan is cheap.
+                self._min_freq = min(self._buckets) if self._buckets else 0
+
+    def victim(self):
+        return next(iter(self._buckets[self._min_freq]))
 
-class FSCache(Cache):
-    """
-    Persistent filesystem cache.
+    def clear(self):
+        self._freqs.clear()
+        self._buckets.clear()
+        self._min_freq = 0
 
-    Each key uniquely identifies a file.
-    Each value is a file path.
 
-    Adding a file to the cache moves it into the cahce directory.
+class TTLPolicy(EvictionPolicy):
+    """
+    Expire entries a fixed number of seconds after they were set.
 
-    Members:
-        path (str): Root cache.
-        escape_key (fn): Function to convert keys to file names.
+    When over budget, the entry closest to expiry is evicted first.
     """
-    def __init__(self, root, escape_key=hash_key):
-        """
-        Create filesystem cache.
 
+    def __init__(self, ttl):
+        """
         Arguments:
-            root (str): String.
-            escape_key (fn, optional): Function to convert keys to file names.
+            ttl (float): Lifetime of an entry, in seconds.
         """
-        self.path = root
-        self.escape_key = escape_key
+        self.ttl = ttl
+        self._expiry = OrderedDict()
 
-        fs.mkdir(self.path)
+    def insert(self, key):
+        self._expiry.pop(key, None)
+        self._expiry[key] = time() + self.ttl
+
+    def access(self, key):
+        pass
+
+    def remove(self, key):
+        self._expiry.pop(key, None)
+
+    def victim(self):
+        return next(iter(self._expiry))
 
     def clear(self):
-        """
-        Empty the filesystem cache.
+        self._expiry.clear()
 
-        This deletes the entire cache directory.
-        """
-        fs.rm(self.path)
+    def expired(self, key):
+        return self._expiry[key] <= time()
 
-    def keypath(self, key):
-        """
-        Get the filesystem path for a key.
+    def expired_keys(self):
+        now = time()
+        keys = []
+        # Entries are ordered by expiry time, so stop at the first
+        # live one.
+        for key, expiry in six.iteritems(self._expiry):
+            if expiry > now:
+                break
+            keys.append(key)
+        return keys
 
-        Arguments:
-            key: Key.
 
-        Returns:
-            str: Absolute path.
-        """
-        return fs.path(self.path, self.escape_key(key))
+# Eviction policies which can be selected by name.
+EVICTION_POLICIES = {
+    "lru": LRUPolicy,
+    "lfu": LFUPolicy,
+    "ttl": TTLPolicy,
+}
 
-    def __getitem__(self, key):
-        """
-        Get path to file in cache.
 
-        Arguments:
-            key: Key.
+def _sizeof(key, value):
+    return sys.getsizeof(key) + sys.getsizeof(value)
 
-        Returns:
-            str: Path to cache value.
 
-        Raises:
-            KeyErorr: If key not in cache.
+class BoundedCache(TransientCache):
+    """
+    An in-memory cache with a limited capacity.
+
+    When the number of entries or their total size exceeds the budget,
+    entries are evicted according to an eviction policy.
+
+    Members:
+        max_entries (int): Maximum number of entries, or None.
+        max_bytes (int): Maximum total size of entries, or None.
+        policy (EvictionPolicy): Eviction policy.
+        nbytes (int): Total size of entries.
+        evictions (int): Number of entries evicted.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, policy="lru",
+                 ttl=None, sizeof=_sizeof, basecache=None):
+        """
+        Create a new bounded cache.
+
+        Example:
+
+            >>> c = BoundedCache(max_entries=2)
+            >>> c["a"] = 1; c["b"] = 2; c["c"] = 3
+            >>> "a" in c
+            False
+
+        Arguments:
+            max_entries (int, optional): Maximum number of entries.
+            max_bytes (int, optional): Maximum total size of entries, as
+              measured by "sizeof".
+            policy (str or EvictionPolicy, optional): Eviction policy,
+              either one of "lru", "lfu", or "ttl", or an EvictionPolicy
+              instance.
+            ttl (float, optional): Entry lifetime in seconds. Required
+              for the "ttl" policy.
+            sizeof (fn, optional): Function which returns the size in
+              bytes of a (key, value) pair. The default uses
+              sys.getsizeof(), which does not account for the contents
+              of containers.
+            basecache (TransientCache, optional): Cache to populate this
+              new cache with.
+
+        Raises:
+            ValueError: If the policy is not recognised, or if a "ttl"
+              policy is requested without a ttl.
+        """
+        super(BoundedCache, self).__init__()
+
+        if isinstance(policy, EvictionPolicy):
+            self.policy = policy
+        elif policy == "ttl":
+            if ttl is None:
+                raise ValueError("ttl eviction policy requires a ttl")
+            self.policy = TTLPolicy(ttl)
+        elif policy in EVICTION_POLICIES:
+            self.policy = EVICTION_POLICIES[policy]()
+        else:
+            raise ValueError("Unknown eviction policy '{0}'".format(policy))
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self.evictions = 0
+        self._sizes = {}
+
+        if basecache is not None:
+            for key,val in basecache.items():
+                self[key] = val
+
+    def _remove(self, key):
+        del self._data[key]
+        self.nbytes -= self._sizes.pop(key)
+        self.policy.remove(key)
+
+    def _over_budget(self, entries=0, nbytes=0):
+        return ((self.max_entries is not None and
+                 len(self._data) + entries > self.max_entries) or
+                (self.max_bytes is not None and
+                 self.nbytes + nbytes > self.max_bytes))
+
+    def evict(self):
+        """
+        Evict a single entry.
+
+        Returns:
+            The key of the evicted entry.
+
+        Raises:
+            KeyError: If the cache is empty.
+        """
+        if not self._data:
+            raise KeyError("evict(): cache is empty")
+        key = self.policy.victim()
+        self._remove(key)
+        self.evictions += 1
+        return key
+
+    def expire(self):
+        """
+        Remove all entries which have outlived their lifetime.
+        """
+        for key in self.policy.expired_keys():
+            self._remove(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def clear(self):
+        super(BoundedCache, self).clear()
+        self._sizes.clear()
+        self.policy.clear()
+        self.nbytes = 0
+
+    def items(self):
+        self.expire()
+        return super(BoundedCache, self).items()
+
+    def __getitem__(self, key):
+        value = self._data[key]
+        if self.policy.expired(key):
+            self._remove(key)
+            raise KeyError(key)
+        self.policy.access(key)
+        return value
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(key, value)
+        if key in self._data:
+            self._remove(key)
+
+        # Make room before inserting, so that the new entry is not
+        # itself chosen for eviction.
+        self.expire()
+        while self._data and self._over_budget(1, size):
+            self.evict()
+
+        self._data[key] = value
+        self._sizes[key] = size
+        self.nbytes += size
+        self.policy.insert(key)
+
+        # An entry which alone exceeds the budget is not kept.
+        if self._over_budget():
+            self.evict()
+        return value
+
+    def __contains__(self, key):
+        if key not in self._data:
+            return False
+        if self.policy.expired(key):
+            self._remove(key)
+            return False
+        return True
+
+    def __delitem__(self, key):
+        if key not in self._data:
+            raise KeyError(key)
+        self._remove(key)
+
+    # Entries must go through the eviction policy one at a time.
+    def get_many(self, keys, default=None):
+        return Cache.get_many(self, keys, default)
+
+    def set_many(self, items):
+        return Cache.set_many(self, items)
+
+    def delete_many(self, keys):
+        return Cache.delete_many(self, keys)
+
+    def __iter__(self):
+        self.expire()
+        return super(BoundedCache, self).__iter__()
+
+    def __len__(self):
+        self.expire()
+        return len(self._data)
+
+
+class JsonCache(TransientCache):
+    """
+    A persistent, JSON-backed cache.
+
+    Requires that (key, value) pairs are JSON serialisable, unless a
+    binary serializer is used. The pickle serializer stores any
+    picklable values, and loads NumPy arrays without copying them.
+    Serialized files are detected on load, so the serializer can be
+    changed for an existing cache. By default, a cache is written in
+    the format it was loaded from.
+
+    In lazy mode, the cache file is not parsed until the cache is first
+    accessed. If the cache was written with an offset index, single
+    keys can then be looked up from a memory-mapped file without
+    parsing the whole document. Any other access loads the full cache.
+
+    The cache file may be compressed. Compressed files are detected on
+    load, so the compression setting can be changed for an existing
+    cache.
+
+    By default, the cache is written on exit. Given a flush interval,
+    modifications are also written periodically by a background
+    thread, so that they survive a killed process, and the cache is
+    only written on exit if modified since the last flush. Every write
+    rewrites the whole file, so the cost of exiting after a
+    modification grows with the size of the cache. For large caches
+    which are modified often, use a JournalCache, which writes only
+    the modifications.
+
+    Members:
+        path (str): Path of the cache file.
+        flush_interval (float): Seconds between background flushes, or
+          None.
+    """
+
+    def __init__(self, path, basecache=None, lazy=False, index=False,
+                 compression=None, compress_threshold=1024 * 1024,
+                 serializer=None, flush_interval=None):
+        """
+        Create a new JSON cache.
+
+        Optionally supports populating the cache with values of an
+        existing cache.
+
+        Arguments:
+           basecache (TransientCache, optional): Cache to populate this new
+             cache with.
+           lazy (bool, optional): Defer loading the cache until first
+             access.
+           index (bool, optional): Write an offset index alongside the
+             cache file, at "<path>.idx", for lazy single-key lookups.
+             Compressed caches are not indexed.
+           compression (str or Compressor, optional): Compress the
+             cache file using "gzip", "zstd", or "lz4".
+           compress_threshold (int, optional): Only compress the cache
+             file if it is at least this many bytes.
+           serializer (str or Serializer, optional): Write the cache
+             file using "json", "pickle", or "msgpack". If not given,
+             use the format of the existing cache file, or JSON. Only
+             JSON caches are indexed.
+           flush_interval (float, optional): Write modifications to disk
+             in a background thread, at most once per this many
+             seconds.
+        """
+
+        super(JsonCache, self).__init__()
+        self.path = fs.abspath(path)
+        self.index = index
+        self.compression = _compressor(compression)
+        self.compress_threshold = compress_threshold
+        self.serializer = _serializer(serializer or "json")
+        self._detect_serializer = serializer is None
+
+        self.flush_interval = flush_interval
+
+        self._loaded = False
+        self._offsets = None
+        self._mmap = None
+        self._dirty = False
+        self._write_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = None
+
+        if not lazy:
+            self._load()
+
+        if basecache is not None:
+            for key,val in basecache.items():
+                self._data[key] = val
+                self._dirty = True
+
+        if flush_interval is not None:
+            self._flusher = threading.Thread(target=self._flush_loop)
+            self._flusher.daemon = True
+            self._flusher.start()
+
+        # Register exit handler
+        atexit.register(self.close)
+
+    @property
+    def _data(self):
+        if not self._loaded:
+            self._load()
+        return self._dict
+
+    @_data.setter
+    def _data(self, value):
+        self._dict = value
+
+    def _load(self):
+        self._loaded = True
+        self._close_mmap()
+        if fs.exists(self.path):
+            io.debug(("Loading cache '{0}'".format(self.path)))
+            compressor = _detect_file_compression(self.path)
+            if compressor:
+                with compressor.open(self.path) as file:
+                    serializer = _detect_serializer(file.read(4))
+                if self._detect_serializer:
+                    self.serializer = serializer
+                # Reopen, as compressed streams may not seek backwards.
+                with compressor.open(self.path) as file:
+                    if isinstance(serializer, JsonSerializer):
+                        # Decode as the file is decompressed, rather
+                        # than buffering the decompressed bytes.
+                        self._dict = json.load(
+                            codecs.getreader("utf-8")(file))
+                    else:
+                        self._dict = serializer.load(file.read())
+                return
+
+            with open(self.path, "rb") as file:
+                serializer = _detect_serializer(file.read(4))
+                if self._detect_serializer:
+                    self.serializer = serializer
+                if isinstance(serializer, JsonSerializer):
+                    file.seek(0)
+                    self._dict = json.load(codecs.getreader("utf-8")(file))
+                else:
+                    # Binary formats are loaded from a private mapping,
+                    # so that buffers can reference the file directly.
+                    buf = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+                    self._dict = serializer.load(buf)
+
+    def _close_mmap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._offsets = None
+
+    def _read_index(self):
+        """
+        Read the offset index, if there is one and it is up to date.
+
+        Returns:
+            dict: Map of keys to (offset, length) pairs, or False if
+              there is no usable index.
+        """
+        index_path = self.path + ".idx"
+        if not fs.exists(index_path) or not fs.exists(self.path):
+            return False
+
+        with open(index_path) as infile:
+            index = json.load(infile)
+        stat = os.stat(self.path)
+        if index["size"] != stat.st_size or index["mtime"] != stat.st_mtime:
+            io.debug("Ignoring stale cache index '{0}'".format(index_path))
+            return False
+
+        with open(self.path, "rb") as infile:
+            self._mmap = mmap.mmap(infile.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        return index["offsets"]
+
+    def _indexed(self):
+        """
+        Return whether single keys can be looked up without loading.
+        """
+        if self._loaded:
+            return False
+        if self._offsets is None:
+            self._offsets = self._read_index()
+        return self._offsets is not False
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __getitem__(self, key):
+        if self._indexed():
+            if key not in self._offsets:
+                raise KeyError(key)
+            offset, length = self._offsets[key]
+            return json.loads(
+                self._mmap[offset:offset + length].decode("utf-8"))
+        return self._data[key]
+
+    def __contains__(self, key):
+        if self._indexed():
+            return key in self._offsets
+        return key in self._data
+
+    def get_many(self, keys, default=None):
+        if self._indexed():
+            return Cache.get_many(self, keys, default)
+        return super(JsonCache, self).get_many(keys, default)
+
+    def _write_indexed(self, data, path):
+        offsets = {}
+        with open(path, "wb") as file:
+            # Produces the same output as json.dump(), keeping track of
+            # the position of each value. json.dumps() escapes non-ASCII
+            # characters, so string lengths are byte lengths.
+            file.write(b"{")
+            offset = 1
+            for i, (key, value) in enumerate(sorted(six.iteritems(data))):
+                if not isinstance(key, six.string_types):
+                    key = json.dumps(key)
+                prefix = "{0}\n  {1}: ".format("," if i else "",
+                                               json.dumps(key))
+                encoded = json.dumps(value, sort_keys=True, indent=2,
+                                     separators=(',', ': '))
+                encoded = encoded.replace("\n", "\n  ")
+                offset += len(prefix)
+                offsets[key] = (offset, len(encoded))
+                offset += len(encoded)
+                file.write((prefix + encoded).encode("utf-8"))
+            file.write(b"\n}" if offsets else b"}")
+        return offsets
+
+    def _write_binary(self, data, path):
+        buf = None
+        if self.compression:
+            buf = six.BytesIO()
+            self.serializer.dump(data, buf)
+
+        if buf and buf.tell() >= self.compress_threshold:
+            with self.compression.open(path, "wb") as file:
+                file.write(buf.getvalue())
+        else:
+            with open(path, "wb") as file:
+                if buf:
+                    file.write(buf.getvalue())
+                else:
+                    self.serializer.dump(data, file)
+
+    def _write_file(self, data, path):
+        """
+        Write a snapshot of the cache to "path".
+
+        Returns:
+            dict: Offset index, or None if the file is not indexed.
+        """
+        if not isinstance(self.serializer, JsonSerializer):
+            self._write_binary(data, path)
+            return None
+
+        if self.compression:
+            encoded = json.dumps(data, sort_keys=True, indent=2,
+                                 separators=(',', ': '))
+            if len(encoded) >= self.compress_threshold:
+                with self.compression.open(path, "wb") as file:
+                    file.write(encoded.encode("utf-8"))
+                return None
+
+        if self.index:
+            return self._write_indexed(data, path)
+
+        with open(path, "w") as file:
+            json.dump(data, file, sort_keys=True, indent=2,
+                      separators=(',', ': '))
+        return None
+
+    def write(self):
+        """
+        Write contents of cache to disk.
+
+        The cache file is replaced atomically, so a crash while writing
+        leaves the previous contents intact. If the cache was never
+        loaded, there is nothing to write.
+        """
+        if not self._loaded:
+            return
+
+        with self._write_lock:
+            # Clear the flag before taking the snapshot, so that
+            # modifications made while writing are not lost.
+            self._dirty = False
+            data = self._dict.copy()
+
+            io.debug("Storing cache '{0}'".format(self.path))
+            # Write to a new file, since the current file may be mapped
+            # by values loaded from it.
+            tmp = "{0}.{1}.tmp".format(self.path, os.getpid())
+            index_path = self.path + ".idx"
+            try:
+                offsets = self._write_file(data, tmp)
+                _fsync_file(tmp)
+                fs.rm(index_path)
+                _replace(tmp, self.path)
+            except:
+                self._dirty = True
+                fs.rm(tmp)
+                raise
+            _fsync_dir(fs.dirname(self.path))
+
+            if offsets is not None:
+                stat = os.stat(self.path)
+                with open(index_path, "w") as file:
+                    json.dump({"size": stat.st_size, "mtime": stat.st_mtime,
+                               "offsets": offsets}, file)
+
+    def flush(self):
+        """
+        Write contents of cache to disk, if modified since last written.
+
+        Only modifications made through the cache are tracked. Values
+        which are modified in place are written with the next write().
+
+        Returns:
+            bool: True if the cache was written, else False.
+        """
+        if not self._dirty:
+            return False
+        self.write()
+        return True
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                io.error("Failed to flush cache '{0}': {1}"
+                         .format(self.path, e))
+
+    def close(self):
+        """
+        Stop background flushing, and write any pending modifications.
+
+        Called on exit. If the cache has been modified since it was
+        last written, the whole cache is rewritten, so this takes time
+        proportional to the size of the cache. Without a flush
+        interval, the cache is always written, as modifications to
+        values in place are not tracked. See JournalCache for a cache
+        whose writes are proportional to the size of each change.
+        """
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+            self.flush()
+        else:
+            self.write()
+
+    def clear(self):
+        self._dirty = True
+        super(JsonCache, self).clear()
+
+    def __setitem__(self, key, value):
+        self._dirty = True
+        return super(JsonCache, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super(JsonCache, self).__delitem__(key)
+        self._dirty = True
+
+    def set_many(self, items):
+        self._dirty = True
+        super(JsonCache, self).set_many(items)
+
+    def delete_many(self, keys):
+        removed = super(JsonCache, self).delete_many(keys)
+        if removed:
+            self._dirty = True
+        return removed
+
+
+def _replace(src, dst):
+    """
+    Atomically move "src" over "dst".
+    """
+    if six.PY3:
+        os.replace(src, dst)
+    else:
+        # Python 2 has no os.replace(). On POSIX, rename() overwrites
+        # atomically.
+        os.rename(src, dst)
+
+
+class JournalCache(TransientCache):
+    """
+    A persistent, JSON-backed cache with an append-only journal.
+
+    Every modification is appended to the journal as a single line, so
+    the cost of a write is proportional to the size of the change, not
+    the size of the cache. On construction, the journal is replayed to
+    restore the cache contents. Once the journal grows past a size
+    threshold, it is compacted in a background thread.
+
+    Requires that values are JSON serialisable, and that keys are
+    strings or numbers.
+
+    Members:
+        path (str): Path of the journal file.
+        compact_threshold (int): Journal size in bytes above which to
+          compact.
+        sync (bool): Whether to fsync after every write.
+    """
+
+    def __init__(self, path, basecache=None, compact_threshold=64 * 1024 * 1024,
+                 sync=False):
+        """
+        Create a new journaled cache.
+
+        Arguments:
+           path (str): Path of the journal file.
+           basecache (TransientCache, optional): Cache to populate this new
+             cache with.
+           compact_threshold (int, optional): Journal size in bytes above
+             which it is compacted. Compaction only happens once the
+             journal has at least doubled in size since last compacted.
+           sync (bool, optional): If true, fsync the journal after every
+             write, so that modifications survive a power loss, not just
+             a process crash.
+        """
+        super(JournalCache, self).__init__()
+        self.path = fs.abspath(path)
+        self.compact_threshold = compact_threshold
+        self.sync = sync
+
+        self._lock = threading.RLock()
+        self._compactor = None
+        self._pending = None
+
+        if fs.exists(self.path):
+            io.debug("Replaying cache journal '{0}'".format(self.path))
+            self._replay()
+        else:
+            fs.mkdir(fs.dirname(self.path))
+
+        self._file = open(self.path, "a")
+        self._size = self._file.tell()
+        self._compacted_size = self._size
+
+        if basecache is not None:
+            for key,val in basecache.items():
+                self[key] = val
+
+        # Register exit handler
+        atexit.register(self.close)
+
+    def _replay(self):
+        valid = 0
+        with open(self.path, "rb") as infile:
+            for line in infile:
+                try:
+                    # Records are complete once their newline is written.
+                    if not line.endswith(b"\n"):
+                        raise ValueError
+                    record = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    # A partially written record, from an interrupted
+                    # process. Everything after it is discarded.
+                    io.warn("Truncating corrupt cache journal '{0}'"
+                            .format(self.path))
+                    break
+                op = record[0]
+                if op == "s":
+                    self._data[record[1]] = record[2]
+                elif op == "d":
+                    self._data.pop(record[1], None)
+                elif op == "c":
+                    self._data.clear()
+                valid += len(line)
+
+        if valid < os.path.getsize(self.path):
+            with open(self.path, "r+b") as outfile:
+                outfile.truncate(valid)
+
+    @staticmethod
+    def _record(*args):
+        return json.dumps(args) + "\n"
+
+    @staticmethod
+    def _check_key(key):
+        # Other keys, such as tuples, would be replayed as unhashable
+        # lists.
+        if (isinstance(key, bool) or
+                not isinstance(key, six.string_types + six.integer_types +
+                               (float,))):
+            raise TypeError("Cache journal keys must be strings or numbers, "
+                            "not '{0}'".format(type(key).__name__))
+
+    def _append(self, line):
+        self._file.write(line)
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+
+        self._size += len(line)
+        if self._pending is not None:
+            self._pending.append(line)
+
+        if (self._compactor is None and
+            self._size > self.compact_threshold and
+            self._size > 2 * self._compacted_size):
+            self.compact(block=False)
+
+    def _compact(self, snapshot):
+        tmp = self.path + ".compact"
+        try:
+            # Writing the snapshot is the expensive part, and does not
+            # block other writers.
+            with open(tmp, "w") as outfile:
+                for key, value in six.iteritems(snapshot):
+                    outfile.write(self._record("s", key, value))
+
+            with self._lock:
+                with open(tmp, "a") as outfile:
+                    # Records appended since the snapshot was taken.
+                    outfile.writelines(self._pending)
+                    outfile.flush()
+                    os.fsync(outfile.fileno())
+                self._file.close()
+                _replace(tmp, self.path)
+                self._file = open(self.path, "a")
+                self._size = self._file.tell()
+                self._compacted_size = self._size
+        except Exception as e:
+            io.error("Failed to compact cache journal '{0}': {1}"
+                     .format(self.path, e))
+            fs.rm(tmp)
+        finally:
+            with self._lock:
+                self._pending = None
+                self._compactor = None
+
+    def compact(self, block=True):
+        """
+        Rewrite the journal to contain only the current cache contents.
+
+        Arguments:
+            block (bool, optional): If false, return immediately and
+              compact in a background thread.
+        """
+        with self._lock:
+            if self._compactor is None:
+                self._pending = []
+                self._compactor = threading.Thread(
+                    target=self._compact, args=(dict(self._data),))
+                self._compactor.daemon = True
+                self._compactor.start()
+            compactor = self._compactor
+
+        if block:
+            compactor.join()
+
+    def close(self):
+        """
+        Wait for any compaction to finish, and close the journal.
+        """
+        with self._lock:
+            compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+        with self._lock:
+            self._file.close()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._append(self._record("c"))
+
+    def __setitem__(self, key, value):
+        # Serialise before modifying, so that an unserialisable value
+        # leaves the cache unchanged.
+        self._check_key(key)
+        line = self._record("s", key, value)
+        with self._lock:
+            self._data[key] = value
+            self._append(line)
+        return value
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+            self._append(self._record("d", key))
+
+    def set_many(self, items):
+        items = list(_pairs(items))
+        for key, _ in items:
+            self._check_key(key)
+        lines = "".join(self._record("s", key, value) for key, value in items)
+        with self._lock:
+            self._data.update(items)
+            self._append(lines)
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        for key in keys:
+            self._check_key(key)
+        with self._lock:
+            keys = [key for key in keys if key in self._data]
+            for key in keys:
+                del self._data[key]
+            self._append("".join(self._record("d", key) for key in keys))
+        return len(keys)
+
+
+class SqliteCache(Cache):
+    """
+    A persistent, SQLite-backed cache.
+
+    Entries are stored in an indexed table and read on demand, so
+    opening a cache is independent of its size. The database uses
+    write-ahead logging, and writes are committed in batches.
+
+    Requires that (key, value) pairs are JSON serialisable.
+
+    Values may be compressed. Compressed values are stored as blobs
+    with a self-describing header, so uncompressed values written by
+    older caches remain readable.
+
+    Members:
+        db (labm8.db.Database): Database.
+        table (str): Name of the table storing entries.
+        commit_every (int): Number of writes per commit.
+        compression (Compressor): Value compressor, or None.
+        compress_threshold (int): Minimum size of compressed values.
+    """
+
+    def __init__(self, path, table="cache", commit_every=1000,
+                 basecache=None, compression=None, compress_threshold=1024):
+        """
+        Create a new SQLite cache.
+
+        Arguments:
+           path (str): Path to the database file.
+           table (str, optional): Name of the table to store entries in.
+           commit_every (int, optional): Number of writes to group into
+             a single commit. Uncommitted writes are visible to this
+             cache, but not to other connections.
+           basecache (Cache, optional): Cache to populate this new cache
+             with.
+           compression (str or Compressor, optional): Compress values
+             using "gzip", "zstd", or "lz4".
+           compress_threshold (int, optional): Only compress values
+             which encode to at least this many bytes.
+        """
+        self.table = table
+        self.commit_every = commit_every
+        self.compression = _compressor(compression)
+        self.compress_threshold = compress_threshold
+        self._uncommitted = 0
+
+        self.db = db.Database(path, {
+            table: (("key", "text primary key"), ("value", "text"))
+        })
+        self.db.execute("PRAGMA journal_mode=WAL")
+
+        if basecache is not None:
+            for key,val in basecache.items():
+                self[key] = val
+
+        # Register exit handler
+        atexit.register(self.close)
+
+    @staticmethod
+    def _encode_key(key):
+        return json.dumps(key, sort_keys=True)
+
+    def _encode_value(self, value):
+        encoded = json.dumps(value)
+        if self.compression and len(encoded) >= self.compress_threshold:
+            return sqlite3.Binary(
+                self.compression.compress(encoded.encode("utf-8")))
+        return encoded
+
+    @staticmethod
+    def _decode_value(value):
+        if not isinstance(value, six.text_type):
+            value = bytes(value)
+            compressor = _detect_compression(value)
+            if compressor:
+                value = compressor.decompress(value)
+            value = value.decode("utf-8")
+        return json.loads(value)
+
+    def _modified(self):
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        """
+        Commit pending writes.
+        """
+        self.db.commit()
+        self._uncommitted = 0
+
+    def close(self):
+        """
+        Commit pending writes and close the database.
+        """
+        if self._uncommitted:
+            self.commit()
+        self.db.close()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def clear(self):
+        self.db.execute("DELETE FROM " + self.table)
+        self.commit()
+
+    def items(self):
+        query = self.db.execute("SELECT key, value FROM " + self.table)
+        for key, value in query:
+            yield json.loads(key), self._decode_value(value)
+
+    def __getitem__(self, key):
+        row = self.db.execute(
+            "SELECT value FROM {table} WHERE key=?".format(table=self.table),
+            (self._encode_key(key),)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return self._decode_value(row[0])
+
+    def __setitem__(self, key, value):
+        self.db.execute(
+            "INSERT OR REPLACE INTO {table} VALUES (?,?)"
+            .format(table=self.table),
+            (self._encode_key(key), self._encode_value(value)))
+        self._modified()
+        return value
+
+    def __contains__(self, key):
+        return self.db.execute(
+            "SELECT 1 FROM {table} WHERE key=?".format(table=self.table),
+            (self._encode_key(key),)).fetchone() is not None
+
+    def __delitem__(self, key):
+        query = self.db.execute(
+            "DELETE FROM {table} WHERE key=?".format(table=self.table),
+            (self._encode_key(key),))
+        if not query.rowcount:
+            raise KeyError(key)
+        self._modified()
+
+    def get_many(self, keys, default=None):
+        encoded = [self._encode_key(key) for key in keys]
+        values = {}
+        # Stay within SQLite's limit on the number of parameters.
+        for i in range(0, len(encoded), 500):
+            chunk = encoded[i:i + 500]
+            query = self.db.execute(
+                "SELECT key, value FROM {table} WHERE key IN {keys}"
+                .format(table=self.table, keys=db.placeholders(*chunk)),
+                chunk)
+            for key, value in query:
+                values[key] = self._decode_value(value)
+        return [values.get(key, default) for key in encoded]
+
+    def set_many(self, items):
+        """
+        Set multiple (key, value) pairs in a single transaction.
+        """
+        self.db.executemany(
+            "INSERT OR REPLACE INTO {table} VALUES (?,?)"
+            .format(table=self.table),
+            ((self._encode_key(key), self._encode_value(value))
+             for key, value in _pairs(items)))
+        self.commit()
+
+    def delete_many(self, keys):
+        """
+        Remove multiple (key, value) pairs in a single transaction.
+        """
+        query = self.db.executemany(
+            "DELETE FROM {table} WHERE key=?".format(table=self.table),
+            ((self._encode_key(key),) for key in keys))
+        self.commit()
+        return query.rowcount
+
+    def __iter__(self):
+        """
+        Iterate over all cache entries.
+
+        Returns:
+            iterable: Entries in cache.
+        """
+        for row in self.db.execute("SELECT value FROM " + self.table):
+            yield self._decode_value(row[0])
+
+    def __len__(self):
+        """
+        Get the number of cache entries.
+
+        Returns:
+            int: Number of entries in the cache.
+        """
+        return self.db.num_rows(self.table)
+
+
+def hash_key(key):
+    """
+    Convert a key to a filename by hashing its value.
+    """
+    return crypto.sha1_str(json.dumps(key, sort_keys=True))
+
+
+def _encode_key(key, out):
+    """
+    Append a canonical encoding of a key to a list of bytes.
+
+    Each value is prefixed with a type tag, and strings and containers
+    with their length, so that distinct keys have distinct encodings.
+    Dicts are encoded in key order. Tuples and lists are equivalent, as
+    they are for JSON.
+    """
+    # Fast paths for exact types, the common case.
+    t = type(key)
+    if t is str and six.PY3:
+        key = key.encode("utf-8")
+        out.append(b"s%d:" % len(key))
+        out.append(key)
+    elif t is int:
+        out.append(b"i%d;" % key)
+    elif t is tuple or t is list:
+        out.append(b"l%d:" % len(key))
+        for item in key:
+            _encode_key(item, out)
+    elif t is dict:
+        out.append(b"d%d:" % len(key))
+        for name in sorted(key):
+            _encode_key(name, out)
+            _encode_key(key[name], out)
+    # Subclasses, and everything else.
+    elif isinstance(key, six.string_types):
+        if isinstance(key, six.text_type):
+            key = key.encode("utf-8")
+        out.append(b"s%d:" % len(key))
+        out.append(key)
+    elif key is None:
+        out.append(b"n")
+    elif key is True:
+        out.append(b"t")
+    elif key is False:
+        out.append(b"f")
+    elif isinstance(key, six.integer_types):
+        out.append(b"i%d;" % key)
+    elif isinstance(key, float):
+        out.append(("f%r;" % key).encode("ascii"))
+    elif isinstance(key, (tuple, list)):
+        _encode_key(list(key), out)
+    elif isinstance(key, dict):
+        _encode_key(dict(key), out)
+    elif hasattr(key, "cache_key"):
+        cls = type(key)
+        out.append(b"o")
+        _encode_key([cls.__module__, getattr(cls, "__qualname__",
+                                             cls.__name__),
+                     key.cache_key()], out)
+    else:
+        raise TypeError("Cannot hash key of type '{0}'. Objects must "
+                        "define cache_key() to be hashed."
+                        .format(type(key).__name__))
+
+
+def fast_hash_key(key, digest_size=16):
+    """
+    Convert a key to a filename by hashing its value.
+
+    A faster alternative to hash_key(), for keys composed of strings,
+    numbers, None, booleans, tuples, lists, and dicts. Other objects
+    are hashed by their type and the value returned by their
+    cache_key() method, if they have one. The key is
+    encoded to bytes directly, rather than via a JSON string, and
+    hashed using BLAKE2b. Hashes are stable across runs, but differ
+    from those of hash_key().
+
+    On Pythons without BLAKE2b, SHA1 is used, and "digest_size" is
+    ignored.
+
+    Arguments:
+        key: Key.
+        digest_size (int, optional): Size of digest in bytes.
+
+    Returns:
+        str: Hex encoded hash.
+
+    Raises:
+        TypeError: If the key contains an unsupported type.
+    """
+    out = []
+    _encode_key(key, out)
+    data = b"".join(out)
+    if hasattr(hashlib, "blake2b"):
+        return hashlib.blake2b(data, digest_size=digest_size).hexdigest()
+    else:
+        return hashlib.sha1(data).hexdigest()
+
+
+def escape_path(key):
+    """
+    Convert a key to a filename by escaping invalid characters.
+    """
+    return re.sub(r'[ \\/]+', '_', key)
+
+
+def _fsync_file(path):
+    """
+    Flush a file's contents to disk.
+    """
+    fd = os.open(path, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_dir(path):
+    """
+    Flush a directory's entries to disk.
+
+    Not supported on Windows, where this does nothing.
+    """
+    if sys.platform == "win32":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _du(path):
+    """
+    Return the size in bytes of a file, or of all files in a directory.
+    """
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, files in os.walk(path) for name in files)
+
+
+# Header of files compressed by an FSCache, followed by the name of the
+# compression format and a newline. Files are only decompressed if they
+# have this header, so stored files which are themselves compressed are
+# returned as they are.
+_FSCACHE_COMPRESSED = b"\x00labm8-compressed:"
+
+
+class FSCache(Cache):
+    """
+    Persistent filesystem cache.
+
+    Each key uniquely identifies a file.
+    Each value is a file path.
+
+    Adding a file to the cache moves it into the cahce directory.
+
+    Entries may be stored directly in the cache directory, or in a
+    sharded layout, where each entry is nested in subdirectories named
+    after successive pairs of characters of its file name, e.g.
+    "ab/cd/abcdef...", or "_" past the end of a short name, e.g.
+    "ab/_/ab". Sharding keeps directories small when there are many
+    entries.
+
+    Inserts may be made atomic, so that concurrent readers and writers
+    never see a partially inserted entry. Payloads are staged in a
+    temporary directory inside the cache and renamed into place.
+    Optionally, files with identical contents may be deduplicated by
+    hardlinking them to a single content-addressed copy. Since
+    deduplicated entries share storage, they must not be modified in
+    place. File names beginning with "." are reserved for internal use.
+
+    A cache may be given a budget for the total size or number of
+    entries. When over budget, the least recently used entries are
+    evicted. Recency is tracked from the access and modification times
+    of entries, which are scanned once, then maintained in memory.
+
+    Files may be compressed as they are inserted. Entries compressed
+    by the cache are marked by a header, so use open() to read entries
+    without needing to know whether they were compressed. Stored files
+    which are themselves compressed, e.g. archives, are not
+    decompressed.
+
+    Members:
+        path (str): Root cache.
+        escape_key (fn): Function to convert keys to file names.
+        shard_depth (int): Number of levels of shard subdirectories.
+        max_bytes (int): Maximum total size of entries, or None.
+        max_entries (int): Maximum number of entries, or None.
+        evictions (int): Number of entries evicted.
+        nbytes (int): Total size of entries, or None if not tracked.
+        atomic (bool): Whether inserts are atomic.
+        dedup (bool): Whether files with identical contents are
+          deduplicated.
+        compression (Compressor): File compressor, or None.
+        compress_threshold (int): Minimum size of compressed files.
+    """
+    def __init__(self, root, escape_key=hash_key, shard_depth=0,
+                 max_bytes=None, max_entries=None, atomic=False,
+                 dedup=False, compression=None, compress_threshold=4096):
+        """
+        Create filesystem cache.
+
+        Arguments:
+            root (str): String.
+            escape_key (fn, optional): Function to convert keys to file names.
+            shard_depth (int, optional): Number of levels of shard
+              subdirectories. Use reshard() to migrate an existing cache
+              to a different layout.
+            max_bytes (int, optional): Maximum total size of entries.
+            max_entries (int, optional): Maximum number of entries.
+            atomic (bool, optional): Make inserts atomic.
+            dedup (bool, optional): Deduplicate files with identical
+              contents. Implies atomic inserts. The total size of a
+              budgeted cache counts deduplicated files once per entry.
+            compression (str or Compressor, optional): Compress files
+              using "gzip", "zstd", or "lz4". Directories are not
+              compressed.
+            compress_threshold (int, optional): Only compress files of
+              at least this many bytes.
+        """
+        self.path = root
+        self.escape_key = escape_key
+        self.shard_depth = shard_depth
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.atomic = atomic or dedup
+        self.dedup = dedup
+        self.compression = _compressor(compression)
+        self.compress_threshold = compress_threshold
+        self.evictions = 0
+
+        # Number of entries. Counted on first use, then maintained by
+        # this instance.
+        self._count = None
+
+        # Map of entry paths to sizes, in least recently used order,
+        # and their total size. Built on first use.
+        self._lru = None
+        self._nbytes = 0
+
+        fs.mkdir(self.path)
+
+    def _shards(self, name):
+        # Names too short to fill every level are padded with "_"
+        # shards, so that all entries are at the same depth. Otherwise,
+        # an entry which is a directory would be taken for a shard.
+        return [name[i:i + 2] or "_"
+                for i in range(0, 2 * self.shard_depth, 2)]
+
+    def _entries(self, root=None, depth=None):
+        """
+        Iterate over the paths of all cache entries.
+        """
+        root = root or fs.abspath(self.path)
+        depth = self.shard_depth if depth is None else depth
+
+        if not fs.isdir(root):
+            return
+        for name in fs.ls(root):
+            if name.startswith("."):
+                continue
+            path = fs.path(root, name)
+            if depth and fs.isdir(path):
+                for entry in self._entries(path, depth - 1):
+                    yield entry
+            else:
+                yield path
+
+    def _budgeted(self):
+        return self.max_bytes is not None or self.max_entries is not None
+
+    @property
+    def nbytes(self):
+        """
+        Total size of entries in bytes, or None if not yet tracked.
+
+        The size is tracked once the cache has been scanned, by du(),
+        gc(), or an insertion into a cache with a budget. After that,
+        it is maintained on insertion and deletion. Reading it never
+        scans the cache.
+        """
+        return None if self._lru is None else self._nbytes
+
+    def du(self):
+        """
+        Get the total size of entries in bytes.
+
+        The cache is scanned on first call. After that, the size is
+        maintained on insertion and deletion, and each lookup records
+        the access time of its entry.
+
+        Returns:
+            int: Total size of entries in bytes.
+        """
+        self._index()
+        return self._nbytes
+
+    def _index(self):
+        """
+        Return the LRU index, scanning the cache if needed.
+        """
+        if self._lru is None:
+            entries = []
+            for path in self._entries():
+                stat = os.stat(path)
+                entries.append((max(stat.st_atime, stat.st_mtime),
+                                path, _du(path)))
+            self._lru = OrderedDict(
+                (path, size) for _, path, size in sorted(entries))
+            self._nbytes = sum(self._lru.values())
+            self._count = len(self._lru)
+        return self._lru
+
+    def _touch(self, path):
+        """
+        Mark an entry as most recently used.
+        """
+        if self._lru is not None and path in self._lru:
+            self._lru[path] = self._lru.pop(path)
+            # Record the access on disk, for filesystems mounted with
+            # noatime.
+            os.utime(path, (time(), os.stat(path).st_mtime))
+
+    def gc(self):
+        """
+        Evict least recently used entries until within budget.
+
+        The most recently used entry is never evicted.
+
+        Returns:
+            int: Number of entries evicted.
+        """
+        if not self._budgeted():
+            return 0
+
+        lru = self._index()
+        evicted = 0
+        while len(lru) > 1 and (
+                (self.max_entries is not None and
+                 len(lru) > self.max_entries) or
+                (self.max_bytes is not None and
+                 self._nbytes > self.max_bytes)):
+            path = next(iter(lru))
+            self._nbytes -= lru.pop(path)
+            self._count -= 1
+            self._unlink(path)
+            evicted += 1
+
+        self.evictions += evicted
+        if evicted:
+            io.debug("Evicted {0} entries from cache '{1}'"
+                     .format(evicted, self.path))
+        return evicted
+
+    def clear(self):
+        """
+        Empty the filesystem cache.
+
+        This deletes the entire cache directory.
+        """
+        fs.rm(self.path)
+        self._count = 0
+        if self._lru is not None:
+            self._lru.clear()
+            self._nbytes = 0
+
+    def keypath(self, key):
+        """
+        Get the filesystem path for a key.
+
+        Arguments:
+            key: Key.
+
+        Returns:
+            str: Absolute path.
+        """
+        name = self.escape_key(key)
+        return fs.path(self.path, *(self._shards(name) + [name]))
+
+    def reshard(self, shard_depth):
+        """
+        Migrate cache entries to a different directory layout.
+
+        Arguments:
+            shard_depth (int): New number of levels of shard
+              subdirectories. Use 0 for a flat layout.
+        """
+        # Stage entries in a separate directory, since shard directory
+        # names may collide with the names of entries.
+        staging = fs.path(self.path, ".reshard")
+        fs.mkdir(staging)
+        for path in list(self._entries()):
+            fs.mv(path, fs.path(staging, fs.basename(path)))
+
+        # Remove the old shard directories.
+        for name in fs.ls(self.path):
+            if not name.startswith("."):
+                fs.rm(self.path, name)
+        self.shard_depth = shard_depth
+        self._lru = None
+
+        for name in fs.ls(staging):
+            path = fs.path(self.path, *(self._shards(name) + [name]))
+            fs.mkdir(fs.dirname(path))
+            fs.mv(fs.path(staging, name), path)
+        fs.rm(staging)
+
+    def _objpath(self, digest):
+        return fs.path(self.path, ".objects", digest[:2], digest)
+
+    def _stage_dedup(self, src, staged):
+        """
+        Stage a file, hardlinking to an existing copy if there is one.
+        """
+        obj = self._objpath(crypto.sha1_file(src))
+        try:
+            os.link(obj, staged)
+            fs.rm(src)
+            return
+        except OSError:
+            # No existing copy.
+            pass
+
+        fs.mv(src, staged)
+        fs.mkdir(fs.dirname(obj))
+        try:
+            os.link(staged, obj)
+        except OSError:
+            # Another writer stored the same contents first.
+            pass
+
+    def _insert_atomic(self, src, dst):
+        staging = tempfile.mkdtemp(prefix=".staging-", dir=self.path)
+        try:
+            staged = fs.path(staging, "entry")
+            if self.dedup and fs.isfile(src):
+                self._stage_dedup(src, staged)
+            else:
+                fs.mv(src, staged)
+
+            try:
+                _replace(staged, dst)
+            except OSError:
+                # A non-empty directory cannot be replaced by a rename,
+                # so move it out of the way first.
+                if not fs.isdir(dst):
+                    raise
+                _replace(dst, fs.path(staging, "old"))
+                _replace(staged, dst)
+        finally:
+            fs.rm(staging)
+
+    def _compress(self, src):
+        """
+        Compress a file into the cache directory, removing the source.
+
+        Returns:
+            str: Path to the compressed file.
+        """
+        fs.mkdir(self.path)
+        fd, tmp = tempfile.mkstemp(prefix=".compress-", dir=self.path)
+        os.close(fd)
+        try:
+            with open(src, "rb") as infile, open(tmp, "wb") as raw:
+                raw.write(_FSCACHE_COMPRESSED +
+                          self.compression.name.encode("ascii") + b"\n")
+                with self.compression.open(raw, "wb") as outfile:
+                    shutil.copyfileobj(infile, outfile)
+        except:
+            fs.rm(tmp)
+            raise
+        fs.rm(src)
+        return tmp
+
+    def _unlink(self, path):
+        """
+        Remove an entry, and its deduplicated copy if no longer used.
+        """
+        obj = None
+        if self.dedup and fs.isfile(path) and os.stat(path).st_nlink == 2:
+            obj = self._objpath(crypto.sha1_file(path))
+        fs.rm(path)
+        if obj and fs.exists(obj) and os.stat(obj).st_nlink == 1:
+            fs.rm(obj)
+
+    def __getitem__(self, key):
+        """
+        Get path to file in cache.
+
+        Arguments:
+            key: Key.
+
+        Returns:
+            str: Path to cache value.
+
+        Raises:
+            KeyErorr: If key not in cache.
         """
         path = self.keypath(key)
         if fs.exists(path):
+            self._touch(fs.abspath(path))
             return path
         else:
             raise KeyError(key)
 
+    def open(self, key):
+        """
+        Open a cached file for reading, decompressing it if needed.
+
+        Arguments:
+            key: Key.
+
+        Returns:
+            file: Binary file object. Files compressed by the cache are
+              decompressed as they are read.
+
+        Raises:
+            KeyError: If key not in cache.
+            IOError: If the entry is a directory.
+        """
+        infile = open(self[key], "rb")
+        if infile.read(len(_FSCACHE_COMPRESSED)) != _FSCACHE_COMPRESSED:
+            infile.seek(0)
+            return infile
+        name = infile.readline().rstrip(b"\n").decode("ascii")
+        return _compressor(name).open(infile, "rb")
+
     def __setitem__(self, key, value):
         """
         Emplace file in cache.
@@ -301,12 +2353,40 @@ class FSCache(Cache):
         Raises:
             ValueError: If no "value" does nto exist.
         """
+        self._insert(key, value)
+        self.gc()
+
+    def _insert(self, key, value):
+        """
+        Insert an entry, without garbage collecting.
+
+        Returns:
+            str: Path to the entry.
+        """
         if not fs.exists(value):
             raise ValueError(value)
 
+        if (self.compression and fs.isfile(value) and
+                os.path.getsize(value) >= self.compress_threshold):
+            value = self._compress(value)
+
         path = self.keypath(key)
-        fs.mkdir(self.path)
-        fs.mv(value, path)
+        exists = fs.exists(path)
+        fs.mkdir(fs.dirname(path))
+        if self.atomic:
+            self._insert_atomic(value, path)
+        else:
+            fs.mv(value, path)
+        if self._count is not None and not exists:
+            self._count += 1
+
+        if self._lru is not None or self._budgeted():
+            lru = self._index()
+            path = fs.abspath(path)
+            self._nbytes -= lru.pop(path, 0)
+            lru[path] = _du(path)
+            self._nbytes += lru[path]
+        return path
 
     def __contains__(self, key):
         """
@@ -333,7 +2413,11 @@ class FSCache(Cache):
         """
         path = self.keypath(key)
         if fs.exists(path):
-            fs.rm(path)
+            self._unlink(path)
+            if self._count is not None:
+                self._count -= 1
+            if self._lru is not None:
+                self._nbytes -= self._lru.pop(fs.abspath(path), 0)
         else:
             raise KeyError(key)
 
@@ -344,17 +2428,65 @@ class FSCache(Cache):
         Returns:
             iterable: Paths in cache.
         """
-        for path in fs.ls(self.path, abspaths=True):
-            yield path
+        return self._entries()
 
     def __len__(self):
         """
         Get the number of entries in the cache.
 
+        The cache is counted on first call. After that, the count is
+        maintained on insertion and deletion, so modifications made
+        through other instances are not reflected.
+
         Returns:
             int: Number of entries in the cache.
         """
-        return len(list(fs.ls(self.path)))
+        if self._count is None:
+            self._count = sum(1 for _ in self._entries())
+        return self._count
+
+    def set_many(self, items):
+        """
+        Emplace multiple files in cache.
+
+        The cache is garbage collected once, after all files have been
+        inserted. The directories containing new entries are then
+        synced to disk.
+
+        Arguments:
+            items (dict or iterable of (key, value) tuples): Keys and
+              paths of files to insert in cache.
+
+        Raises:
+            ValueError: If a "value" does not exist.
+        """
+        dirs = set()
+        try:
+            for key, value in _pairs(items):
+                dirs.add(fs.dirname(self._insert(key, value)))
+        finally:
+            self.gc()
+            for path in dirs:
+                _fsync_dir(path)
+
+    def delete_many(self, keys):
+        """
+        Delete multiple cached files.
+
+        The directories containing the deleted entries are synced to
+        disk once, after all files have been deleted.
+        """
+        dirs = set()
+        removed = 0
+        for key in keys:
+            if key in self:
+                path = self.keypath(key)
+                del self[key]
+                dirs.add(fs.dirname(path))
+                removed += 1
+        for path in dirs:
+            _fsync_dir(path)
+        return removed
 
     def get(self, key, default=None):
         """
@@ -377,9 +2509,1011 @@ class FSCache(Cache):
         List files in cache.
 
         Arguments:
-            **kwargs: Keyword options to pass to fs.ls().
+            **kwargs: Keyword options to pass to fs.ls(). For a sharded
+              cache, only "abspaths" is supported.
 
         Returns:
             iterable: List of files.
         """
-        return fs.ls(self.path, **kwargs)
+        if not self.shard_depth:
+            paths = fs.ls(self.path, **kwargs)
+            if kwargs.get("abspaths"):
+                prefix = len(fs.abspath(self.path)) + 1
+            else:
+                prefix = 0
+            return [path for path in paths if path[prefix] != "."]
+
+        paths = sorted(self._entries(), key=fs.basename)
+        if kwargs.get("abspaths"):
+            return paths
+        return [fs.basename(path) for path in paths]
+
+
+class SharedMemoryCache(Cache):
+    """
+    A cache shared between processes on the same host.
+
+    Entries are stored in an open-addressing hash table in a
+    memory-mapped file, in /dev/shm where available, so that any
+    process opening a cache with the same name sees the same entries.
+    Values are pickled directly into shared memory, with no server
+    process. Access is serialized by a lock on the file, which is
+    shared for reads and exclusive for writes.
+
+    The table has a fixed capacity, set when the cache is first
+    created. Entries are appended to a data region, and the space of
+    deleted and replaced entries is reclaimed by compacting the region
+    when it fills. If the cache is still full, it is emptied.
+
+    A cache may be passed to worker processes, which reopen it by
+    name. Requires POSIX file locking, so is not available on Windows.
+
+    Keys must be composed of strings, numbers, None, booleans, tuples,
+    lists, and dicts, as for fast_hash_key(). Values must be picklable.
+
+    Members:
+        name (str): Name of the cache.
+        path (str): Path of the shared memory file.
+        capacity (int): Maximum number of entries.
+        nbytes (int): Size of the data region in bytes.
+    """
+
+    _MAGIC = b"LABM8SHM"
+    # Magic number, number of slots, number of entries, number of used
+    # slots (entries and deleted slots), and end of data.
+    _HEADER = struct.Struct("<8sIIIQ")
+    # Key hash, data offset, key length, and value length.
+    _SLOT = struct.Struct("<QQII")
+    # Hashes of empty and deleted slots.
+    _EMPTY = 0
+    _DELETED = 1
+    # Maximum fraction of used slots.
+    _LOAD_FACTOR = .75
+
+    def __init__(self, name, max_entries=65536, nbytes=64 * 1024 * 1024,
+                 path=None):
+        """
+        Open a shared cache, creating it if it does not exist.
+
+        Arguments:
+            name (str): Name of the cache.
+            max_entries (int, optional): Maximum number of entries, if
+              creating the cache.
+            nbytes (int, optional): Size of the data region in bytes, if
+              creating the cache. Memory is only allocated as it is
+              used.
+            path (str, optional): Path of the shared memory file, if not
+              named after the cache.
+
+        Raises:
+            ValueError: If the file is not a shared cache.
+        """
+        import fcntl
+
+        self._fcntl = fcntl
+        self.name = name
+        if path is None:
+            root = "/dev/shm" if fs.isdir("/dev/shm") else tempfile.gettempdir()
+            path = fs.path(root, "labm8-cache-" + escape_path(name))
+        self.path = path
+
+        self._open(max_entries, nbytes)
+
+    def _open(self, max_entries=65536, nbytes=64 * 1024 * 1024):
+        fcntl = self._fcntl
+        self._pid = os.getpid()
+        self._thread_lock = threading.Lock()
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if not os.fstat(self._fd).st_size:
+                nslots = int(max_entries / self._LOAD_FACTOR) + 1
+                heap = self._HEADER.size + nslots * self._SLOT.size
+                os.ftruncate(self._fd, heap + nbytes)
+                self._mm = mmap.mmap(self._fd, 0)
+                self._HEADER.pack_into(self._mm, 0, self._MAGIC, nslots,
+                                       0, 0, heap)
+            else:
+                self._mm = mmap.mmap(self._fd, 0)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+        magic, self._nslots = self._HEADER.unpack_from(self._mm, 0)[:2]
+        if magic != self._MAGIC:
+            self.close()
+            raise ValueError("'{0}' is not a shared cache".format(self.path))
+        self._heap = self._HEADER.size + self._nslots * self._SLOT.size
+        self.capacity = int(self._nslots * self._LOAD_FACTOR)
+        self.nbytes = len(self._mm) - self._heap
+
+    def __getstate__(self):
+        return {"name": self.name, "path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["name"], path=state["path"])
+
+    def close(self):
+        """
+        Close this process's mapping of the cache.
+        """
+        if self._fd is not None:
+            self._mm.close()
+            os.close(self._fd)
+            self._fd = None
+
+    def unlink(self):
+        """
+        Remove the shared cache.
+
+        Processes which have the cache open may continue to use it.
+        """
+        fs.rm(self.path, glob=False)
+
+    def _lock(self, exclusive=False):
+        if self._pid != os.getpid():
+            # A forked child shares the parent's file description, and
+            # so its lock. Reopen the file to get a lock of its own.
+            os.close(self._fd)
+            self._open()
+        self._thread_lock.acquire()
+        self._fcntl.flock(self._fd, self._fcntl.LOCK_EX if exclusive
+                          else self._fcntl.LOCK_SH)
+
+    def _unlock(self):
+        self._fcntl.flock(self._fd, self._fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+    @staticmethod
+    def _encode(key):
+        out = []
+        _encode_key(key, out)
+        encoded = b"".join(out)
+        h = struct.unpack("<Q", hashlib.sha1(encoded).digest()[:8])[0]
+        # Reserve the hashes of empty and deleted slots.
+        return encoded, max(h, SharedMemoryCache._DELETED + 1)
+
+    def _slot(self, i):
+        return self._HEADER.size + i * self._SLOT.size
+
+    def _probe(self, encoded, h):
+        """
+        Find the slot of a key.
+
+        Returns:
+            (int, bool): The slot index, and whether the key was found.
+              If not found, the index of a free slot, or None.
+        """
+        mm = self._mm
+        free = None
+        i = h % self._nslots
+        for _ in range(self._nslots):
+            slot_h, offset, keylen, _ = self._SLOT.unpack_from(
+                mm, self._slot(i))
+            if slot_h == self._EMPTY:
+                return (i if free is None else free), False
+            elif slot_h == self._DELETED:
+                if free is None:
+                    free = i
+            elif slot_h == h and mm[offset:offset + keylen] == encoded:
+                return i, True
+            i = (i + 1) % self._nslots
+        return free, False
+
+    def _entries(self):
+        """
+        Iterate over the (key length, entry data) of live slots.
+        """
+        mm = self._mm
+        for i in range(self._nslots):
+            slot_h, offset, keylen, datalen = self._SLOT.unpack_from(
+                mm, self._slot(i))
+            if slot_h > self._DELETED:
+                yield slot_h, keylen, mm[offset:offset + keylen + datalen]
+
+    def _reset(self, entries=()):
+        """
+        Empty the table, then insert entries.
+        """
+        mm = self._mm
+        mm[self._HEADER.size:self._heap] = b"\0" * (self._heap -
+                                                    self._HEADER.size)
+        end = self._heap
+        for h, keylen, data in entries:
+            i, _ = self._probe(data[:keylen], h)
+            mm[end:end + len(data)] = data
+            self._SLOT.pack_into(mm, self._slot(i), h, end, keylen,
+                                 len(data) - keylen)
+            end += len(data)
+        self._HEADER.pack_into(mm, 0, self._MAGIC, self._nslots,
+                               len(entries), len(entries), end)
+
+    def _get(self, encoded, h):
+        """
+        Return the pickled value of a key, or None.
+        """
+        self._lock()
+        try:
+            i, found = self._probe(encoded, h)
+            if not found:
+                return None
+            _, offset, keylen, datalen = self._SLOT.unpack_from(
+                self._mm, self._slot(i))
+            offset += keylen
+            return self._mm[offset:offset + datalen]
+        finally:
+            self._unlock()
+
+    def _set(self, encoded, h, data):
+        mm = self._mm
+        size = len(encoded) + len(data)
+        if size > self.nbytes:
+            raise ValueError("Cache entry of {0} bytes exceeds the size of "
+                             "shared cache '{1}'".format(size, self.name))
+
+        _, _, count, used, end = self._HEADER.unpack_from(mm, 0)
+        i, found = self._probe(encoded, h)
+        if not found and (used >= self.capacity or i is None):
+            # Reclaim deleted slots.
+            self._reset(list(self._entries()))
+            _, _, count, used, end = self._HEADER.unpack_from(mm, 0)
+            i, found = self._probe(encoded, h)
+            if used >= self.capacity:
+                io.debug("Emptying full shared cache '{0}'".format(self.name))
+                self._reset()
+                _, _, count, used, end = self._HEADER.unpack_from(mm, 0)
+                i, found = self._probe(encoded, h)
+
+        if end + size > len(mm):
+            # Reclaim space, keeping a replaced entry in place until the
+            # new value is written.
+            self._reset(list(self._entries()))
+            _, _, count, used, end = self._HEADER.unpack_from(mm, 0)
+            i, found = self._probe(encoded, h)
+            if end + size > len(mm):
+                io.debug("Emptying full shared cache '{0}'".format(self.name))
+                self._reset()
+                _, _, count, used, end = self._HEADER.unpack_from(mm, 0)
+                i, found = self._probe(encoded, h)
+
+        mm[end:end + size] = encoded + data
+        if not found:
+            slot_h = self._SLOT.unpack_from(mm, self._slot(i))[0]
+            count += 1
+            if slot_h == self._EMPTY:
+                used += 1
+        self._SLOT.pack_into(mm, self._slot(i), h, end, len(encoded),
+                             len(data))
+        self._HEADER.pack_into(mm, 0, self._MAGIC, self._nslots, count, used,
+                               end + size)
+
+    def _delete(self, encoded, h):
+        """
+        Remove a key. Returns whether the key was found.
+        """
+        i, found = self._probe(encoded, h)
+        if found:
+            header = list(self._HEADER.unpack_from(self._mm, 0))
+            header[2] -= 1
+            self._SLOT.pack_into(self._mm, self._slot(i), self._DELETED,
+                                 0, 0, 0)
+            self._HEADER.pack_into(self._mm, 0, *header)
+        return found
+
+    def get(self, key, default=None):
+        data = self._get(*self._encode(key))
+        if data is None:
+            return default
+        return pickle.loads(data)[1]
+
+    def clear(self):
+        self._lock(exclusive=True)
+        try:
+            self._reset()
+        finally:
+            self._unlock()
+
+    def items(self):
+        self._lock()
+        try:
+            entries = [data[keylen:] for _, keylen, data in self._entries()]
+        finally:
+            self._unlock()
+        for data in entries:
+            yield pickle.loads(data)
+
+    def __getitem__(self, key):
+        data = self._get(*self._encode(key))
+        if data is None:
+            raise KeyError(key)
+        return pickle.loads(data)[1]
+
+    def __setitem__(self, key, value):
+        encoded, h = self._encode(key)
+        data = pickle.dumps((key, value), pickle.HIGHEST_PROTOCOL)
+        self._lock(exclusive=True)
+        try:
+            self._set(encoded, h, data)
+        finally:
+            self._unlock()
+        return value
+
+    def get_many(self, keys, default=None):
+        encoded = [self._encode(key) for key in keys]
+        self._lock()
+        try:
+            values = []
+            for key, h in encoded:
+                i, found = self._probe(key, h)
+                if found:
+                    _, offset, keylen, datalen = self._SLOT.unpack_from(
+                        self._mm, self._slot(i))
+                    offset += keylen
+                    values.append(self._mm[offset:offset + datalen])
+                else:
+                    values.append(None)
+        finally:
+            self._unlock()
+        return [default if data is None else pickle.loads(data)[1]
+                for data in values]
+
+    def set_many(self, items):
+        """
+        Set multiple (key, value) pairs, holding the lock once.
+        """
+        entries = [self._encode(key) + (
+            pickle.dumps((key, value), pickle.HIGHEST_PROTOCOL),)
+                   for key, value in _pairs(items)]
+        self._lock(exclusive=True)
+        try:
+            for encoded, h, data in entries:
+                self._set(encoded, h, data)
+        finally:
+            self._unlock()
+
+    def delete_many(self, keys):
+        """
+        Remove multiple keys, holding the lock once.
+        """
+        encoded = [self._encode(key) for key in keys]
+        self._lock(exclusive=True)
+        try:
+            return sum(1 for key, h in encoded if self._delete(key, h))
+        finally:
+            self._unlock()
+
+    def __contains__(self, key):
+        encoded, h = self._encode(key)
+        self._lock()
+        try:
+            return self._probe(encoded, h)[1]
+        finally:
+            self._unlock()
+
+    def __delitem__(self, key):
+        encoded, h = self._encode(key)
+        self._lock(exclusive=True)
+        try:
+            found = self._delete(encoded, h)
+        finally:
+            self._unlock()
+        if not found:
+            raise KeyError(key)
+
+    def __iter__(self):
+        """
+        Iterate over all cache entries.
+
+        Returns:
+            iterable: Entries in cache.
+        """
+        for _, value in self.items():
+            yield value
+
+    def __len__(self):
+        """
+        Get the number of cache entries.
+
+        Returns:
+            int: Number of entries in the cache.
+        """
+        return self._HEADER.unpack_from(self._mm, 0)[2]
+
+
+class TieredCache(Cache):
+    """
+    A bounded in-memory cache in front of a persistent cache.
+
+    Reads are served from memory where possible. Entries read from the
+    persistent cache are promoted into memory. Writes either go straight
+    through to the persistent cache, or are buffered and written back in
+    batches.
+
+    Values held in memory are those stored by the persistent cache,
+    which may differ from the values set, e.g. the path of a file moved
+    into an FSCache. Buffered writes are served as set until they are
+    written back, after which the stored value is read on next use.
+
+    Members:
+        front (BoundedCache): In-memory cache.
+        backend (Cache): Persistent cache.
+        write_back (bool): Whether writes are buffered.
+        flush_every (int): Number of buffered writes per flush.
+    """
+
+    def __init__(self, backend, max_entries=1024, max_bytes=None,
+                 policy="lru", write_back=False, flush_every=1000):
+        """
+        Create a new tiered cache.
+
+        Arguments:
+            backend (Cache): Persistent cache.
+            max_entries (int, optional): Maximum number of entries held
+              in memory.
+            max_bytes (int, optional): Maximum size of entries held in
+              memory.
+            policy (str or EvictionPolicy, optional): Eviction policy for
+              the in-memory cache. See BoundedCache.
+            write_back (bool, optional): If true, buffer writes and
+              write them to the persistent cache in batches. Else, write
+              through on every modification.
+            flush_every (int, optional): Number of buffered writes at
+              which to flush to the persistent cache.
+        """
+        self.front = BoundedCache(max_entries=max_entries,
+                                  max_bytes=max_bytes, policy=policy)
+        self.backend = backend
+        self.write_back = write_back
+        self.flush_every = flush_every
+
+        # Buffered writes and deletes, if write_back.
+        self._dirty = {}
+        self._deleted = set()
+
+        if write_back:
+            # Register exit handler
+            atexit.register(self.flush)
+
+    def _buffered(self):
+        if len(self._dirty) + len(self._deleted) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """
+        Write buffered modifications to the persistent cache.
+        """
+        if self._deleted:
+            self.backend.delete_many(self._deleted)
+        if self._dirty:
+            self.backend.set_many(self._dirty)
+        self._deleted.clear()
+        self._dirty.clear()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def clear(self):
+        self.front.clear()
+        self._dirty.clear()
+        self._deleted.clear()
+        self.backend.clear()
+
+    def items(self):
+        self.flush()
+        return self.backend.items()
+
+    def __getitem__(self, key):
+        if key in self._dirty:
+            return self._dirty[key]
+        if key in self._deleted:
+            raise KeyError(key)
+        try:
+            return self.front[key]
+        except KeyError:
+            value = self.backend[key]
+            self.front[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        if self.write_back:
+            if key in self.front:
+                del self.front[key]
+            self._deleted.discard(key)
+            self._dirty[key] = value
+            self._buffered()
+        else:
+            self.backend[key] = value
+            self.front[key] = self.backend.get(key, value)
+        return value
+
+    def __contains__(self, key):
+        if key in self._dirty:
+            return True
+        if key in self._deleted:
+            return False
+        return key in self.front or key in self.backend
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self.front:
+            del self.front[key]
+        if self.write_back:
+            self._dirty.pop(key, None)
+            self._deleted.add(key)
+            self._buffered()
+        else:
+            del self.backend[key]
+
+    def get_many(self, keys, default=None):
+        """
+        Retrieve multiple items from cache.
+
+        Items not held in memory are fetched from the persistent cache
+        in a single batch.
+        """
+        keys = list(keys)
+        values = []
+        missing = []
+        for i, key in enumerate(keys):
+            if key in self._dirty:
+                values.append(self._dirty[key])
+            elif key in self._deleted:
+                values.append(default)
+            else:
+                value = self.front.get(key, _MISSING)
+                if value is _MISSING:
+                    missing.append(i)
+                values.append(value)
+
+        if missing:
+            fetched = self.backend.get_many([keys[i] for i in missing],
+                                            _MISSING)
+            for i, value in zip(missing, fetched):
+                if value is _MISSING:
+                    values[i] = default
+                else:
+                    self.front[keys[i]] = value
+                    values[i] = value
+        return values
+
+    def set_many(self, items):
+        items = list(_pairs(items))
+        if self.write_back:
+            for key, value in items:
+                if key in self.front:
+                    del self.front[key]
+                self._deleted.discard(key)
+                self._dirty[key] = value
+            self._buffered()
+        else:
+            self.backend.set_many(items)
+            keys = [key for key, _ in items]
+            for key, value in zip(keys, self.backend.get_many(keys,
+                                                              _MISSING)):
+                if value is not _MISSING:
+                    self.front[key] = value
+
+    def delete_many(self, keys):
+        keys = [key for key in keys if key in self]
+        for key in keys:
+            if key in self.front:
+                del self.front[key]
+        if self.write_back:
+            for key in keys:
+                self._dirty.pop(key, None)
+                self._deleted.add(key)
+            self._buffered()
+        else:
+            self.backend.delete_many(keys)
+        return len(keys)
+
+    def __iter__(self):
+        self.flush()
+        return iter(self.backend)
+
+    def __len__(self):
+        self.flush()
+        return len(self.backend)
+
+
+class Histogram(object):
+    """
+    A histogram of latencies, in power of two buckets of microseconds.
+
+    Members:
+        count (int): Number of samples.
+        total (float): Sum of samples, in seconds.
+        max (float): Largest sample, in seconds.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._buckets = {}
+
+    def add(self, seconds):
+        """
+        Record a sample.
+
+        Arguments:
+            seconds (float): Latency.
+        """
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        bucket = int(seconds * 1e6).bit_length()
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+
+    def percentile(self, p):
+        """
+        Return an upper bound on the p-th percentile.
+
+        Arguments:
+            p (float): Percentile, in the range [0,100].
+
+        Returns:
+            float: Latency in seconds, or 0 if there are no samples.
+        """
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for bucket in sorted(self._buckets):
+            seen += self._buckets[bucket]
+            if seen >= rank:
+                return min((2 ** bucket) / 1e6, self.max)
+        return self.max
+
+    def to_dict(self):
+        """
+        Returns:
+            dict: Summary statistics, and a map of bucket upper bounds
+              in seconds to counts.
+        """
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "buckets": dict(((2 ** bucket) / 1e6, count) for bucket, count
+                            in six.iteritems(self._buckets)),
+        }
+
+
+class StatsCache(Cache):
+    """
+    A cache which records usage statistics of another cache.
+
+    Wraps any cache, recording hits, misses, sets, deletes, and the
+    latency of lookups and sets. Evictions and bytes stored are
+    reported for caches which track them. Any other attributes are
+    those of the wrapped cache.
+
+    Bulk operations are counted once per key, but their latency is not
+    recorded.
+
+    Example:
+
+        >>> c = StatsCache(FSCache("/tmp/cache"), name="artifacts")
+        >>> c.stats()["hit_rate"]
+        0
+
+    Members:
+        cache (Cache): Wrapped cache.
+        name (str): Name to report statistics under.
+        hits (int): Number of lookups which found an entry.
+        misses (int): Number of lookups which did not find an entry.
+        sets (int): Number of entries set.
+        deletes (int): Number of entries deleted.
+        get_latency (Histogram): Lookup latencies.
+        set_latency (Histogram): Set latencies.
+    """
+
+    def __init__(self, cache, name=None):
+        """
+        Arguments:
+            cache (Cache): Cache to wrap.
+            name (str, optional): Name to report statistics under.
+              Defaults to the class name of the wrapped cache.
+        """
+        self.cache = cache
+        self.name = name or type(cache).__name__
+        self.reset()
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on this object.
+        if name == "cache":
+            raise AttributeError(name)
+        return getattr(self.cache, name)
+
+    def reset(self):
+        """
+        Reset all statistics.
+        """
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.deletes = 0
+        self.get_latency = Histogram()
+        self.set_latency = Histogram()
+
+    def stats(self):
+        """
+        Return cache statistics.
+
+        Returns:
+            dict: Statistics. "evictions" and "nbytes" are None if the
+              wrapped cache does not track them.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0,
+            "sets": self.sets,
+            "deletes": self.deletes,
+            "evictions": getattr(self.cache, "evictions", None),
+            "nbytes": getattr(self.cache, "nbytes", None),
+            "get_latency": self.get_latency.to_dict(),
+            "set_latency": self.set_latency.to_dict(),
+        }
+
+    def report(self, file=sys.stderr):
+        """
+        Print cache statistics, if profiling is enabled.
+
+        See labm8.prof.
+
+        Returns:
+            bool: Whether or not profiling is enabled.
+        """
+        if prof.is_enabled():
+            stats = self.stats()
+            io.prof("cache {name}: {hits} hits, {misses} misses "
+                    "({rate:.1%}), {sets} sets, {deletes} deletes, "
+                    "{evictions} evictions, get p95 {get:.3f} ms, "
+                    "set p95 {set:.3f} ms".format(
+                        rate=stats["hit_rate"],
+                        get=stats["get_latency"]["p95"] * 1000,
+                        set=stats["set_latency"]["p95"] * 1000,
+                        **stats), file=file)
+        return prof.is_enabled()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def clear(self):
+        self.cache.clear()
+
+    def items(self):
+        return self.cache.items()
+
+    def __getitem__(self, key):
+        start = time()
+        try:
+            value = self.cache[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        finally:
+            self.get_latency.add(time() - start)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        start = time()
+        self.cache[key] = value
+        self.set_latency.add(time() - start)
+        self.sets += 1
+        return value
+
+    def __contains__(self, key):
+        return key in self.cache
+
+    def __delitem__(self, key):
+        del self.cache[key]
+        self.deletes += 1
+
+    def get_many(self, keys, default=None):
+        values = self.cache.get_many(keys, _MISSING)
+        misses = sum(1 for value in values if value is _MISSING)
+        self.hits += len(values) - misses
+        self.misses += misses
+        return [default if value is _MISSING else value for value in values]
+
+    def set_many(self, items):
+        items = list(_pairs(items))
+        self.cache.set_many(items)
+        self.sets += len(items)
+
+    def delete_many(self, keys):
+        removed = self.cache.delete_many(keys)
+        self.deletes += removed
+        return removed
+
+    def __iter__(self):
+        return iter(self.cache)
+
+    def __len__(self):
+        return len(self.cache)
+
+
+class Memoized(object):
+    """
+    A function whose results are stored in a cache.
+
+    Concurrent calls with the same arguments from multiple threads
+    compute the result only once; the other callers wait for it.
+
+    Methods may be memoized. The instance is part of the key, so its
+    class must define a cache_key() method returning a value which
+    identifies the state the result depends on. See fast_hash_key().
+
+    Members:
+        fn (fn): The wrapped function.
+        backend (Cache): Cache storing results.
+        hits (int): Number of calls served from the cache.
+        misses (int): Number of calls which computed a result.
+        waits (int): Number of calls which waited for another thread to
+          compute a result.
+        lookup_time (float): Total seconds spent in cache lookups.
+        compute_time (float): Total seconds spent computing results.
+    """
+
+    def __init__(self, fn, backend):
+        """
+        Arguments:
+            fn (fn): Function to memoize.
+            backend (Cache): Cache to store results in.
+        """
+        self.fn = fn
+        self.backend = backend
+        self.name = ".".join((fn.__module__,
+                              getattr(fn, "__qualname__", fn.__name__)))
+
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.lookup_time = 0.0
+        self.compute_time = 0.0
+
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+        functools.update_wrapper(self, fn)
+
+    def __get__(self, instance, owner):
+        # Bind to instances, so that memoized methods receive self.
+        if instance is None:
+            return self
+        return functools.partial(self, instance)
+
+    def key(self, *args, **kwargs):
+        """
+        Return the cache key for a set of arguments.
+
+        Arguments must be JSON serialisable.
+        """
+        return fast_hash_key([self.name, args, kwargs])
+
+    def _lookup(self, key):
+        start = time()
+        try:
+            return True, self.backend[key]
+        except KeyError:
+            return False, None
+        finally:
+            elapsed = time() - start
+            with self._lock:
+                self.lookup_time += elapsed
+
+    def __call__(self, *args, **kwargs):
+        key = self.key(*args, **kwargs)
+
+        while True:
+            found, value = self._lookup(key)
+            if found:
+                with self._lock:
+                    self.hits += 1
+                return value
+
+            with self._lock:
+                event = self._inflight.get(key)
+                owner = event is None
+                if owner:
+                    event = self._inflight[key] = threading.Event()
+                else:
+                    self.waits += 1
+
+            if owner:
+                break
+            # Once the owner has finished, the result is in the cache,
+            # unless the computation failed, in which case we retry.
+            event.wait()
+
+        try:
+            # The result may have been stored between our lookup and
+            # becoming the owner.
+            found, value = self._lookup(key)
+            if found:
+                with self._lock:
+                    self.hits += 1
+                return value
+
+            start = time()
+            value = self.fn(*args, **kwargs)
+            elapsed = time() - start
+            with self._lock:
+                self.misses += 1
+                self.compute_time += elapsed
+
+            self.backend[key] = value
+            # Return the cached value, so that hits and misses return
+            # the same thing, e.g. a path for an FSCache.
+            return self.backend.get(key, value)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            event.set()
+
+    def stats(self):
+        """
+        Return cache statistics.
+
+        Returns:
+            dict: Counters and mean latencies, in seconds.
+        """
+        with self._lock:
+            calls = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "waits": self.waits,
+                "hit_rate": self.hits / calls if calls else 0,
+                "lookup_time": self.lookup_time,
+                "compute_time": self.compute_time,
+                "mean_lookup_time":
+                    self.lookup_time / calls if calls else 0,
+                "mean_compute_time":
+                    self.compute_time / self.misses if self.misses else 0,
+            }
+
+
+def memoize(backend=None):
+    """
+    Decorator to store the results of a function in a cache.
+
+    Results are keyed by the function name and arguments, using
+    fast_hash_key(). Arguments must be JSON serialisable, or define a
+    cache_key() method. For methods, this includes the instance.
+
+    Example:
+
+        >>> @memoize(backend=JsonCache("results.json"))
+        ... def run(benchmark, size):
+        ...     return expensive(benchmark, size)
+        >>> run("foo", 1024)
+        >>> run.stats()["hits"]
+        0
+
+    Arguments:
+        backend (Cache, optional): Cache to store results in. If not
+          provided, results are stored in a TransientCache.
+
+    Returns:
+        fn: Decorator which returns a Memoized function.
+    """
+    def decorator(fn):
+        return Memoized(fn, TransientCache() if backend is None else backend)
+    return decorator
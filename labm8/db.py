@@ -18,13 +18,26 @@ Extended SQL database interface.
 """
 import atexit
 import csv
+import json
+import math
 import re
 import six
 import sqlite3 as sql
+import sys
+import threading
+import zlib
+
+from collections import deque
+from collections import OrderedDict
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+from time import sleep
+from time import time
 
 import labm8 as lab
 from labm8 import fs
 from labm8 import io
+from labm8 import prof
 
 if lab.is_python3():
     from io import StringIO
@@ -99,8 +112,453 @@ def where(*columns):
     return " AND ".join(["{}=?".format(column) for column in columns])
 
 
+def _batches(cursor, batch_size):
+    """
+    Iterate over lists of rows fetched from a cursor.
+    """
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            return
+        yield batch
+
+
+def _numpy_batches(names, batches):
+    import numpy as np
+
+    for batch in batches:
+        yield dict((name, np.array(column))
+                   for name, column in zip(names, zip(*batch)))
+
+
+def _arrow_batches(names, batches):
+    import pyarrow as pa
+
+    for batch in batches:
+        yield pa.RecordBatch.from_arrays(
+            [pa.array(column) for column in zip(*batch)], names=names)
+
+
+# Numeric CSV values, in the forms which SQLite converts to numbers.
+# Python's int() and float() also accept whitespace, underscores,
+# non-ASCII digits, and "nan" and "inf", which would corrupt data.
+_CSV_INTEGER = re.compile(r"[-+]?[0-9]+\Z")
+_CSV_REAL = re.compile(
+    r"[-+]?([0-9]+(\.[0-9]*)?|\.[0-9]+)([eE][-+]?[0-9]+)?\Z")
+
+
+def _is_int(value):
+    # Integers which overflow 64 bits are stored by SQLite as reals.
+    return (_CSV_INTEGER.match(value) is not None and
+            -2 ** 63 <= int(value) < 2 ** 63)
+
+
+def _is_float(value):
+    return _CSV_REAL.match(value) is not None
+
+
+def _infer_csv_type(values):
+    """
+    Return the narrowest column type of a sequence of CSV strings.
+    """
+    values = [value for value in values if value != ""]
+    if values and all(_is_int(value) for value in values):
+        return "integer"
+    if values and all(_is_float(value) for value in values):
+        return "real"
+    return "text"
+
+
+def _infer_json_type(values):
+    """
+    Return the narrowest column type of a sequence of JSON values.
+    """
+    types = set(type(value) for value in values if value is not None)
+    if types and types <= set([bool, int] + list(six.integer_types)):
+        return "integer"
+    if types and types <= set([bool, float] + list(six.integer_types)):
+        return "real"
+    return "text"
+
+
+def _parse_csv_value(value, decl):
+    """
+    Convert a CSV string to a value of the declared column type.
+
+    Empty strings are NULL. Values which cannot be converted are kept as
+    strings, which SQLite will store as text.
+    """
+    if value == "":
+        return None
+    if "int" in decl:
+        if _is_int(value):
+            return int(value)
+    elif "real" in decl or "floa" in decl or "doub" in decl:
+        if _is_float(value):
+            return float(value)
+    return value
+
+
+def _json_value(value):
+    """
+    Convert a JSON value to a value which SQLite can store.
+
+    Lists and objects are stored as JSON strings.
+    """
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True)
+    return value
+
+
+# Named sets of pragmas for tuning a database. See:
+#
+# https://www.sqlite.org/pragma.html
+#
+# Negative cache sizes are in KiB. The journal mode is a property of
+# the database file. All other pragmas are set per connection.
+PROFILES = {
+    # Every transaction survives a power loss.
+    "durable": (
+        ("journal_mode", "wal"),
+        ("synchronous", "full"),
+        ("mmap_size", 0),
+        ("cache_size", -2000),
+        ("temp_store", "default"),
+    ),
+    # Fast bulk loads. Transactions survive a crash of the process, but
+    # not a power loss.
+    "bulk-load": (
+        ("journal_mode", "wal"),
+        ("synchronous", "off"),
+        ("mmap_size", 256 * 1024 * 1024),
+        ("cache_size", -256 * 1024),
+        ("temp_store", "memory"),
+    ),
+    # Fast reads from a memory-mapped database.
+    "read-mostly": (
+        ("journal_mode", "wal"),
+        ("synchronous", "normal"),
+        ("mmap_size", 1024 * 1024 * 1024),
+        ("cache_size", -64 * 1024),
+        ("temp_store", "memory"),
+    ),
+}
+
+
+# Literal strings and numbers in SQL statements.
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")
+# Parenthesized lists of placeholders, e.g. "(?,?,?)".
+_PLACEHOLDERS = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+
+
+def normalize_statement(statement):
+    """
+    Normalize an SQL statement, for grouping similar statements.
+
+    Literals are replaced by placeholders, lists of placeholders are
+    collapsed, and whitespace and trailing semicolons are normalized.
+
+    Example:
+
+        >>> normalize_statement("SELECT * FROM foo WHERE id IN (1, 2, 3)")
+        "SELECT * FROM foo WHERE id IN (...)"
+
+    Arguments:
+
+        statement (str): An SQL statement.
+
+    Returns:
+
+        str: Normalized statement.
+    """
+    statement = _LITERAL.sub("?", statement)
+    statement = _PLACEHOLDERS.sub("(...)", statement)
+    return " ".join(statement.split()).rstrip(";")
+
+
+class QueryProfiler(object):
+    """
+    Query timing statistics for a database.
+
+    Statistics are recorded per normalized statement. The number of
+    statements tracked is bounded, by discarding the statistics of the
+    least recently executed statement. Latencies include the time to
+    fetch a statement's rows, and percentiles are computed over the
+    most recent executions of each statement.
+
+    Members:
+        max_statements (int): Maximum number of statements to track.
+    """
+
+    # Number of recent latencies kept per statement.
+    _SAMPLES = 1024
+
+    def __init__(self, max_statements=256):
+        self.max_statements = max_statements
+        self._stats = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def clear(self):
+        """
+        Discard all statistics.
+        """
+        with self._lock:
+            self._stats.clear()
+
+    def record(self, statement, elapsed, rows=0):
+        """
+        Record an execution of a statement.
+
+        Arguments:
+
+            statement (str): SQL statement.
+            elapsed (float): Latency in seconds, or None if unknown.
+            rows (int, optional): Number of rows returned or modified.
+        """
+        statement = normalize_statement(statement)
+        with self._lock:
+            stats = self._stats.pop(statement, None)
+            if stats is None:
+                stats = {"count": 0, "total": 0, "rows": 0,
+                         "latencies": deque(maxlen=self._SAMPLES)}
+                if len(self._stats) >= self.max_statements:
+                    self._stats.popitem(last=False)
+            self._stats[statement] = stats
+
+            stats["count"] += 1
+            stats["rows"] += rows
+            if elapsed is not None:
+                stats["total"] += elapsed
+                stats["latencies"].append(elapsed)
+
+    def trace(self, statement):
+        """
+        Trace callback, recording statements executed by SQLite which
+        were not timed, such as those of scripts.
+        """
+        if not getattr(self._local, "active", False):
+            self.record(statement, None)
+
+    def time(self, statement, fn, *args):
+        """
+        Call a function, recording its latency against a statement.
+        """
+        self._local.active = True
+        start = time()
+        try:
+            return fn(*args)
+        finally:
+            self._local.active = False
+            self.record(statement, time() - start)
+
+    def execute(self, statement, fn, *args):
+        """
+        Call a function which executes a statement and returns a cursor.
+
+        If the statement returns rows, the latency and number of rows
+        are recorded once they have been fetched, or the cursor is
+        discarded.
+        """
+        self._local.active = True
+        start = time()
+        try:
+            cursor = fn(*args)
+        finally:
+            self._local.active = False
+        elapsed = time() - start
+
+        if cursor.description is None:
+            self.record(statement, elapsed, max(cursor.rowcount, 0))
+            return cursor
+        return _ProfiledCursor(cursor, self, statement, elapsed)
+
+    def stats(self):
+        """
+        Return the statistics of all statements.
+
+        Returns:
+
+            list of dicts: One dict per statement, in descending order
+              of total latency. Each dict contains the keys
+              "statement", "count", "total", "p95", and "rows".
+              Latencies are in seconds.
+        """
+        with self._lock:
+            items = [(statement, dict(stats, latencies=list(
+                stats["latencies"]))) for statement, stats in
+                     six.iteritems(self._stats)]
+
+        results = []
+        for statement, stats in items:
+            latencies = sorted(stats["latencies"])
+            p95 = None
+            if latencies:
+                p95 = latencies[int(math.ceil(.95 * len(latencies))) - 1]
+            results.append({
+                "statement": statement,
+                "count": stats["count"],
+                "total": stats["total"],
+                "p95": p95,
+                "rows": stats["rows"],
+            })
+        return sorted(results, key=lambda x: x["total"], reverse=True)
+
+    def report(self, n=10, file=sys.stderr):
+        """
+        Print the statements with the highest total latency.
+
+        Arguments:
+
+            n (int, optional): Number of statements to print.
+            file (file, optional): File to print to.
+        """
+        io.prof("{0:>8} {1:>10} {2:>10} {3:>10}  statement"
+                .format("calls", "total ms", "p95 ms", "rows"), file=file)
+        for stats in self.stats()[:n]:
+            p95 = "-" if stats["p95"] is None else \
+                  "{0:.3f}".format(stats["p95"] * 1000)
+            io.prof("{0:>8} {1:>10.3f} {2:>10} {3:>10}  {4}"
+                    .format(stats["count"], stats["total"] * 1000, p95,
+                            stats["rows"], stats["statement"]), file=file)
+
+
+class _ProfiledCursor(object):
+    """
+    A cursor which records the latency and rows of its statement.
+    """
+
+    def __init__(self, cursor, profiler, statement, elapsed):
+        self._cursor = cursor
+        self._profiler = profiler
+        self._statement = statement
+        self._elapsed = elapsed
+        self._rows = 0
+        self._done = False
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _finish(self):
+        if not self._done:
+            self._done = True
+            self._profiler.record(self._statement, self._elapsed,
+                                  self._rows)
+
+    def _fetch(self, method, *args):
+        start = time()
+        try:
+            return getattr(self._cursor, method)(*args)
+        finally:
+            self._elapsed += time() - start
+
+    def fetchone(self):
+        row = self._fetch("fetchone")
+        if row is None:
+            self._finish()
+        else:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._fetch("fetchmany", size or self._cursor.arraysize)
+        self._rows += len(rows)
+        if not rows:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        rows = self._fetch("fetchall")
+        self._rows += len(rows)
+        self._finish()
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    next = __next__
+
+    def close(self):
+        self._finish()
+        self._cursor.close()
+
+    def __del__(self):
+        self._finish()
+
+
+# Shard files of a ShardedDatabase.
+_SHARD_FILE = re.compile(r"^(\d+)\.db$")
+
+# Table of the first shard which records the key column of each table.
+_SHARD_KEYS = "_shard_keys"
+
+# Default maximum number of attached databases of SQLite builds.
+_MAX_ATTACHED = 10
+
+
+def shard_index(key, num_shards):
+    """
+    Return the shard which a key is partitioned to.
+
+    Keys are hashed by their string value, using CRC32, so that the
+    partitioning is the same across processes and Python versions.
+
+    Arguments:
+
+        key: The key value.
+        num_shards (int): The number of shards.
+
+    Returns:
+
+        int: The index of the shard, in the range [0, num_shards).
+    """
+    if not isinstance(key, six.binary_type):
+        key = six.text_type(key).encode("utf-8")
+    return (zlib.crc32(key) & 0xffffffff) % num_shards
+
+
+# Statements which do not modify the database.
+_READ_STATEMENT = re.compile(r"^\s*(SELECT|EXPLAIN)\b", re.IGNORECASE)
+
+
 class Database(object):
-    def __init__(self, path, tables={}, enable_traces=True):
+    """
+    A SQLite database.
+
+    By default, a database has a single connection, which may only be
+    used by the thread that created it. In pooled mode, each thread
+    gets its own connection to the database, and the database uses
+    write-ahead logging so that readers run concurrently. Writes are
+    serialized: the first write of a transaction waits, for up to the
+    timeout, for any other thread's transaction to be committed.
+    Connections of threads which have exited are closed, rolling back
+    any transaction they left open.
+
+    A database may be tuned using one of the named pragma PROFILES,
+    either when opened, or at runtime using set_profile().
+
+    Query profiling may be enabled using enable_profiling(), to record
+    per-statement timing statistics in a QueryProfiler.
+
+    Table names and table info are cached. The cache is invalidated by
+    the DDL helpers, and whenever the schema version of the database
+    changes, so schema changes made by other means or by other
+    connections are also seen.
+
+    Members:
+        path (str): The path to the database file.
+        pooled (bool): Whether each thread has its own connection.
+        profile (str): Name of the pragma profile in use, or None.
+        profiler (QueryProfiler): Query profiler, or None.
+    """
+    def __init__(self, path, tables={}, enable_traces=True, pooled=False,
+                 timeout=5.0, profile=None, cached_statements=128):
         """
         Arguments:
             path (str): The path to the database file.
@@ -109,15 +567,48 @@ class Database(object):
               of the form: (name, type).
            enable_traces(bool, optional): Enable traces for user
              defined functions and aggregates.
+           pooled (bool, optional): Give each thread its own connection.
+           timeout (float, optional): Seconds to wait for a lock held by
+             another connection.
+           profile (str, optional): Name of a pragma profile to apply.
+           cached_statements (int, optional): Number of prepared
+             statements to cache per connection.
         """
         self.path = fs.path(path)
+        self.pooled = pooled
+        self.timeout = timeout
+        self.profile = None
+        self.profiler = None
+        self.enable_traces = enable_traces
+        self.cached_statements = cached_statements
 
         # Create directory if needed.
         parent_dir = fs.dirname(path)
         if parent_dir:
             fs.mkdir(parent_dir)
 
-        self.connection = sql.connect(self.path)
+        self._closed = False
+        self._local = threading.local()
+        # Map of threads to their connections. In pooled mode, the
+        # connection of a thread is closed once it has exited.
+        self._connections = {}
+        self._pool_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        # The thread holding the write lock, or None.
+        self._writer = None
+        # Incremented when the profile changes, so that each pooled
+        # connection applies the new profile on its next use.
+        self._profile_version = 0
+        # Cached table names and table info, for a schema version.
+        self._metadata_cache = {}
+
+        if pooled:
+            self.execute("PRAGMA journal_mode=WAL")
+        else:
+            self._connections[None] = self._connect()
+
+        if profile is not None:
+            self.set_profile(profile)
 
         for name,schema in six.iteritems(tables):
             self.create_table(name, schema)
@@ -139,6 +630,241 @@ class Database(object):
     def __str__(self):
         return self.__repr__()
 
+    @property
+    def connection(self):
+        """
+        The connection for the current thread.
+
+        Raises:
+
+            sql.ProgrammingError: If the database is closed.
+        """
+        if not self.pooled:
+            return self._connections[None]
+
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            with self._pool_lock:
+                if self._closed:
+                    raise sql.ProgrammingError(
+                        "Cannot operate on a closed database.")
+                self._close_dead()
+                connection = self._connect()
+                self._connections[threading.current_thread()] = connection
+            self._local.connection = connection
+            self._local.writing = False
+            self._local.profile_version = 0
+
+        if self._local.profile_version != self._profile_version:
+            self._local.profile_version = self._profile_version
+            self._apply_profile(connection, self.profile)
+        return connection
+
+    def _connect(self):
+        # Pooled connections may be closed from any thread.
+        connection = sql.connect(self.path, timeout=self.timeout,
+                                 cached_statements=self.cached_statements,
+                                 check_same_thread=not self.pooled)
+        if self.profiler is not None:
+            self._set_trace_callback(connection, self.profiler.trace)
+        return connection
+
+    def _set_trace_callback(self, connection, callback):
+        # Trace callbacks require Python 3.3.
+        if self.enable_traces and hasattr(connection, "set_trace_callback"):
+            connection.set_trace_callback(callback)
+
+    def enable_profiling(self, max_statements=256):
+        """
+        Record timing statistics of queries.
+
+        If traces are enabled, statements which SQLite executes without
+        going through execute(), such as those of scripts, are also
+        counted.
+
+        Example:
+
+            >>> db.enable_profiling()
+            >>> db.execute("SELECT * FROM foo").fetchall()
+            >>> db.profiler.report()
+
+        Arguments:
+
+            max_statements (int, optional): Maximum number of distinct
+              statements to record statistics for.
+
+        Returns:
+
+            QueryProfiler: The profiler.
+        """
+        self.profiler = QueryProfiler(max_statements=max_statements)
+        with self._pool_lock:
+            for connection in self._connections.values():
+                self._set_trace_callback(connection, self.profiler.trace)
+        return self.profiler
+
+    def disable_profiling(self):
+        """
+        Stop recording timing statistics of queries.
+
+        Returns:
+
+            QueryProfiler: The profiler, or None if not enabled.
+        """
+        profiler, self.profiler = self.profiler, None
+        with self._pool_lock:
+            for connection in self._connections.values():
+                self._set_trace_callback(connection, None)
+        return profiler
+
+    def _apply_profile(self, connection, profile):
+        for name, value in PROFILES[profile]:
+            if name != "journal_mode":
+                connection.execute("PRAGMA {name}={value}"
+                                   .format(name=name, value=value))
+
+    def set_profile(self, profile):
+        """
+        Apply a pragma profile.
+
+        Example:
+
+            >>> db.set_profile("bulk-load")
+            >>> db.executemany("INSERT INTO foo VALUES (?,?)", rows)
+            >>> db.commit()
+            >>> db.set_profile("durable")
+
+        Arguments:
+
+            profile (str): One of "durable", "bulk-load", or
+              "read-mostly".
+
+        Returns:
+
+            str: The name of the previous profile, or None.
+
+        Raises:
+
+            ValueError: If the profile is not recognised.
+            sql.OperationalError: If there is an open transaction, in
+              which the journal mode and synchronous pragmas cannot be
+              changed. The previous profile remains in use.
+        """
+        if profile not in PROFILES:
+            raise ValueError("Unknown pragma profile '{0}'".format(profile))
+
+        previous = self.profile
+        journal_mode = dict(PROFILES[profile])["journal_mode"]
+        self.execute("PRAGMA journal_mode=" + journal_mode)
+
+        # Apply the pragmas before recording the profile, so that if
+        # they cannot be changed, the previous profile is reported.
+        self._apply_profile(self.connection, profile)
+        self.profile = profile
+        self._profile_version += 1
+        if self.pooled:
+            # Other threads' connections apply the profile on next use.
+            self._local.profile_version = self._profile_version
+
+        io.debug("Applied '{0}' profile to '{1}'".format(profile, self.path))
+        return previous
+
+    def pragma(self, name):
+        """
+        Return the current value of a pragma.
+
+        Arguments:
+
+            name (str): Name of the pragma.
+
+        Returns:
+
+            The value of the pragma.
+        """
+        return self._read("PRAGMA " + name).fetchone()[0]
+
+    def _read(self, statement):
+        """
+        Run a statement which does not modify the database.
+
+        In pooled mode, execute() treats statements other than queries
+        as writes, and waits for the write lock. Statements which only
+        read the database, such as PRAGMAs which return a value, are
+        run without it.
+        """
+        if self.profiler is None:
+            return self.connection.execute(statement)
+        return self.profiler.execute(statement, self.connection.execute,
+                                     statement)
+
+    def _write(self, method, *args):
+        """
+        Run a statement which modifies the database, holding the write
+        lock until the transaction is committed.
+        """
+        connection = self.connection
+        if not self._local.writing:
+            self._acquire_write_lock()
+        try:
+            return getattr(connection.cursor(), method)(*args)
+        finally:
+            # Python 2 does not report whether there is an open
+            # transaction, so the lock is held until commit().
+            if not getattr(connection, "in_transaction", True):
+                self._release_write_lock()
+
+    def _acquire_write_lock(self):
+        """
+        Wait for the write lock.
+
+        Raises:
+
+            sql.OperationalError: If the lock is not acquired within the
+              timeout.
+        """
+        deadline = time() + self.timeout
+        while not self._write_lock.acquire(False):
+            writer = self._writer
+            if writer is not None and not writer.is_alive():
+                # The writer exited without committing.
+                with self._pool_lock:
+                    self._close_dead()
+                continue
+
+            remaining = deadline - time()
+            if remaining <= 0:
+                raise sql.OperationalError(
+                    "database is locked by another thread")
+            # Wait in short intervals, to notice if the writer exits.
+            # Locks of Python 2 cannot wait with a timeout.
+            if six.PY2:
+                sleep(min(remaining, .001))
+            elif self._write_lock.acquire(timeout=min(remaining, .1)):
+                break
+        self._writer = threading.current_thread()
+        self._local.writing = True
+
+    def _release_write_lock(self):
+        if getattr(self._local, "writing", False):
+            self._local.writing = False
+            self._writer = None
+            self._write_lock.release()
+
+    def _close_dead(self):
+        """
+        Close the connections of threads which have exited.
+
+        Must be called with the pool lock held.
+        """
+        for thread in list(self._connections):
+            if thread is None or thread.is_alive():
+                continue
+            # Closing a connection rolls back any open transaction.
+            self._connections.pop(thread).close()
+            if self._writer is thread:
+                self._writer = None
+                self._write_lock.release()
+
     @property
     def tables(self):
         """
@@ -153,12 +879,28 @@ class Database(object):
 
             list of str: One string for each table name.
         """
-        select = ("SELECT name FROM sqlite_master",)
-        query = self.execute(*select)
-        result = query.fetchall()
+        return list(self._tables(self._metadata()))
 
-        # Filter first column from rows.
-        return [row[0] for row in result]
+    def _metadata(self):
+        """
+        Return the metadata cache, emptying it if the schema changed.
+        """
+        version = self._read("PRAGMA schema_version").fetchone()[0]
+        cache = self._metadata_cache
+        if cache.get("version") != version:
+            cache = {"version": version, "info": {}}
+            self._metadata_cache = cache
+        return cache
+
+    def _tables(self, cache):
+        if "tables" not in cache:
+            query = self.execute("SELECT name FROM sqlite_master")
+            # Filter first column from rows.
+            cache["tables"] = [row[0] for row in query]
+        return cache["tables"]
+
+    def _invalidate_metadata(self):
+        self._metadata_cache = {}
 
     @property
     def schema(self):
@@ -224,12 +966,21 @@ class Database(object):
                 "primary_key": row[5] == 1
             }
 
-        if table not in self.tables:
-            raise sql.OperationalError("Cannot retrieve information about "
-                                       "missing table '{0}'".format(table))
+        cache = self._metadata()
+        info = cache["info"].get(table)
+        if info is None:
+            if table not in self._tables(cache):
+                raise sql.OperationalError(
+                    "Cannot retrieve information about missing table "
+                    "'{0}'".format(table))
+
+            query = self._read("PRAGMA table_info({table})"
+                               .format(table=table))
+            info = [_row2dict(row) for row in query]
+            cache["info"][table] = info
 
-        query = self.execute("PRAGMA table_info({table})".format(table=table))
-        return [_row2dict(row) for row in query]
+        # Copy, so that the cache cannot be modified.
+        return [dict(column) for column in info]
 
     def isempty(self, tables=None):
         """
@@ -287,8 +1038,14 @@ class Database(object):
     def close(self):
         """
         Close a database connection.
+
+        In pooled mode, this closes the connections of all threads.
         """
-        self.connection.close()
+        with self._pool_lock:
+            self._closed = True
+            for connection in self._connections.values():
+                connection.close()
+        self._release_write_lock()
 
     def drop_table(self, name):
         """
@@ -302,6 +1059,7 @@ class Database(object):
         """
         if name in self.tables:
             self.execute("DROP TABLE " + name)
+            self._invalidate_metadata()
 
     def create_table(self, name, schema):
         """
@@ -323,6 +1081,7 @@ class Database(object):
         columns = [" ".join(column) for column in schema]
         self.execute("CREATE TABLE IF NOT EXISTS {name} ({columns})"
                      .format(name=name, columns=",".join(columns)))
+        self._invalidate_metadata()
 
     def empty_table(self, name):
         """
@@ -368,6 +1127,7 @@ class Database(object):
 
         # Execute this new command.
         self.execute(new_cmd)
+        self._invalidate_metadata()
 
     def copy_table(self, src, dst):
         """
@@ -392,23 +1152,35 @@ class Database(object):
         # Commit changes.
         self.commit()
 
+    def _run(self, method, *args):
+        if self.pooled and (method != "execute" or
+                            not _READ_STATEMENT.match(args[0])):
+            return self._write(method, *args)
+        return getattr(self.connection.cursor(), method)(*args)
+
+    def _call(self, method, *args):
+        if self.profiler is None:
+            return self._run(method, *args)
+        return self.profiler.execute(args[0], self._run, method, *args)
+
     def execute(self, *args):
         """
         Execute the given arguments.
         """
-        return self.connection.cursor().execute(*args)
+        return self._call("execute", *args)
 
     def executemany(self, *args):
         """
         Execute the given arguments.
         """
-        return self.connection.cursor().executemany(*args)
+        return self._call("executemany", *args)
 
     def executescript(self, *args):
         """
         Execute the given arguments.
         """
-        return self.connection.cursor().executescript(*args)
+        # Statements of the script are recorded by the trace callback.
+        return self._run("executescript", *args)
 
     def commit(self):
         """
@@ -417,7 +1189,294 @@ class Database(object):
         Make sure to call this method after you've modified the
         database's state!
         """
-        return self.connection.commit()
+        try:
+            if self.profiler is not None:
+                return self.profiler.time("COMMIT", self.connection.commit)
+            return self.connection.commit()
+        finally:
+            self._release_write_lock()
+
+    def rollback(self):
+        """
+        Roll back the current transaction.
+        """
+        try:
+            return self.connection.rollback()
+        finally:
+            self._release_write_lock()
+
+    def insert_many(self, table, rows, chunk_size=10000, columns=None):
+        """
+        Insert rows into a table, in chunked transactions.
+
+        Rows are read lazily, so generators of any length may be
+        inserted. Each chunk of rows is inserted under its own
+        savepoint, so a failure rolls back only the failed chunk,
+        leaving all previous chunks inserted. Outside of a transaction,
+        each chunk is committed once inserted. Within a pending
+        transaction, chunks become part of it, and are committed or
+        rolled back along with it.
+
+        Example:
+
+            >>> db.insert_many("foo", ((i, str(i)) for i in range(10**6)))
+            1000000
+
+        Arguments:
+
+            table (str): The name of the table to insert into.
+            rows (iterable of sequences): Rows to insert.
+            chunk_size (int, optional): Number of rows per transaction.
+            columns (sequence of str, optional): Names of the columns
+              to insert into, if not all columns.
+
+        Returns:
+
+            int: The number of rows inserted.
+
+        Raises:
+
+            sql.Error: If a chunk fails to insert. The failed chunk is
+              rolled back.
+        """
+        rows = iter(rows)
+        columns = "({0})".format(",".join(columns)) if columns else ""
+
+        start = time()
+        count = 0
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            cmd = ("INSERT INTO {table}{columns} VALUES {values}"
+                   .format(table=table, columns=columns,
+                           values=placeholders(*chunk[0])))
+            # Releasing the outermost savepoint commits the chunk.
+            self.execute("SAVEPOINT insert_many")
+            try:
+                self.executemany(cmd, chunk)
+            except:
+                self.execute("ROLLBACK TO insert_many")
+                self.execute("RELEASE insert_many")
+                raise
+            self.execute("RELEASE insert_many")
+            count += len(chunk)
+
+        elapsed = time() - start
+        rate = count / elapsed if elapsed else 0
+        io.debug("Inserted {0} rows into '{1}' in {2:.3f} s ({3:.0f} rows/s)"
+                 .format(count, table, elapsed, rate))
+        if prof.is_enabled():
+            io.prof("insert {0}: {1} rows, {2:.0f} rows/s"
+                    .format(table, count, rate))
+        return count
+
+    def _bulk_insert(self, table, schema, chunks):
+        """
+        Insert chunks of rows into a table, creating it if needed.
+
+        All rows are inserted under a single savepoint, so a failure
+        rolls back only the import. Outside of a transaction, the rows
+        are committed once inserted, with the per-connection pragmas of
+        the "bulk-load" profile applied for the duration. Within a
+        pending transaction, the rows become part of it, and the
+        pragmas are left unchanged, as they cannot be changed within a
+        transaction.
+
+        Returns:
+
+            int: The number of rows inserted.
+        """
+        cmd = ("INSERT INTO {table} ({columns}) VALUES {values}"
+               .format(table=table,
+                       columns=",".join(name for name, _ in schema),
+                       values=placeholders(*schema)))
+
+        if getattr(self.connection, "in_transaction", False):
+            pragmas = []
+        else:
+            pragmas = [(name, value)
+                       for name, value in PROFILES["bulk-load"]
+                       if name != "journal_mode"]
+        saved = [(name, self.pragma(name)) for name, _ in pragmas]
+
+        start = time()
+        count = 0
+        try:
+            for name, value in pragmas:
+                self.connection.execute("PRAGMA {name}={value}"
+                                        .format(name=name, value=value))
+            # Releasing the outermost savepoint commits the rows.
+            self.execute("SAVEPOINT bulk_insert")
+            try:
+                self.create_table(table, schema)
+                for chunk in chunks:
+                    self.executemany(cmd, chunk)
+                    count += len(chunk)
+            except:
+                self.execute("ROLLBACK TO bulk_insert")
+                self.execute("RELEASE bulk_insert")
+                # The table may have been created and rolled back.
+                self._invalidate_metadata()
+                raise
+            self.execute("RELEASE bulk_insert")
+        finally:
+            for name, value in saved:
+                self.connection.execute("PRAGMA {name}={value}"
+                                        .format(name=name, value=value))
+
+        elapsed = time() - start
+        rate = count / elapsed if elapsed else 0
+        io.debug("Imported {0} rows into '{1}' in {2:.3f} s ({3:.0f} rows/s)"
+                 .format(count, table, elapsed, rate))
+        if prof.is_enabled():
+            io.prof("import {0}: {1} rows, {2:.0f} rows/s"
+                    .format(table, count, rate))
+        return count
+
+    def import_csv(self, table, path, schema=None, header=True,
+                   chunk_size=10000, **kwargs):
+        """
+        Import rows from a CSV file into a table.
+
+        If the table does not exist, it is created. If no schema is
+        given, column names are read from the header row, and column
+        types are inferred from the first chunk of rows as "integer",
+        "real", or "text". Empty fields are imported as NULL, and empty
+        lines are skipped.
+
+        The file is streamed in chunks, and all rows are inserted in a
+        single transaction. If any row fails to insert, no rows are
+        imported.
+
+        Example:
+
+            >>> db.import_csv("results", "results.csv")
+            20000000
+
+        Arguments:
+
+            table (str): The name of the table to import into.
+            path (str): Path of the CSV file.
+            schema (sequence of tuples, optional): A list of (name,
+              type) tuples for each of the columns in the file.
+            header (bool, optional): Whether the first row of the file
+              is a header row. Required if no schema is given.
+            chunk_size (int, optional): Number of rows per
+              executemany().
+            **kwargs: Additional format parameters passed to
+              csv.reader(), e.g. "delimiter".
+
+        Returns:
+
+            int: The number of rows imported.
+
+        Raises:
+
+            ValueError: If neither a schema nor header row is given, or
+              if a row does not have one field per column.
+            sql.Error: If the rows cannot be inserted.
+        """
+        if schema is None and not header:
+            raise ValueError("Cannot infer the schema of a CSV file "
+                             "without a header row")
+
+        # The csv module requires files to be opened without newline
+        # translation.
+        if lab.is_python3():
+            infile = open(path, newline="")
+        else:
+            infile = open(path, "rb")
+
+        with infile:
+            reader = csv.reader(infile, **kwargs)
+            names = next(reader, []) if header else None
+            width = len(names) if schema is None else len(schema)
+
+            def _check(row):
+                if len(row) != width:
+                    raise ValueError("Line {line} of '{path}' has {n} "
+                                     "fields, expected {width}".format(
+                                         line=reader.line_num, path=path,
+                                         n=len(row), width=width))
+                return row
+
+            if names is not None:
+                _check(names)
+            rows = (_check(row) for row in reader if row)
+
+            first = list(islice(rows, chunk_size))
+            if schema is None:
+                columns = list(zip(*first)) or [()] * len(names)
+                schema = [(name, _infer_csv_type(column))
+                          for name, column in zip(names, columns)]
+            types = [decl.lower() for _, decl in schema]
+
+            def _chunks():
+                chunk = first
+                while chunk:
+                    yield [tuple(_parse_csv_value(value, decl)
+                                 for value, decl in zip(row, types))
+                           for row in chunk]
+                    chunk = list(islice(rows, chunk_size))
+
+            return self._bulk_insert(table, schema, _chunks())
+
+    def import_jsonl(self, table, path, schema=None, chunk_size=10000):
+        """
+        Import rows from a JSON lines file into a table.
+
+        Each line of the file is a JSON object, with one member per
+        column. Missing members are imported as NULL, and lists and
+        objects as JSON strings. Blank lines are ignored.
+
+        If the table does not exist, it is created. If no schema is
+        given, column names and types are inferred from the first chunk
+        of rows. The file is streamed in chunks, and all rows are
+        inserted in a single transaction. If any row fails to insert,
+        no rows are imported.
+
+        Arguments:
+
+            table (str): The name of the table to import into.
+            path (str): Path of the JSON lines file.
+            schema (sequence of tuples, optional): A list of (name,
+              type) tuples for the columns to import.
+            chunk_size (int, optional): Number of rows per
+              executemany().
+
+        Returns:
+
+            int: The number of rows imported.
+
+        Raises:
+
+            ValueError: If a line is not valid JSON.
+            sql.Error: If the rows cannot be inserted.
+        """
+        with open(path) as infile:
+            records = (json.loads(line) for line in infile if line.strip())
+
+            first = list(islice(records, chunk_size))
+            if schema is None:
+                names = []
+                for record in first:
+                    names += [name for name in sorted(record)
+                              if name not in names]
+                schema = [(name, _infer_json_type(
+                    [record.get(name) for record in first]))
+                          for name in names]
+            names = [name for name, _ in schema]
+
+            def _chunks():
+                chunk = first
+                while chunk:
+                    yield [tuple(_json_value(record.get(name))
+                                 for name in names)
+                           for record in chunk]
+                    chunk = list(islice(records, chunk_size))
+
+            return self._bulk_insert(table, schema, _chunks())
 
     def attach(self, path, name):
         """
@@ -440,15 +1499,72 @@ class Database(object):
         """
         self.execute("DETACH ?", (name,))
 
-    def export_csv(self, table, output=None, columns="*", **kwargs):
+    def stream(self, query, params=(), batch_size=1000, format="rows"):
+        """
+        Iterate over the results of a query, without loading them all.
+
+        Results are fetched in batches. They may be returned as rows, or
+        as columnar batches of NumPy arrays or Arrow record batches.
+
+        Example:
+
+            >>> for row in db.stream("SELECT * FROM foo"):
+                    print(row)
+
+            >>> total = 0
+            >>> for batch in db.stream("SELECT price FROM foo",
+                                       format="numpy"):
+                    total += batch["price"].sum()
+
+        Arguments:
+
+            query (str): The query to execute.
+            params (sequence, optional): Query parameters.
+            batch_size (int, optional): Number of rows to fetch at a
+              time.
+            format (str, optional): One of "rows", to iterate over
+              rows, "numpy", to iterate over dicts of column names to
+              NumPy arrays, or "arrow", to iterate over
+              pyarrow.RecordBatch objects.
+
+        Returns:
+
+            iterable: Rows or batches.
+
+        Raises:
+
+            ValueError: If the format is not recognised.
+        """
+        if format not in ("rows", "numpy", "arrow"):
+            raise ValueError("Unknown result format '{0}'".format(format))
+
+        cursor = self.execute(query, params)
+        batches = _batches(cursor, batch_size)
+        if format == "rows":
+            return (row for batch in batches for row in batch)
+
+        names = [column[0] for column in cursor.description]
+        if format == "numpy":
+            return _numpy_batches(names, batches)
+        return _arrow_batches(names, batches)
+
+    def _select_table(self, table, columns):
+        if table not in self.tables:
+            raise SchemaError("Cannot find table '{table}'"
+                              .format(table=table))
+        return self.execute("SELECT {columns} FROM {table}"
+                            .format(columns=columns, table=table))
+
+    def export_csv(self, table, output=None, columns="*", header=True,
+                   batch_size=10000, **kwargs):
         """
         Export a table to a CSV file.
 
         If an output path is provided, write to file. Else, return a
         string.
 
-        Wrapper around pandas.sql.to_csv(). See:
-        http://pandas.pydata.org/pandas-docs/stable/io.html#io-store-in-csv
+        Rows are streamed from the database in batches, so memory use
+        is independent of the size of the table.
 
         Arguments:
 
@@ -456,7 +1572,11 @@ class Database(object):
             output (str, optional): Path of the file to write.
             columns (str, optional): A comma separated list of columns
               to export.
-            **kwargs: Additional args passed to pandas.sql.to_csv()
+            header (bool, optional): Write a header row of column names.
+            batch_size (int, optional): Number of rows to fetch at a
+              time.
+            **kwargs: Additional format parameters passed to
+              csv.writer(), e.g. "delimiter".
 
         Returns:
 
@@ -467,22 +1587,513 @@ class Database(object):
             IOError: In case of error writing to file.
             SchemaError: If the named table is not found.
         """
-        import pandas.io.sql as panda
+        cursor = self._select_table(table, columns)
 
         # Determine if we're writing to a file or returning a string.
         isfile = output is not None
-        output = output or StringIO()
+        outfile = open(output, "w") if isfile else StringIO()
 
-        if table not in self.tables:
-            raise SchemaError("Cannot find table '{table}'"
-                              .format(table=table))
+        kwargs.setdefault("lineterminator", "\n")
+        try:
+            writer = csv.writer(outfile, **kwargs)
+            if header:
+                writer.writerow([column[0] for column in cursor.description])
+            for batch in _batches(cursor, batch_size):
+                writer.writerows(batch)
+            return None if isfile else outfile.getvalue()
+        finally:
+            outfile.close()
+
+    def export_parquet(self, table, output, columns="*", batch_size=65536,
+                       **kwargs):
+        """
+        Export a table to a Parquet file.
+
+        Rows are streamed from the database and written in row groups
+        of "batch_size" rows, so memory use is independent of the size
+        of the table. Column types are taken from the table schema.
+
+        Requires the "pyarrow" package.
+
+        Arguments:
+
+            table (str): Name of the table to export.
+            output (str): Path of the file to write.
+            columns (str, optional): A comma separated list of columns
+              to export.
+            batch_size (int, optional): Number of rows per row group.
+            **kwargs: Additional args passed to
+              pyarrow.parquet.ParquetWriter(), e.g. "compression".
+
+        Raises:
+
+            IOError: In case of error writing to file.
+            SchemaError: If the named table is not found.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        cursor = self._select_table(table, columns)
+        names = [column[0] for column in cursor.description]
+
+        # Map declared column types to Arrow types, using SQLite's
+        # rules for type affinity. Expressions have no declared type,
+        # so their type is inferred from the first batch.
+        types = dict((column["name"], column["type"].lower())
+                     for column in self.table_info(table))
+
+        def _arrow_type(name):
+            decl = types.get(name)
+            if not decl:
+                return None
+            if "int" in decl:
+                return pa.int64()
+            if "char" in decl or "clob" in decl or "text" in decl:
+                return pa.string()
+            if "blob" in decl:
+                return pa.binary()
+            if "real" in decl or "floa" in decl or "doub" in decl:
+                return pa.float64()
+            return None
+
+        batches = _batches(cursor, batch_size)
+        first = next(batches, [])
+        arrays = [pa.array(column, type=_arrow_type(name))
+                  for name, column in zip(names, list(zip(*first)) or
+                                          [[]] * len(names))]
+        schema = pa.schema([pa.field(name, array.type)
+                            for name, array in zip(names, arrays)])
+
+        writer = pq.ParquetWriter(output, schema, **kwargs)
+        try:
+            if first:
+                writer.write_table(pa.Table.from_arrays(arrays,
+                                                        schema=schema))
+            for batch in batches:
+                writer.write_table(pa.Table.from_arrays(
+                    [pa.array(column, type=field.type)
+                     for field, column in zip(schema, zip(*batch))],
+                    schema=schema))
+        finally:
+            writer.close()
+
+
+class ShardedDatabase(object):
+    """
+    A database which is partitioned across multiple SQLite files.
+
+    The rows of each table are hash-partitioned across the shards by a
+    key column, which defaults to the first column of the table. Each
+    shard is a pooled Database with its own file, so writes to
+    different shards do not wait for each other, and many workers may
+    append rows at once.
+
+    Shards are stored in a directory, as files "0.db", "1.db", etc.
+    The number of shards is fixed when the database is created, as
+    changing it would change the partitioning of keys. For the same
+    reason, the key column of each table is recorded in the first
+    shard, and cannot be changed once the table is created.
+
+    There are two ways to query across shards. query() attaches every
+    shard to an in-memory database, in which each table is a view of
+    the UNION ALL of the shards' tables, so any query may be run,
+    including joins and aggregates. SQLite limits the number of
+    attached databases, which is 10 by default. read() runs a query on
+    every shard in parallel and merges the results, so it works for any
+    number of shards, but aggregates are per-shard.
+
+    Members:
+        path (str): The path to the shard directory.
+        shards (list of Database): The shards.
+        keys (dictionary of {str: str}): The key column of each table.
+    """
+    def __init__(self, path, num_shards=None, tables={}, keys={},
+                 timeout=5.0, profile=None, threads=None):
+        """
+        Arguments:
+            path (str): The path to the shard directory.
+            num_shards (int, optional): The number of shards. Required
+              to create a new database.
+            tables (dictionary of {str: tuple of str}, optional): A
+              dictionary of {name: schema} pairs, as for Database.
+            keys (dictionary of {str: str}, optional): A dictionary of
+              {table: column} pairs of key columns of tables. Tables
+              created without a key column are partitioned by their
+              first column.
+            timeout (float, optional): Seconds to wait for a lock held
+              by another connection.
+            profile (str, optional): Name of a pragma profile to apply
+              to each shard.
+            threads (int, optional): Number of threads used by read().
+              Defaults to one per shard.
+
+        Raises:
+            Error: If the number of shards does not match an existing
+              database, or is not given for a new database.
+            SchemaError: If a key column does not match the key column
+              of an existing table.
+        """
+        self.path = fs.mkdir(path)
+
+        existing = [name for name in fs.ls(self.path)
+                    if _SHARD_FILE.match(name)]
+        if num_shards is None:
+            num_shards = len(existing)
+        if num_shards < 1:
+            raise Error("Number of shards of '{0}' not given"
+                        .format(self.path))
+        if existing and len(existing) != num_shards:
+            raise Error("'{path}' has {n} shards, not {num_shards}"
+                        .format(path=self.path, n=len(existing),
+                                num_shards=num_shards))
+
+        self.shards = [Database(fs.path(self.path, "{0}.db".format(i)),
+                                pooled=True, timeout=timeout,
+                                profile=profile)
+                       for i in range(num_shards)]
+        self.threads = threads or num_shards
+
+        self.shards[0].create_table(_SHARD_KEYS, (
+            ("name", "text primary key"), ("key", "text")))
+        self.keys = dict(self.shards[0].execute(
+            "SELECT name, key FROM " + _SHARD_KEYS).fetchall())
+        for name,key in six.iteritems(keys):
+            if self.keys.get(name, key) != key:
+                raise SchemaError("Key column of table '{name}' is '{stored}', "
+                                  "not '{key}'".format(name=name, key=key,
+                                                       stored=self.keys[name]))
+
+        self._pool = None
+        self._local = threading.local()
+        self._coordinators = []
+        self._lock = threading.Lock()
+
+        for name,schema in six.iteritems(tables):
+            self.create_table(name, schema, key=keys.get(name))
+
+        io.debug("Opened {0} shards in '{1}'".format(num_shards, self.path))
+
+        atexit.register(self.close)
+
+    def __repr__(self):
+        return self.path
+
+    def __str__(self):
+        return self.__repr__()
+
+    @property
+    def num_shards(self):
+        """
+        The number of shards.
+        """
+        return len(self.shards)
+
+    @property
+    def tables(self):
+        """
+        Returns a list of table names.
+        """
+        query = self.shards[0].execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name != ?",
+            (_SHARD_KEYS,))
+        return [row[0] for row in query]
+
+    def key(self, table):
+        """
+        Return the key column of a table.
+
+        Arguments:
 
-        # Don't print row indexes by default.
-        if "index" not in kwargs:
-            kwargs["index"] = False
+            table (str): The name of the table.
 
-        table = panda.read_sql("SELECT {columns} FROM {table}"
-                               .format(columns=columns, table=table),
-                               self.connection)
-        table.to_csv(output, **kwargs)
-        return None if isfile else output.getvalue()
+        Returns:
+
+            str: The name of the key column.
+
+        Raises:
+
+            SchemaError: If the table does not exist, or was not
+              created by a ShardedDatabase.
+        """
+        if table not in self.keys:
+            # The table may have been created by another instance.
+            row = self.shards[0].execute(
+                "SELECT key FROM {keys} WHERE name=?".format(keys=_SHARD_KEYS),
+                (table,)).fetchone()
+            if row is None:
+                raise SchemaError("Cannot find key column of table '{table}'"
+                                  .format(table=table))
+            self.keys[table] = row[0]
+        return self.keys[table]
+
+    def shard(self, key):
+        """
+        Return the shard which a key is partitioned to.
+
+        Example:
+
+            >>> db.shard(benchmark).execute(
+                    "INSERT INTO results VALUES (?,?)", (benchmark, runtime))
+
+        Arguments:
+
+            key: The key value.
+
+        Returns:
+
+            Database: The shard.
+        """
+        return self.shards[shard_index(key, self.num_shards)]
+
+    def create_table(self, name, schema, key=None):
+        """
+        Create a new table in every shard.
+
+        If the table already exists, nothing happens.
+
+        Arguments:
+
+           name (str): The name of the table to create.
+           schema (sequence of tuples): A list of (name, type) tuples
+             representing each of the columns.
+           key (str, optional): The name of the key column. Defaults
+             to the first column, or the key column of an existing
+             table.
+
+        Raises:
+
+            SchemaError: If the key column is not in the schema, or
+              does not match the key column of an existing table.
+        """
+        try:
+            stored = self.key(name)
+        except SchemaError:
+            stored = None
+        if stored is not None:
+            if key is not None and key != stored:
+                raise SchemaError("Key column of table '{name}' is "
+                                  "'{stored}', not '{key}'".format(
+                                      name=name, key=key, stored=stored))
+            key = stored
+
+        key = key or schema[0][0]
+        if key not in [column[0] for column in schema]:
+            raise SchemaError("Key column '{key}' not in table '{name}'"
+                              .format(key=key, name=name))
+
+        for shard in self.shards:
+            shard.create_table(name, schema)
+        if stored is None:
+            self.shards[0].execute("INSERT INTO {keys} VALUES (?,?)"
+                                   .format(keys=_SHARD_KEYS), (name, key))
+            self.shards[0].commit()
+            self.keys[name] = key
+
+    def drop_table(self, name):
+        """
+        Drop a table from every shard.
+
+        If the table does not exist, nothing happens.
+
+        Arguments:
+
+            name (str): The name of the table to drop.
+        """
+        for shard in self.shards:
+            shard.drop_table(name)
+        self.shards[0].execute("DELETE FROM {keys} WHERE name=?"
+                               .format(keys=_SHARD_KEYS), (name,))
+        self.shards[0].commit()
+        self.keys.pop(name, None)
+
+    def num_rows(self, table):
+        """
+        Return the number of rows in the named table, across all shards.
+
+        Arguments:
+
+            table (str): The name of the table to count the rows in.
+
+        Returns:
+
+            int: The number of rows in the named table.
+        """
+        return sum(shard.num_rows(table) for shard in self.shards)
+
+    def insert_many(self, table, rows, chunk_size=10000, columns=None):
+        """
+        Partition rows of a table across the shards, and insert them.
+
+        Rows are buffered per shard, and each buffer is inserted into
+        its shard once it holds a chunk of rows, as for
+        Database.insert_many(). Only the shard being inserted into is
+        locked.
+
+        Arguments:
+
+            table (str): The name of the table to insert into.
+            rows (iterable of sequences): Rows to insert.
+            chunk_size (int, optional): Number of rows per transaction.
+            columns (sequence of str, optional): Names of the columns
+              to insert into, if not all columns.
+
+        Returns:
+
+            int: The number of rows inserted.
+
+        Raises:
+
+            SchemaError: If the key column is not inserted.
+        """
+        key = self.key(table)
+        names = list(columns or [column["name"] for column in
+                                 self.shards[0].table_info(table)])
+        if key not in names:
+            raise SchemaError("Key column '{key}' of table '{table}' "
+                              "not inserted".format(key=key, table=table))
+        index = names.index(key)
+
+        buffers = [[] for _ in self.shards]
+        count = 0
+        for row in rows:
+            i = shard_index(row[index], self.num_shards)
+            buffers[i].append(row)
+            if len(buffers[i]) >= chunk_size:
+                count += self.shards[i].insert_many(
+                    table, buffers[i], chunk_size=chunk_size, columns=columns)
+                buffers[i] = []
+
+        for shard, buffer in zip(self.shards, buffers):
+            if buffer:
+                count += shard.insert_many(
+                    table, buffer, chunk_size=chunk_size, columns=columns)
+        return count
+
+    def commit(self):
+        """
+        Commit the current transaction of every shard.
+        """
+        for shard in self.shards:
+            shard.commit()
+
+    def _coordinator(self):
+        """
+        Return the current thread's connection to the attached shards,
+        with a view of each table.
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sql.connect(":memory:", check_same_thread=False)
+            limit = _MAX_ATTACHED
+            # Limits may only be read from Python 3.11.
+            if hasattr(connection, "getlimit"):
+                limit = connection.getlimit(sql.SQLITE_LIMIT_ATTACHED)
+            if self.num_shards > limit:
+                connection.close()
+                raise Error("Cannot attach {n} shards, SQLite allows {limit}. "
+                            "Use read() instead."
+                            .format(n=self.num_shards, limit=limit))
+
+            for i, shard in enumerate(self.shards):
+                connection.execute("ATTACH ? AS ?",
+                                   (shard.path, "shard{0}".format(i)))
+            with self._lock:
+                self._coordinators.append(connection)
+            self._local.connection = connection
+            self._local.tables = []
+
+        # Recreate the views if tables have been created or dropped.
+        tables = self.tables
+        if tables != self._local.tables:
+            for table in self._local.tables:
+                connection.execute("DROP VIEW IF EXISTS temp." + table)
+            for table in tables:
+                connection.execute(
+                    "CREATE TEMP VIEW {table} AS {union}".format(
+                        table=table, union=" UNION ALL ".join(
+                            "SELECT * FROM shard{i}.{table}"
+                            .format(i=i, table=table)
+                            for i in range(self.num_shards))))
+            self._local.tables = tables
+        return connection
+
+    def query(self, query, params=()):
+        """
+        Execute a query across all shards.
+
+        Each table of the query is the union of the table's rows in
+        every shard, so the query may be of any form.
+
+        Example:
+
+            >>> db.query("SELECT benchmark, AVG(runtime) FROM results "
+                         "GROUP BY benchmark").fetchall()
+
+        Arguments:
+
+            query (str): The query to execute.
+            params (sequence, optional): Query parameters.
+
+        Returns:
+
+            sql.Cursor: The query results.
+
+        Raises:
+
+            Error: If there are more shards than SQLite may attach.
+        """
+        return self._coordinator().execute(query, params)
+
+    def read(self, query, params=(), key=None, reverse=False):
+        """
+        Execute a query on every shard in parallel, and merge the results.
+
+        Example:
+
+            >>> db.read("SELECT * FROM results WHERE runtime > ?", (10,),
+                        key=lambda row: row[1])
+
+        Arguments:
+
+            query (str): The query to execute on each shard.
+            params (sequence, optional): Query parameters.
+            key (function, optional): If given, the merged results are
+              sorted by this key. Otherwise, results are in shard order.
+            reverse (bool, optional): Sort in descending order.
+
+        Returns:
+
+            list of tuples: The results of all shards.
+        """
+        def _read(shard):
+            # Each read uses a short-lived connection, as pool threads
+            # would otherwise keep a connection to every shard.
+            connection = sql.connect(shard.path, timeout=shard.timeout)
+            try:
+                return connection.execute(query, params).fetchall()
+            finally:
+                connection.close()
+
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.threads)
+        results = self._pool.map(_read, self.shards)
+
+        rows = [row for result in results for row in result]
+        if key is not None:
+            rows.sort(key=key, reverse=reverse)
+        return rows
+
+    def close(self):
+        """
+        Close the connections to every shard.
+        """
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
+            for connection in self._coordinators:
+                connection.close()
+            self._coordinators = []
+        for shard in self.shards:
+            shard.close()
@@ -13,14 +13,38 @@
 # You should have received a copy of the GNU General Public License
 # along with labm8.  If not, see <http://www.gnu.org/licenses/>.
 from unittest import main
+from unittest import skipIf
 from tests import TestCase
 
+import json
+import multiprocessing
+import os
+import threading
+import time
+
 import labm8 as lab
+from labm8 import crypto
 from labm8 import fs
+from labm8 import prof
 from labm8 import system
 
 from labm8 import cache
 
+if lab.is_python3():
+    from io import StringIO
+else:
+    from StringIO import StringIO
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+def _shared_memory_worker(_cache, n):
+    for i in range(100 * n, 100 * (n + 1)):
+        _cache[i] = i * i
+
+
 class TestCache(TestCase):
     def _test_cache(self, _cache):
         _cache.clear()
@@ -55,6 +79,22 @@ class TestCache(TestCase):
 
         _cache.clear()
 
+    def _test_bulk(self, _cache):
+        _cache.clear()
+
+        _cache.set_many({"foo": 1, "bar": 2})
+        _cache.set_many([("baz", 3)])
+        self._test(3, len(_cache))
+        self._test([1, 2, 3, None], _cache.get_many(["foo", "bar", "baz",
+                                                     "notakey"]))
+        self._test([5], _cache.get_many(["notakey"], default=5))
+
+        self._test(2, _cache.delete_many(["foo", "baz", "notakey"]))
+        self._test(False, "foo" in _cache)
+        self._test([None, 2], _cache.get_many(["foo", "bar"]))
+
+        _cache.clear()
+
     # Cache
     def test_cache(self):
         # Test interface.
@@ -66,6 +106,9 @@ class TestCache(TestCase):
         self.assertRaises(NotImplementedError, _cache.__setitem__, "foo", 1)
         self.assertRaises(NotImplementedError, _cache.__contains__, "foo")
         self.assertRaises(NotImplementedError, _cache.__delitem__, "foo")
+        self.assertRaises(NotImplementedError, _cache.get_many, ["foo"])
+        self.assertRaises(NotImplementedError, _cache.set_many, {"foo": 1})
+        self.assertRaises(NotImplementedError, _cache.delete_many, ["foo"])
 
     # TransientCache
     def test_transient_cache(self):
@@ -86,6 +129,114 @@ class TestCache(TestCase):
         self._test(2, _cache["bar"])
         self._test(3, _cache["baz"])
 
+    # BoundedCache
+    def test_bounded_cache(self):
+        _cache = cache.BoundedCache(max_entries=10)
+        self._test_cache(_cache)
+        self._test(True, isinstance(_cache, cache.TransientCache))
+
+    def test_bounded_cache_lru(self):
+        _cache = cache.BoundedCache(max_entries=2, policy="lru")
+        _cache["a"] = 1
+        _cache["b"] = 2
+        # Access "a" so that "b" becomes least recently used.
+        _cache["a"]
+        _cache["c"] = 3
+        self._test(2, len(_cache))
+        self._test(True, "a" in _cache)
+        self._test(False, "b" in _cache)
+        self._test(True, "c" in _cache)
+        self._test(1, _cache.evictions)
+
+    def test_bounded_cache_lfu(self):
+        _cache = cache.BoundedCache(max_entries=2, policy="lfu")
+        _cache["a"] = 1
+        _cache["b"] = 2
+        _cache["a"]
+        _cache["a"]
+        _cache["b"]
+        _cache["c"] = 3
+        self._test(True, "a" in _cache)
+        self._test(False, "b" in _cache)
+        self._test(True, "c" in _cache)
+
+    def test_bounded_cache_ttl(self):
+        _cache = cache.BoundedCache(policy="ttl", ttl=0)
+        _cache["a"] = 1
+        self._test(False, "a" in _cache)
+        self._test(None, _cache.get("a"))
+        self._test(0, len(_cache))
+
+        _cache = cache.BoundedCache(policy="ttl", ttl=3600)
+        _cache["a"] = 1
+        self._test(1, _cache["a"])
+
+        with self.assertRaises(ValueError):
+            cache.BoundedCache(policy="ttl")
+
+    def test_bounded_cache_max_bytes(self):
+        _cache = cache.BoundedCache(max_bytes=10,
+                                    sizeof=lambda k, v: len(v))
+        _cache["a"] = "xxxx"
+        _cache["b"] = "xxxx"
+        self._test(8, _cache.nbytes)
+        _cache["c"] = "xxxx"
+        self._test(8, _cache.nbytes)
+        self._test(False, "a" in _cache)
+
+        # Overwriting an entry replaces its size.
+        _cache["c"] = "x"
+        self._test(5, _cache.nbytes)
+
+        del _cache["c"]
+        self._test(4, _cache.nbytes)
+        _cache.clear()
+        self._test(0, _cache.nbytes)
+
+    def test_bounded_cache_bad_policy(self):
+        with self.assertRaises(ValueError):
+            cache.BoundedCache(policy="not a policy")
+
+    def test_bulk(self):
+        self._test_bulk(cache.TransientCache())
+        self._test_bulk(cache.BoundedCache(max_entries=10))
+        self._test_bulk(cache.StatsCache(cache.TransientCache()))
+        self._test_bulk(cache.TieredCache(cache.TransientCache(),
+                                          max_entries=1))
+        self._test_bulk(cache.TieredCache(cache.TransientCache(),
+                                          max_entries=1, write_back=True))
+
+        fs.rm("/tmp/labm8.cache.json")
+        self._test_bulk(cache.JsonCache("/tmp/labm8.cache.json"))
+
+        fs.rm("/tmp/labm8.cache.journal")
+        _cache = cache.JournalCache("/tmp/labm8.cache.journal")
+        self._test_bulk(_cache)
+        _cache.set_many({"foo": 1, "bar": 2})
+        _cache.delete_many(["bar"])
+        _cache.close()
+        _cache = cache.JournalCache("/tmp/labm8.cache.journal")
+        self._test({"foo": 1}, dict(_cache.items()))
+        _cache.close()
+        fs.rm("/tmp/labm8.cache.journal")
+
+        fs.rm("/tmp/labm8.cache.sql*")
+        _cache = cache.SqliteCache("/tmp/labm8.cache.sql")
+        self._test_bulk(_cache)
+        _cache.set_many(("key{0}".format(i), i) for i in range(1200))
+        self._test(list(range(1200)), _cache.get_many(
+            "key{0}".format(i) for i in range(1200)))
+        _cache.close()
+        fs.rm("/tmp/labm8.cache.sql*")
+
+    def test_bulk_stats(self):
+        _cache = cache.StatsCache(cache.TransientCache())
+        _cache.set_many({"foo": 1, "bar": 2})
+        _cache.get_many(["foo", "baz"])
+        self._test(2, _cache.sets)
+        self._test(1, _cache.hits)
+        self._test(1, _cache.misses)
+
     # JsonCache
     def test_json_cache(self):
         # Load test-set
@@ -115,6 +266,686 @@ class TestCache(TestCase):
         _cache["foo"] = 1
         _cache.write()
 
+    def test_json_cache_lazy(self):
+        fs.rm("/tmp/labm8.cache.json")
+        _cache = cache.JsonCache("/tmp/labm8.cache.json")
+        _cache["foo"] = 1
+        _cache.write()
+
+        # Lazy cache is loaded on first access.
+        _cache = cache.JsonCache("/tmp/labm8.cache.json", lazy=True)
+        self._test(False, _cache._loaded)
+        self._test(1, _cache["foo"])
+        self._test(True, _cache._loaded)
+
+        # An unloaded cache is not rewritten.
+        _cache = cache.JsonCache("/tmp/labm8.cache.json", lazy=True)
+        system.echo("{}", "/tmp/labm8.cache.json")
+        _cache.write()
+        self._test(["{}"], fs.read("/tmp/labm8.cache.json"))
+        fs.rm("/tmp/labm8.cache.json")
+
+    def test_json_cache_index(self):
+        fs.rm("/tmp/labm8.cache.json*")
+        data = {"foo": 1, "bar": {"a": [1, 2], "b": "\u00e9"}, "baz": []}
+        _cache = cache.JsonCache("/tmp/labm8.cache.json", index=True)
+        for key, value in data.items():
+            _cache[key] = value
+        _cache.write()
+
+        # The indexed file is identical to the unindexed format.
+        self._test(json.dumps(data, sort_keys=True, indent=2,
+                              separators=(',', ': ')),
+                   fs.read_file("/tmp/labm8.cache.json"))
+
+        # Lookups are served from the index without loading.
+        _cache = cache.JsonCache("/tmp/labm8.cache.json", lazy=True)
+        for key, value in data.items():
+            self._test(value, _cache[key])
+        self._test(False, "notakey" in _cache)
+        self._test(5, _cache.get("notakey", 5))
+        self.assertRaises(KeyError, _cache.__getitem__, "notakey")
+        self._test(False, _cache._loaded)
+
+        # Modification loads the cache.
+        _cache["qux"] = 2
+        self._test(True, _cache._loaded)
+        self._test(4, len(_cache))
+
+        # A stale index is ignored.
+        json.dump({"foo": 2}, open("/tmp/labm8.cache.json", "w"))
+        _cache = cache.JsonCache("/tmp/labm8.cache.json", lazy=True)
+        self._test(2, _cache["foo"])
+        self._test(True, _cache._loaded)
+        fs.rm("/tmp/labm8.cache.json*")
+
+    def test_json_cache_compression(self):
+        fs.rm("/tmp/labm8.cache.json*")
+        _cache = cache.JsonCache("/tmp/labm8.cache.json", compression="gzip",
+                                 compress_threshold=0)
+        _cache["foo"] = {"a": [1, 2]}
+        _cache.write()
+        with open("/tmp/labm8.cache.json", "rb") as infile:
+            self._test(b"\x1f\x8b", infile.read(2))
+
+        # Compression is detected on load.
+        _cache = cache.JsonCache("/tmp/labm8.cache.json")
+        self._test({"a": [1, 2]}, _cache["foo"])
+
+        # Uncompressed caches remain readable.
+        json.dump({"foo": 2}, open("/tmp/labm8.cache.json", "w"))
+        _cache = cache.JsonCache("/tmp/labm8.cache.json", compression="gzip")
+        self._test(2, _cache["foo"])
+        # Small caches are not compressed.
+        _cache.write()
+        self._test(b"{", open("/tmp/labm8.cache.json", "rb").read(1))
+        fs.rm("/tmp/labm8.cache.json*")
+
+    def test_json_cache_pickle(self):
+        import numpy as np
+
+        fs.rm("/tmp/labm8.cache.json*")
+        array = np.arange(1000, dtype=np.float64)
+        _cache = cache.JsonCache("/tmp/labm8.cache.json", serializer="pickle")
+        _cache[("foo", 1)] = array
+        _cache["bar"] = {"a": (1, 2)}
+        _cache.write()
+        with open("/tmp/labm8.cache.json", "rb") as infile:
+            self._test(cache.PickleSerializer.magic, infile.read(4))
+
+        # Serialized files are detected on load. Arrays are views of the
+        # file, and may be modified.
+        _cache = cache.JsonCache("/tmp/labm8.cache.json")
+        loaded = _cache[("foo", 1)]
+        self.assertTrue(np.array_equal(array, loaded))
+        self.assertFalse(loaded.flags.owndata)
+        loaded[0] = 5
+        self._test({"a": (1, 2)}, _cache["bar"])
+
+        # Overwriting a mapped file leaves loaded values intact.
+        _cache.write()
+        self._test(5, loaded[0])
+        self._test(5, cache.JsonCache("/tmp/labm8.cache.json")[("foo", 1)][0])
+
+        # Compressed pickles.
+        _cache = cache.JsonCache("/tmp/labm8.cache.json", serializer="pickle",
+                                 compression="gzip", compress_threshold=0)
+        _cache.write()
+        with open("/tmp/labm8.cache.json", "rb") as infile:
+            self._test(b"\x1f\x8b", infile.read(2))
+        _cache = cache.JsonCache("/tmp/labm8.cache.json")
+        self.assertTrue(np.array_equal(array[1:], _cache[("foo", 1)][1:]))
+        fs.rm("/tmp/labm8.cache.json*")
+
+    @skipIf(msgpack is None, "msgpack not installed")
+    def test_json_cache_msgpack(self):
+        import numpy as np
+
+        fs.rm("/tmp/labm8.cache.json*")
+        array = np.arange(1000, dtype=np.float64)
+        _cache = cache.JsonCache("/tmp/labm8.cache.json",
+                                 serializer="msgpack")
+        _cache["foo"] = array
+        _cache["bar"] = {"a": (1, 2)}
+        _cache.write()
+        with open("/tmp/labm8.cache.json", "rb") as infile:
+            self._test(cache.MsgpackSerializer.magic, infile.read(4))
+
+        # Serialized files are detected on load. Tuples are loaded as
+        # lists.
+        _cache = cache.JsonCache("/tmp/labm8.cache.json")
+        self.assertTrue(np.array_equal(array, _cache["foo"]))
+        self._test({"a": [1, 2]}, _cache["bar"])
+
+        # Compressed files.
+        _cache = cache.JsonCache("/tmp/labm8.cache.json",
+                                 serializer="msgpack", compression="gzip",
+                                 compress_threshold=0)
+        _cache.write()
+        _cache = cache.JsonCache("/tmp/labm8.cache.json")
+        self.assertTrue(np.array_equal(array, _cache["foo"]))
+        self._test("msgpack", _cache.serializer.name)
+        fs.rm("/tmp/labm8.cache.json*")
+
+    def test_json_cache_flush(self):
+        fs.rm("/tmp/labm8.cache.json*")
+        _cache = cache.JsonCache("/tmp/labm8.cache.json")
+        self._test(False, _cache.flush())
+        _cache["foo"] = 1
+        self._test(True, _cache.flush())
+        self._test(False, _cache.flush())
+        self._test({"foo": 1}, json.load(open("/tmp/labm8.cache.json")))
+
+        del _cache["foo"]
+        self._test(True, _cache.flush())
+        self._test(0, _cache.delete_many(["foo"]))
+        self._test(False, _cache.flush())
+
+        # The file is replaced, leaving no temporary files behind.
+        self._test(["labm8.cache.json"], [x for x in fs.ls("/tmp")
+                                          if x.startswith("labm8.cache.json")])
+        fs.rm("/tmp/labm8.cache.json*")
+
+    def test_json_cache_flush_interval(self):
+        fs.rm("/tmp/labm8.cache.json*")
+        _cache = cache.JsonCache("/tmp/labm8.cache.json", flush_interval=.01)
+        _cache["foo"] = 1
+        for _ in range(500):
+            if fs.exists("/tmp/labm8.cache.json"):
+                break
+            time.sleep(.01)
+        self._test({"foo": 1}, json.load(open("/tmp/labm8.cache.json")))
+
+        # Pending modifications are written on close.
+        _cache.flush_interval = 1000
+        _cache["bar"] = 2
+        _cache.close()
+        self._test({"foo": 1, "bar": 2},
+                   json.load(open("/tmp/labm8.cache.json")))
+        fs.rm("/tmp/labm8.cache.json*")
+
+    def test_serializer_unknown(self):
+        with self.assertRaises(ValueError):
+            cache.JsonCache("/tmp/labm8.cache.json", serializer="foo")
+
+    def test_compression_unknown(self):
+        with self.assertRaises(ValueError):
+            cache.JsonCache("/tmp/labm8.cache.json", compression="foo")
+
+    # JournalCache
+    def test_journal_cache(self):
+        fs.rm("/tmp/labm8.cache.journal")
+        _cache = cache.JournalCache("/tmp/labm8.cache.journal")
+        self._test_cache(_cache)
+
+        _cache["foo"] = 1
+        _cache["bar"] = [1, 2, 3]
+        _cache["baz"] = 3
+        del _cache["baz"]
+        _cache.close()
+
+        # Replay journal.
+        cache2 = cache.JournalCache("/tmp/labm8.cache.journal")
+        self._test(2, len(cache2))
+        self._test(1, cache2["foo"])
+        self._test([1, 2, 3], cache2["bar"])
+        self._test(False, "baz" in cache2)
+        cache2.close()
+        fs.rm("/tmp/labm8.cache.journal")
+
+    def test_journal_cache_compact(self):
+        fs.rm("/tmp/labm8.cache.journal")
+        _cache = cache.JournalCache("/tmp/labm8.cache.journal")
+        for i in range(100):
+            _cache["foo"] = i
+        size = fs.du("/tmp/labm8.cache.journal", human_readable=False)
+
+        _cache.compact()
+        self._test(True, fs.du("/tmp/labm8.cache.journal",
+                               human_readable=False) < size)
+
+        # Modifications after compaction are still journaled.
+        _cache["bar"] = 1
+        _cache.close()
+        cache2 = cache.JournalCache("/tmp/labm8.cache.journal")
+        self._test(99, cache2["foo"])
+        self._test(1, cache2["bar"])
+        cache2.close()
+        fs.rm("/tmp/labm8.cache.journal")
+
+    def test_journal_cache_auto_compact(self):
+        fs.rm("/tmp/labm8.cache.journal")
+        _cache = cache.JournalCache("/tmp/labm8.cache.journal",
+                                    compact_threshold=1024)
+        for i in range(1000):
+            _cache["foo"] = i
+        _cache.close()
+        # The journal was compacted at least once, discarding
+        # overwritten records.
+        self._test(True, len(fs.read("/tmp/labm8.cache.journal")) < 1000)
+        cache2 = cache.JournalCache("/tmp/labm8.cache.journal")
+        self._test(999, cache2["foo"])
+        cache2.close()
+        fs.rm("/tmp/labm8.cache.journal")
+
+    def test_journal_cache_truncated(self):
+        fs.rm("/tmp/labm8.cache.journal")
+        _cache = cache.JournalCache("/tmp/labm8.cache.journal")
+        _cache["foo"] = 1
+        _cache.close()
+
+        # Simulate a crash midway through writing a record.
+        with open("/tmp/labm8.cache.journal", "a") as outfile:
+            outfile.write('["s", "bar", ')
+
+        _cache = cache.JournalCache("/tmp/labm8.cache.journal")
+        self._test(1, _cache["foo"])
+        self._test(False, "bar" in _cache)
+        _cache["bar"] = 2
+        _cache.close()
+
+        cache2 = cache.JournalCache("/tmp/labm8.cache.journal")
+        self._test(2, cache2["bar"])
+        cache2.close()
+
+        # A complete record without its newline is also discarded.
+        with open("/tmp/labm8.cache.journal", "a") as outfile:
+            outfile.write('["s", "baz", 3]')
+        _cache = cache.JournalCache("/tmp/labm8.cache.journal")
+        self._test(False, "baz" in _cache)
+        _cache["x"] = 4
+        _cache["y"] = 5
+        _cache.close()
+        _cache = cache.JournalCache("/tmp/labm8.cache.journal")
+        self._test({"foo": 1, "bar": 2, "x": 4, "y": 5}, dict(_cache.items()))
+        _cache.close()
+        fs.rm("/tmp/labm8.cache.journal")
+
+    def test_journal_cache_bad_key(self):
+        fs.rm("/tmp/labm8.cache.journal")
+        _cache = cache.JournalCache("/tmp/labm8.cache.journal")
+        _cache[1] = "a"
+        self.assertRaises(TypeError, _cache.__setitem__, ("a", 1), 1)
+        self.assertRaises(TypeError, _cache.set_many, {"b": 2, ("a", 1): 1})
+        self.assertRaises(TypeError, _cache.delete_many, [("a", 1)])
+        self._test({1: "a"}, dict(_cache.items()))
+        _cache.close()
+
+        # Nothing was journaled.
+        _cache = cache.JournalCache("/tmp/labm8.cache.journal")
+        self._test({1: "a"}, dict(_cache.items()))
+        _cache.close()
+        fs.rm("/tmp/labm8.cache.journal")
+
+    # SqliteCache
+    def test_sqlite_cache(self):
+        fs.rm("/tmp/labm8.cache.sql*")
+        _cache = cache.SqliteCache("/tmp/labm8.cache.sql")
+        self._test_cache(_cache)
+
+        _cache["foo"] = 1
+        _cache[("bar", 2)] = {"a": [1, 2]}
+        self._test(2, len(_cache))
+        self._test({"a": [1, 2]}, _cache[("bar", 2)])
+        self._test([1, {"a": [1, 2]}], sorted(_cache, key=str))
+        _cache.close()
+
+        cache2 = cache.SqliteCache("/tmp/labm8.cache.sql")
+        self._test(1, cache2["foo"])
+        self._test({"a": [1, 2]}, cache2[("bar", 2)])
+        self._test(2, len(list(cache2.items())))
+        cache2.close()
+        fs.rm("/tmp/labm8.cache.sql*")
+
+    def test_sqlite_cache_commit_every(self):
+        fs.rm("/tmp/labm8.cache.sql*")
+        _cache = cache.SqliteCache("/tmp/labm8.cache.sql", commit_every=2)
+        reader = cache.SqliteCache("/tmp/labm8.cache.sql")
+
+        _cache["foo"] = 1
+        # Uncommitted writes are only visible to the writer.
+        self._test(1, _cache["foo"])
+        self._test(False, "foo" in reader)
+
+        _cache["bar"] = 2
+        self._test(1, reader["foo"])
+        self._test(2, reader["bar"])
+
+        reader.close()
+        _cache.close()
+        fs.rm("/tmp/labm8.cache.sql*")
+
+    def test_sqlite_cache_compression(self):
+        fs.rm("/tmp/labm8.cache.sql*")
+        _cache = cache.SqliteCache("/tmp/labm8.cache.sql")
+        _cache["foo"] = "a" * 100
+        _cache.close()
+
+        # Old uncompressed values are read alongside compressed values.
+        _cache = cache.SqliteCache("/tmp/labm8.cache.sql", compression="gzip",
+                                   compress_threshold=50)
+        _cache["bar"] = "b" * 100
+        _cache["baz"] = "c"
+        self._test(["a" * 100, "b" * 100, "c"], _cache.get_many(
+            ["foo", "bar", "baz"]))
+        self._test(["a" * 100, "b" * 100, "c"], sorted(_cache))
+
+        types = dict(_cache.db.execute(
+            "SELECT key, typeof(value) FROM cache").fetchall())
+        self._test({'"foo"': "text", '"bar"': "blob", '"baz"': "text"},
+                   types)
+        _cache.close()
+        fs.rm("/tmp/labm8.cache.sql*")
+
+    # SharedMemoryCache
+    def test_shared_memory_cache(self):
+        _cache = cache.SharedMemoryCache("labm8-test")
+        _cache.clear()
+        self._test_cache(_cache)
+        self._test_bulk(_cache)
+
+        _cache[("foo", 1)] = {"a": [1, 2]}
+        _cache.set_many({"bar": 2})
+        self._test([2, {"a": [1, 2]}], sorted(_cache, key=str))
+        self._test([("bar", 2), (("foo", 1), {"a": [1, 2]})],
+                   sorted(_cache.items(), key=str))
+
+        # Other instances share the same entries.
+        cache2 = cache.SharedMemoryCache("labm8-test")
+        self._test({"a": [1, 2]}, cache2[["foo", 1]])
+        del cache2["bar"]
+        self._test(1, len(_cache))
+        cache2.close()
+        _cache.unlink()
+
+    def test_shared_memory_cache_processes(self):
+        _cache = cache.SharedMemoryCache("labm8-test")
+        _cache.clear()
+        workers = [multiprocessing.Process(target=_shared_memory_worker,
+                                           args=(_cache, i))
+                   for i in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self._test(400, len(_cache))
+        self._test([i * i for i in range(400)], _cache.get_many(range(400)))
+        _cache.unlink()
+
+    def test_shared_memory_cache_full(self):
+        _cache = cache.SharedMemoryCache("labm8-test-full", max_entries=8,
+                                         nbytes=1024)
+        _cache.clear()
+
+        # Deleted and replaced entries are reclaimed.
+        for i in range(100):
+            _cache["foo"] = i
+            _cache["bar"] = i
+            del _cache["bar"]
+        self._test(99, _cache["foo"])
+        self._test(1, len(_cache))
+
+        # Once full, the cache is emptied.
+        _cache.clear()
+        for i in range(8):
+            _cache[i] = i
+        self._test(8, len(_cache))
+        _cache[8] = 8
+        self._test(1, len(_cache))
+        self._test(8, _cache[8])
+
+        self.assertRaises(ValueError, _cache.__setitem__, "foo", "a" * 2048)
+        _cache.unlink()
+
+    # TieredCache
+    def test_tiered_cache(self):
+        backend = cache.TransientCache()
+        _cache = cache.TieredCache(backend, max_entries=2)
+        self._test_cache(_cache)
+
+        # Write through.
+        _cache["foo"] = 1
+        self._test(1, backend["foo"])
+        del _cache["foo"]
+        self._test(False, "foo" in backend)
+
+    def test_tiered_cache_promote(self):
+        backend = cache.TransientCache()
+        backend["foo"] = 1
+        backend["bar"] = 2
+        _cache = cache.TieredCache(backend, max_entries=1)
+
+        self._test(1, _cache["foo"])
+        self._test(True, "foo" in _cache.front)
+        self._test(2, _cache["bar"])
+        self._test(False, "foo" in _cache.front)
+        self._test(True, "bar" in _cache.front)
+        self._test(2, len(_cache))
+
+    def test_tiered_cache_write_back(self):
+        backend = cache.TransientCache()
+        backend["baz"] = 3
+        _cache = cache.TieredCache(backend, max_entries=1, write_back=True,
+                                   flush_every=10)
+
+        _cache["foo"] = 1
+        _cache["bar"] = 2
+        del _cache["baz"]
+        # Writes are buffered, and served even if evicted from memory.
+        self._test(False, "foo" in backend)
+        self._test(True, "baz" in backend)
+        self._test(1, _cache["foo"])
+        self._test(2, _cache["bar"])
+        self._test(False, "baz" in _cache)
+
+        _cache.flush()
+        self._test(1, backend["foo"])
+        self._test(2, backend["bar"])
+        self._test(False, "baz" in backend)
+
+        # Flush once the buffer is full.
+        for i in range(10):
+            _cache[i] = i
+        self._test(12, len(backend))
+
+    def test_tiered_cache_fs(self):
+        fs.rm("/tmp/labm8-cache-tiered")
+        backend = cache.FSCache("/tmp/labm8-cache-tiered")
+        _cache = cache.TieredCache(backend)
+
+        # Memory holds the path of the file in the cache, not the
+        # path it was moved from.
+        system.echo("a", "/tmp/labm8.tiered.a")
+        _cache["a"] = "/tmp/labm8.tiered.a"
+        self._test(backend.keypath("a"), _cache["a"])
+        self._test(backend.keypath("a"), _cache.front["a"])
+        self._test(["a"], fs.read(_cache["a"]))
+
+        system.echo("b", "/tmp/labm8.tiered.b")
+        _cache.set_many({"b": "/tmp/labm8.tiered.b"})
+        self._test(backend.keypath("b"), _cache["b"])
+
+        _cache = cache.TieredCache(backend, write_back=True)
+        system.echo("c", "/tmp/labm8.tiered.c")
+        _cache["c"] = "/tmp/labm8.tiered.c"
+        self._test("/tmp/labm8.tiered.c", _cache["c"])
+        _cache.flush()
+        self._test(backend.keypath("c"), _cache["c"])
+        self._test(["c"], fs.read(_cache["c"]))
+        backend.clear()
+
+    # StatsCache
+    def test_stats_cache(self):
+        self._test_cache(cache.StatsCache(cache.TransientCache()))
+
+        _cache = cache.StatsCache(cache.BoundedCache(max_entries=1))
+
+        _cache["foo"] = 1
+        _cache["bar"] = 2
+        self._test(2, _cache["bar"])
+        self._test(None, _cache.get("foo"))
+        del _cache["bar"]
+
+        stats = _cache.stats()
+        self._test("BoundedCache", stats["name"])
+        self._test(1, stats["hits"])
+        self._test(1, stats["misses"])
+        self._test(.5, stats["hit_rate"])
+        self._test(2, stats["sets"])
+        self._test(1, stats["deletes"])
+        self._test(1, stats["evictions"])
+        self._test(0, stats["nbytes"])
+        self._test(2, stats["get_latency"]["count"])
+        self._test(2, stats["set_latency"]["count"])
+
+        # Attributes of the wrapped cache are accessible.
+        self._test(1, _cache.max_entries)
+
+    def test_stats_cache_fs(self):
+        fs.rm("/tmp/labm8-cache-stats")
+        backend = cache.FSCache("/tmp/labm8-cache-stats")
+        _cache = cache.StatsCache(backend)
+        system.echo("Hello", "/tmp/labm8.testfile.txt")
+        _cache["foo"] = "/tmp/labm8.testfile.txt"
+
+        # Reading statistics does not scan the cache.
+        self._test(None, _cache.stats()["nbytes"])
+        self._test(None, backend.nbytes)
+
+        # Sizes are reported once tracked.
+        self._test(6, backend.du())
+        self._test(6, backend.nbytes)
+        self._test(6, _cache.stats()["nbytes"])
+        backend.clear()
+
+    def test_stats_cache_report(self):
+        _cache = cache.StatsCache(cache.TransientCache(), name="foo")
+        _cache["foo"] = 1
+        out = StringIO()
+
+        prof.disable()
+        self._test(False, _cache.report(file=out))
+        self._test("", out.getvalue())
+
+        prof.enable()
+        self._test(True, _cache.report(file=out))
+        prof.disable()
+        self._test(True, "cache foo: 0 hits, 0 misses" in out.getvalue())
+
+    def test_histogram(self):
+        hist = cache.Histogram()
+        self._test(0, hist.percentile(50))
+        for _ in range(99):
+            hist.add(.000001)
+        hist.add(1)
+
+        self._test(100, hist.count)
+        self._test(1, hist.max)
+        self._test(.000002, hist.percentile(50))
+        self._test(1, hist.percentile(100))
+        self._test((.000099 + 1) / 100, hist.to_dict()["mean"],
+                   approximate=True)
+
+    # memoize()
+    def test_memoize(self):
+        calls = []
+
+        @cache.memoize()
+        def square(x):
+            calls.append(x)
+            return x * x
+
+        self._test(4, square(2))
+        self._test(4, square(2))
+        self._test(9, square(x=3))
+        self._test([2, 3], calls)
+        self._test("square", square.__name__)
+
+        stats = square.stats()
+        self._test(1, stats["hits"])
+        self._test(2, stats["misses"])
+        self._test(1 / 3.0, stats["hit_rate"], approximate=True)
+
+    def test_memoize_backend(self):
+        _cache = cache.TransientCache()
+
+        @cache.memoize(backend=_cache)
+        def add(a, b):
+            return a + b
+
+        self._test(3, add(1, 2))
+        self._test(1, len(_cache))
+        self._test(3, _cache[add.key(1, 2)])
+
+    def test_memoize_concurrent(self):
+        calls = []
+
+        @cache.memoize()
+        def slow(x):
+            calls.append(x)
+            time.sleep(.1)
+            return x
+
+        threads = [threading.Thread(target=slow, args=(1,))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Only one thread computed the result.
+        self._test([1], calls)
+        self._test(1, slow.misses)
+        self._test(7, slow.hits)
+
+    def test_memoize_exception(self):
+        calls = []
+
+        @cache.memoize()
+        def fail(x):
+            calls.append(x)
+            raise ValueError(x)
+
+        self.assertRaises(ValueError, fail, 1)
+        self.assertRaises(ValueError, fail, 1)
+        # Failures are not cached.
+        self._test([1, 1], calls)
+
+    def test_memoize_method(self):
+        calls = []
+
+        class Foo(object):
+            def __init__(self, n):
+                self.n = n
+
+            def cache_key(self):
+                return self.n
+
+            @cache.memoize()
+            def add(self, x):
+                calls.append(x)
+                return self.n + x
+
+        self._test(3, Foo(1).add(2))
+        self._test(3, Foo(1).add(2))
+        self._test(4, Foo(2).add(2))
+        self._test([2, 2], calls)
+        self._test(1, Foo.add.hits)
+
+        class Bar(object):
+            @cache.memoize()
+            def add(self, x):
+                return x
+
+        # Instances must define cache_key().
+        self.assertRaises(TypeError, Bar().add, 1)
+
+    # fast_hash_key()
+    def test_fast_hash_key(self):
+        # Hashes are stable across runs.
+        self._test("a1ece2677816366c23180ec346f4d246",
+                   cache.fast_hash_key([1, "a", None, True, 1.5,
+                                        {"x": (1,)}]))
+        self._test(40, len(cache.fast_hash_key("foo", digest_size=20)))
+
+        # Tuples and lists are equivalent.
+        self._test(cache.fast_hash_key(("a", 1)),
+                   cache.fast_hash_key(["a", 1]))
+        # Dicts are order independent.
+        self._test(cache.fast_hash_key({"a": 1, "b": 2}),
+                   cache.fast_hash_key(dict([("b", 2), ("a", 1)])))
+
+        # Distinct keys have distinct hashes.
+        keys = ["1", 1, 1.0, True, None, "", [], {}, ("ab",), ("a", "b"),
+                ["a", ["b"]], [["a"], "b"], {"a": "b"}, ["a", "b", None]]
+        hashes = set(cache.fast_hash_key(key) for key in keys)
+        self._test(len(keys), len(hashes))
+
+    def test_fast_hash_key_bad_type(self):
+        with self.assertRaises(TypeError):
+            cache.fast_hash_key(set([1, 2]))
+
 
 class TestFSCache(TestCase):
     def test_init_and_empty(self):
@@ -225,3 +1056,272 @@ class TestFSCache(TestCase):
         self.assertTrue("foo" in c.ls())
 
         c.clear()
+
+    def test_sharded(self):
+        c = cache.FSCache("/tmp/labm8-fscache-sharded", shard_depth=2)
+        c.clear()
+
+        system.echo("Hello, world!", "/tmp/labm8.testfile.txt")
+        c["foo"] = "/tmp/labm8.testfile.txt"
+        name = cache.hash_key("foo")
+        self._test(fs.path("/tmp/labm8-fscache-sharded",
+                           name[:2], name[2:4], name),
+                   c.keypath("foo"))
+        self.assertTrue(fs.isfile(c.keypath("foo")))
+        self._test(["Hello, world!"], fs.read(c["foo"]))
+
+        system.echo("Hello, world!", "/tmp/labm8.testfile.txt")
+        c["bar"] = "/tmp/labm8.testfile.txt"
+        self._test(2, len(c))
+        self._test(sorted([cache.hash_key("foo"), cache.hash_key("bar")]),
+                   c.ls())
+        self._test(sorted([c.keypath("foo"), c.keypath("bar")]),
+                   sorted(c))
+
+        del c["foo"]
+        self._test(1, len(c))
+        c.clear()
+        self._test(0, len(c))
+
+    def test_sharded_short_names(self):
+        c = cache.FSCache("/tmp/labm8-fscache-sharded",
+                          escape_key=cache.escape_path, shard_depth=2)
+        c.clear()
+
+        # Short names are padded to the full depth.
+        fs.mkdir("/tmp/labm8.testdir")
+        system.echo("foo", "/tmp/labm8.testdir/foo")
+        system.echo("bar", "/tmp/labm8.testdir/bar")
+        c["a"] = "/tmp/labm8.testdir"
+        system.echo("Hello", "/tmp/labm8.testfile.txt")
+        c["abc"] = "/tmp/labm8.testfile.txt"
+        self._test(fs.path("/tmp/labm8-fscache-sharded", "a", "_", "a"),
+                   c.keypath("a"))
+        self._test(fs.path("/tmp/labm8-fscache-sharded", "ab", "c", "abc"),
+                   c.keypath("abc"))
+
+        # Directory entries are not walked into.
+        self._test(2, len(cache.FSCache("/tmp/labm8-fscache-sharded",
+                                        shard_depth=2)))
+        self._test(sorted([c.keypath("a"), c.keypath("abc")]), sorted(c))
+
+        c.reshard(1)
+        self._test(["bar", "foo"], fs.ls(c["a"]))
+        self._test(["Hello"], fs.read(c["abc"]))
+        c.clear()
+
+    def test_len_counter(self):
+        c = cache.FSCache("/tmp/labm8-fscache-len")
+        c.clear()
+
+        system.echo("Hello, world!", "/tmp/labm8.testfile.txt")
+        c["foo"] = "/tmp/labm8.testfile.txt"
+        self._test(1, len(c))
+
+        # Overwriting an entry does not change the count.
+        system.echo("Hello, world!", "/tmp/labm8.testfile.txt")
+        c["foo"] = "/tmp/labm8.testfile.txt"
+        self._test(1, len(c))
+
+        # A new instance counts existing entries.
+        c2 = cache.FSCache("/tmp/labm8-fscache-len")
+        self._test(1, len(c2))
+        c.clear()
+
+    def test_reshard(self):
+        c = cache.FSCache("/tmp/labm8-fscache-reshard",
+                          escape_key=cache.escape_path)
+        c.clear()
+
+        for key in ["ab", "abcdef", "x"]:
+            system.echo(key, "/tmp/labm8.testfile.txt")
+            c[key] = "/tmp/labm8.testfile.txt"
+
+        c.reshard(2)
+        self._test(2, c.shard_depth)
+        self._test(fs.path("/tmp/labm8-fscache-reshard", "ab", "cd",
+                           "abcdef"),
+                   c.keypath("abcdef"))
+        for key in ["ab", "abcdef", "x"]:
+            self._test([key], fs.read(c[key]))
+        self._test(["ab", "abcdef", "x"], c.ls())
+
+        # Migrate back to a flat layout.
+        c.reshard(0)
+        self._test(["ab", "abcdef", "x"],
+                   fs.ls("/tmp/labm8-fscache-reshard"))
+        for key in ["ab", "abcdef", "x"]:
+            self._test([key], fs.read(c[key]))
+        c.clear()
+
+    def test_max_entries(self):
+        c = cache.FSCache("/tmp/labm8-fscache-max-entries", max_entries=2)
+        c.clear()
+
+        for key in ["a", "b"]:
+            system.echo(key, "/tmp/labm8.testfile.txt")
+            c[key] = "/tmp/labm8.testfile.txt"
+
+        # Access "a" so that "b" becomes least recently used.
+        c["a"]
+        system.echo("c", "/tmp/labm8.testfile.txt")
+        c["c"] = "/tmp/labm8.testfile.txt"
+
+        self._test(2, len(c))
+        self._test(True, "a" in c)
+        self._test(False, "b" in c)
+        self._test(True, "c" in c)
+        c.clear()
+
+    def test_max_bytes(self):
+        c = cache.FSCache("/tmp/labm8-fscache-max-bytes", max_bytes=10)
+        c.clear()
+
+        for key in ["a", "b", "c"]:
+            system.echo("xxxx", "/tmp/labm8.testfile.txt")
+            c[key] = "/tmp/labm8.testfile.txt"
+
+        # Each file is 5 bytes, including the newline.
+        self._test(False, "a" in c)
+        self._test(True, "b" in c)
+        self._test(True, "c" in c)
+
+        # The most recently used entry is kept, even if over budget.
+        system.echo("x" * 20, "/tmp/labm8.testfile.txt")
+        c["d"] = "/tmp/labm8.testfile.txt"
+        self._test(1, len(c))
+        self._test(True, "d" in c)
+        c.clear()
+
+    def test_gc_existing(self):
+        c = cache.FSCache("/tmp/labm8-fscache-gc")
+        c.clear()
+        for key in ["a", "b", "c"]:
+            system.echo(key, "/tmp/labm8.testfile.txt")
+            c[key] = "/tmp/labm8.testfile.txt"
+        # No budget, nothing to evict.
+        self._test(0, c.gc())
+
+        # Budget applies to existing entries.
+        c = cache.FSCache("/tmp/labm8-fscache-gc", max_entries=1)
+        self._test(2, c.gc())
+        self._test(1, len(c))
+        c.clear()
+
+    def test_atomic(self):
+        c = cache.FSCache("/tmp/labm8-fscache-atomic", atomic=True)
+        c.clear()
+
+        system.echo("Hello, world!", "/tmp/labm8.testfile.txt")
+        c["foo"] = "/tmp/labm8.testfile.txt"
+        self.assertFalse(fs.isfile("/tmp/labm8.testfile.txt"))
+        self._test(["Hello, world!"], fs.read(c["foo"]))
+
+        # Replace a file.
+        system.echo("Goodbye!", "/tmp/labm8.testfile.txt")
+        c["foo"] = "/tmp/labm8.testfile.txt"
+        self._test(["Goodbye!"], fs.read(c["foo"]))
+
+        # Replace a directory.
+        fs.mkdir("/tmp/labm8.testdir")
+        system.echo("a", "/tmp/labm8.testdir/a")
+        c["bar"] = "/tmp/labm8.testdir"
+        fs.mkdir("/tmp/labm8.testdir")
+        system.echo("b", "/tmp/labm8.testdir/b")
+        c["bar"] = "/tmp/labm8.testdir"
+        self._test(["b"], fs.ls(c["bar"]))
+
+        # Staging directories are cleaned up.
+        self._test(2, len(c.ls()))
+        self._test(2, len(fs.ls("/tmp/labm8-fscache-atomic")))
+        c.clear()
+
+    def test_dedup(self):
+        c = cache.FSCache("/tmp/labm8-fscache-dedup", dedup=True)
+        c.clear()
+
+        system.echo("Hello, world!", "/tmp/labm8.testfile.txt")
+        c["foo"] = "/tmp/labm8.testfile.txt"
+        system.echo("Hello, world!", "/tmp/labm8.testfile.txt")
+        c["bar"] = "/tmp/labm8.testfile.txt"
+        self.assertFalse(fs.isfile("/tmp/labm8.testfile.txt"))
+
+        # Identical contents share an inode.
+        self._test(os.stat(c["foo"]).st_ino, os.stat(c["bar"]).st_ino)
+        self._test(["Hello, world!"], fs.read(c["bar"]))
+        self._test(2, len(c))
+        self._test(sorted([cache.hash_key("foo"), cache.hash_key("bar")]),
+                   c.ls())
+
+        # The shared copy is removed with the last entry using it.
+        obj = c._objpath(crypto.sha1_file(c["foo"]))
+        del c["foo"]
+        self.assertTrue(fs.isfile(obj))
+        del c["bar"]
+        self.assertFalse(fs.isfile(obj))
+        c.clear()
+
+    def test_bulk(self):
+        c = cache.FSCache("/tmp/labm8-fscache-bulk", shard_depth=1,
+                          max_entries=2)
+        c.clear()
+
+        items = []
+        for key in ["a", "b", "c"]:
+            system.echo(key, "/tmp/labm8.testfile." + key)
+            items.append((key, "/tmp/labm8.testfile." + key))
+        c.set_many(items)
+
+        # Garbage collected once all were inserted.
+        self._test(2, len(c))
+        self._test([None, c.keypath("b"), c.keypath("c")],
+                   c.get_many(["a", "b", "c"]))
+
+        self._test(1, c.delete_many(["a", "b"]))
+        self._test(1, len(c))
+        c.clear()
+
+    def test_compression(self):
+        c = cache.FSCache("/tmp/labm8-fscache-compress", compression="gzip",
+                          compress_threshold=10, dedup=True)
+        c.clear()
+
+        system.echo("Hello, world!", "/tmp/labm8.testfile.txt")
+        c["foo"] = "/tmp/labm8.testfile.txt"
+        system.echo("Hello, world!", "/tmp/labm8.testfile.txt")
+        c["bar"] = "/tmp/labm8.testfile.txt"
+        system.echo("Hi", "/tmp/labm8.testfile.txt")
+        c["baz"] = "/tmp/labm8.testfile.txt"
+        self.assertFalse(fs.isfile("/tmp/labm8.testfile.txt"))
+
+        with open(c["foo"], "rb") as infile:
+            self._test(b"\x00labm8-compressed:gzip\n", infile.readline())
+            self._test(b"\x1f\x8b", infile.read(2))
+        with c.open("foo") as infile:
+            self._test(b"Hello, world!\n", infile.read())
+        # Compressed files are deterministic, so can be deduplicated.
+        self._test(os.stat(c["foo"]).st_ino, os.stat(c["bar"]).st_ino)
+
+        # Small files are stored uncompressed.
+        self._test(["Hi"], fs.read(c["baz"]))
+        with c.open("baz") as infile:
+            self._test(b"Hi\n", infile.read())
+
+        self._test(3, len(c))
+        self._test([], [x for x in fs.ls(c.path) if x.startswith(".compress")])
+        self.assertRaises(KeyError, c.open, "notakey")
+        c.clear()
+
+    def test_compressed_payload(self):
+        # Compressed files are stored as they are.
+        data = cache.GzipCompressor().compress(b"Hello, world!\n")
+        for compression in (None, "gzip"):
+            c = cache.FSCache("/tmp/labm8-fscache-compress",
+                              compression=compression, compress_threshold=0)
+            c.clear()
+            with open("/tmp/labm8.testfile.gz", "wb") as outfile:
+                outfile.write(data)
+            c["foo"] = "/tmp/labm8.testfile.gz"
+            with c.open("foo") as infile:
+                self._test(data, infile.read())
+            c.clear()
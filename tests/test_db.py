@@ -16,6 +16,9 @@ from unittest import main
 from tests import TestCase
 
 import sqlite3 as sql
+import threading
+
+from unittest import skipIf
 
 import pandas.io.sql as panda
 
@@ -23,6 +26,17 @@ import labm8 as lab
 from labm8 import db
 from labm8 import fs
 
+if lab.is_python3():
+    from io import StringIO
+else:
+    from StringIO import StringIO
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 class TestDatabase(TestCase):
 
     def __init__(self, *args, **kwargs):
@@ -109,6 +123,32 @@ class TestDatabase(TestCase):
     def test_schema_empty(self):
         self._test([], self.db_empty.schema)
 
+    def test_schema_cache(self):
+        fs.rm("/tmp/labm8.sql")
+        _db = db.Database("/tmp/labm8.sql", {"foo": (("id", "integer"),)})
+        self._test([("foo", (("id", "integer"),))], _db.schema)
+
+        # Cached metadata only requires a schema version check.
+        statements = []
+        _db.connection.set_trace_callback(statements.append)
+        self._test([("foo", (("id", "integer"),))], _db.schema)
+        self._test(["PRAGMA schema_version"], list(set(statements)))
+        _db.connection.set_trace_callback(None)
+
+        # Changes by any means are seen.
+        _db.execute("ALTER TABLE foo ADD COLUMN value text")
+        self._test(["id", "value"],
+                   [column["name"] for column in _db.table_info("foo")])
+        other = db.Database("/tmp/labm8.sql")
+        other.create_table("bar", (("id", "integer"),))
+        other.commit()
+        self._test(["foo", "bar"], _db.tables)
+        _db.drop_table("bar")
+        self._test(["foo"], _db.tables)
+        other.close()
+        _db.close()
+        fs.rm("/tmp/labm8.sql")
+
     # num_rows()
     def test_num_rows(self):
         self._test(3, self.db.num_rows("names"))
@@ -233,6 +273,576 @@ class TestDatabase(TestCase):
         # You can close an already-closed database.
         c.close()
 
+    # pooled connections
+    def test_pooled(self):
+        fs.rm("/tmp/labm8.pool.sql*")
+        _db = db.Database("/tmp/labm8.pool.sql", {
+            "foo": (("thread", "integer"), ("id", "integer"))
+        }, pooled=True)
+        self._test("wal",
+                   _db.execute("PRAGMA journal_mode").fetchone()[0])
+
+        counts = []
+
+        def worker(n):
+            for i in range(50):
+                _db.execute("INSERT INTO foo VALUES (?,?)", (n, i))
+                # Reads see this thread's uncommitted writes.
+                counts.append(_db.execute(
+                    "SELECT Count(*) FROM foo WHERE thread=?",
+                    (n,)).fetchone()[0] - i)
+                _db.commit()
+
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self._test([1] * 200, counts)
+        self._test(200, _db.num_rows("foo"))
+
+        # Connections of exited threads are closed.
+        thread = threading.Thread(target=_db.num_rows, args=("foo",))
+        thread.start()
+        thread.join()
+        self._test(2, len(_db._connections))
+
+        _db.close()
+        with self.assertRaises(sql.ProgrammingError) as ctx:
+            _db.execute("SELECT * FROM foo")
+        fs.rm("/tmp/labm8.pool.sql*")
+
+    def test_pooled_write_timeout(self):
+        fs.rm("/tmp/labm8.pool.sql*")
+        _db = db.Database("/tmp/labm8.pool.sql", {
+            "foo": (("id", "integer"),)
+        }, pooled=True, timeout=.1)
+        writing = threading.Event()
+        done = threading.Event()
+
+        def writer():
+            _db.execute("INSERT INTO foo VALUES (1)")
+            writing.set()
+            done.wait(10)
+            _db.commit()
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        writing.wait(10)
+        with self.assertRaises(sql.OperationalError) as ctx:
+            _db.execute("INSERT INTO foo VALUES (2)")
+        done.set()
+        thread.join()
+
+        # A thread which exits without committing has its transaction
+        # rolled back, and does not block other writers.
+        thread = threading.Thread(target=_db.execute,
+                                  args=("INSERT INTO foo VALUES (3)",))
+        thread.start()
+        thread.join()
+        _db.execute("INSERT INTO foo VALUES (4)")
+        _db.commit()
+        self._test([(1,), (4,)], _db.execute(
+            "SELECT * FROM foo ORDER BY id").fetchall())
+        _db.close()
+        fs.rm("/tmp/labm8.pool.sql*")
+
+    def test_pooled_metadata(self):
+        fs.rm("/tmp/labm8.pool.sql*")
+        _db = db.Database("/tmp/labm8.pool.sql", {
+            "foo": (("id", "integer"),)
+        }, pooled=True)
+        writing = threading.Event()
+        done = threading.Event()
+
+        def writer():
+            _db.execute("INSERT INTO foo VALUES (1)")
+            writing.set()
+            done.wait(10)
+            _db.commit()
+
+        results = []
+
+        def reader():
+            results.append(_db.tables)
+            results.append(_db.table_info("foo")[0]["name"])
+            results.append(_db.pragma("journal_mode"))
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        writing.wait(10)
+
+        # Metadata may be read while another thread is writing.
+        reading = threading.Thread(target=reader)
+        reading.start()
+        reading.join(5)
+        self._test(False, reading.is_alive())
+        done.set()
+        thread.join()
+        self._test([["foo"], "id", "wal"], results)
+        _db.close()
+        fs.rm("/tmp/labm8.pool.sql*")
+
+    # set_profile()
+    def test_profile(self):
+        fs.rm("/tmp/labm8.profile.sql*")
+        _db = db.Database("/tmp/labm8.profile.sql", profile="read-mostly")
+        self._test("read-mostly", _db.profile)
+        self._test("wal", _db.pragma("journal_mode"))
+        self._test(1, _db.pragma("synchronous"))
+        self._test(-64 * 1024, _db.pragma("cache_size"))
+        self._test(2, _db.pragma("temp_store"))
+
+        self._test("read-mostly", _db.set_profile("bulk-load"))
+        self._test(0, _db.pragma("synchronous"))
+        self._test("bulk-load", _db.set_profile("durable"))
+        self._test(2, _db.pragma("synchronous"))
+        self._test(0, _db.pragma("temp_store"))
+
+        with self.assertRaises(ValueError) as ctx:
+            _db.set_profile("foo")
+
+        # Profiles cannot be changed inside a transaction.
+        _db.create_table("foo", (("id", "integer"),))
+        _db.set_profile("read-mostly")
+        _db.execute("INSERT INTO foo VALUES (1)")
+        with self.assertRaises(sql.OperationalError) as ctx:
+            _db.set_profile("bulk-load")
+        self._test("read-mostly", _db.profile)
+        self._test(1, _db.pragma("synchronous"))
+        _db.commit()
+        _db.close()
+        fs.rm("/tmp/labm8.profile.sql*")
+
+    def test_profile_pooled(self):
+        fs.rm("/tmp/labm8.profile.sql*")
+        _db = db.Database("/tmp/labm8.profile.sql", pooled=True,
+                          profile="bulk-load")
+        results = []
+
+        def worker():
+            results.append(_db.pragma("synchronous"))
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        self._test([0], results)
+
+        # Connections pick up profile changes.
+        _db.set_profile("durable")
+        self._test(2, _db.pragma("synchronous"))
+        _db.close()
+        fs.rm("/tmp/labm8.profile.sql*")
+
+    # insert_many()
+    def test_insert_many(self):
+        fs.rm("/tmp/labm8.sql")
+        _db = db.Database("/tmp/labm8.sql", {
+            "foo": (("id", "integer primary key"), ("value", "text"))
+        })
+
+        rows = ((i, str(i)) for i in range(2500))
+        self._test(2500, _db.insert_many("foo", rows, chunk_size=1000))
+        self._test(2500, _db.num_rows("foo"))
+        self._test((1234, "1234"), _db.execute(
+            "SELECT * FROM foo WHERE id=1234").fetchone())
+
+        # Insert into named columns.
+        self._test(1, _db.insert_many("foo", [("bar",)], columns=["value"]))
+        self._test((2500,), _db.execute(
+            "SELECT id FROM foo WHERE value='bar'").fetchone())
+
+        # Committed chunks are kept, and the failed chunk rolled back.
+        rows = [(3000 + i, "x") for i in range(15)] + [(0, "duplicate")]
+        with self.assertRaises(sql.IntegrityError) as ctx:
+            _db.insert_many("foo", rows, chunk_size=10)
+        self._test(2511, _db.num_rows("foo"))
+
+        # Within a pending transaction, a failed chunk does not roll
+        # back the transaction, and inserted chunks are part of it.
+        _db.execute("INSERT INTO foo VALUES (4000, 'pending')")
+        with self.assertRaises(sql.IntegrityError) as ctx:
+            _db.insert_many("foo", [(4001, "x"), (0, "duplicate")],
+                            chunk_size=1)
+        self._test(2513, _db.num_rows("foo"))
+        _db.rollback()
+        self._test(2511, _db.num_rows("foo"))
+        _db.execute("INSERT INTO foo VALUES (4000, 'pending')")
+        self._test(1, _db.insert_many("foo", [(4001, "x")]))
+        _db.commit()
+        self._test(2513, _db.num_rows("foo"))
+
+        self._test(0, _db.insert_many("foo", []))
+        _db.close()
+        fs.rm("/tmp/labm8.sql")
+
+    # ShardedDatabase
+    def test_sharded(self):
+        fs.rm("/tmp/labm8.shards")
+        _db = db.ShardedDatabase("/tmp/labm8.shards", 4, {
+            "results": (("id", "integer"), ("benchmark", "text"),
+                        ("runtime", "real"))
+        }, keys={"results": "benchmark"})
+        self._test(4, _db.num_shards)
+        self._test(["results"], _db.tables)
+        self._test("benchmark", _db.key("results"))
+
+        rows = [(i, "b" + str(i % 10), float(i)) for i in range(100)]
+        self._test(100, _db.insert_many("results", rows, chunk_size=7))
+        self._test(100, _db.num_rows("results"))
+
+        # Rows are partitioned by key.
+        for shard in _db.shards:
+            for benchmark, in shard.execute(
+                    "SELECT DISTINCT benchmark FROM results"):
+                self._test(shard, _db.shard(benchmark))
+        self.assertTrue(all(shard.num_rows("results")
+                            for shard in _db.shards))
+
+        # Queries across attached shards.
+        self._test([("b0", 10, 450.0), ("b1", 10, 460.0)], _db.query(
+            "SELECT benchmark, COUNT(*), SUM(runtime) FROM results "
+            "GROUP BY benchmark ORDER BY benchmark LIMIT 2").fetchall())
+
+        # Parallel reads, merged.
+        self._test(rows, _db.read("SELECT * FROM results",
+                                  key=lambda row: row[0]))
+        self._test([(99, "b9", 99.0), (98, "b8", 98.0)], _db.read(
+            "SELECT * FROM results WHERE id > ?", (80,),
+            key=lambda row: row[0], reverse=True)[:2])
+
+        # Views are updated for new tables.
+        _db.create_table("foo", (("a", "text"),))
+        self._test(1, _db.insert_many("foo", [("x",)]))
+        self._test([("x",)], _db.query("SELECT * FROM foo").fetchall())
+        _db.close()
+
+        # Reopen existing shards. Key columns are kept.
+        _db = db.ShardedDatabase("/tmp/labm8.shards")
+        self._test(4, _db.num_shards)
+        self._test(["results", "foo"], _db.tables)
+        self._test("benchmark", _db.key("results"))
+        self._test("a", _db.key("foo"))
+        self._test(100, _db.num_rows("results"))
+        self._test(10, _db.shard("b3").execute(
+            "SELECT COUNT(*) FROM results WHERE benchmark='b3'").fetchone()[0])
+        _db.close()
+
+        with self.assertRaises(db.SchemaError) as ctx:
+            db.ShardedDatabase("/tmp/labm8.shards", keys={"results": "id"})
+        fs.rm("/tmp/labm8.shards")
+
+    def test_sharded_primary_key(self):
+        fs.rm("/tmp/labm8.shards")
+        _db = db.ShardedDatabase("/tmp/labm8.shards", 3, {
+            "results": (("id", "text primary key"), ("runtime", "real"))
+        })
+        for shard in _db.shards:
+            shard.execute("CREATE INDEX runtimes ON results (runtime)")
+        _db.insert_many("results", [(str(i), float(i)) for i in range(10)])
+
+        # Only tables are queried, not indexes.
+        self._test(["results"], _db.tables)
+        self._test((10, 45.0), _db.query(
+            "SELECT COUNT(*), SUM(runtime) FROM results").fetchone())
+        _db.close()
+        fs.rm("/tmp/labm8.shards")
+
+    def test_sharded_threads(self):
+        fs.rm("/tmp/labm8.shards")
+        _db = db.ShardedDatabase("/tmp/labm8.shards", 3, {
+            "foo": (("id", "integer"), ("worker", "integer"))
+        })
+
+        def _worker(n):
+            _db.insert_many("foo", ((n * 100 + i, n) for i in range(100)),
+                            chunk_size=10)
+
+        workers = [threading.Thread(target=_worker, args=(n,))
+                   for n in range(8)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self._test(800, _db.num_rows("foo"))
+        self._test((800, 8), _db.query(
+            "SELECT COUNT(DISTINCT id), COUNT(DISTINCT worker) "
+            "FROM foo").fetchone())
+        _db.close()
+        fs.rm("/tmp/labm8.shards")
+
+    def test_sharded_errors(self):
+        fs.rm("/tmp/labm8.shards")
+        with self.assertRaises(db.Error) as ctx:
+            db.ShardedDatabase("/tmp/labm8.shards")
+
+        _db = db.ShardedDatabase("/tmp/labm8.shards", 2)
+        with self.assertRaises(db.SchemaError) as ctx:
+            _db.create_table("foo", (("a", "text"),), key="b")
+        _db.create_table("foo", (("a", "text"), ("b", "text")))
+        with self.assertRaises(db.SchemaError) as ctx:
+            _db.insert_many("foo", [("x",)], columns=["b"])
+        with self.assertRaises(db.SchemaError) as ctx:
+            _db.key("bar")
+        with self.assertRaises(db.SchemaError) as ctx:
+            _db.create_table("foo", (("a", "text"), ("b", "text")), key="b")
+
+        # Dropped tables may be recreated with a different key.
+        _db.drop_table("foo")
+        _db.create_table("foo", (("a", "text"), ("b", "text")), key="b")
+        self._test("b", _db.key("foo"))
+        _db.close()
+
+        with self.assertRaises(db.Error) as ctx:
+            db.ShardedDatabase("/tmp/labm8.shards", 3)
+        fs.rm("/tmp/labm8.shards")
+
+    # stream()
+    def test_stream(self):
+        rows = self.db.stream("SELECT * FROM names ORDER BY last",
+                              batch_size=2)
+        self._test(("Joe", "Bloggs"), next(rows))
+        self._test([("David", "Bowie"), ("David", "Brent")], list(rows))
+        self._test([], list(self.db.stream("SELECT * FROM prices")))
+        self._test([("Joe",)], list(self.db.stream(
+            "SELECT first FROM names WHERE last=?", ("Bloggs",))))
+
+    def test_stream_numpy(self):
+        fs.rm("/tmp/labm8.sql")
+        _db = db.Database("/tmp/labm8.sql", {
+            "foo": (("id", "integer"), ("value", "real"))
+        })
+        _db.insert_many("foo", ((i, i / 2.0) for i in range(10)))
+
+        batches = list(_db.stream("SELECT * FROM foo", batch_size=4,
+                                  format="numpy"))
+        self._test([4, 4, 2], [len(batch["id"]) for batch in batches])
+        self._test(45, sum(batch["id"].sum() for batch in batches))
+        self._test(22.5, sum(batch["value"].sum() for batch in batches))
+        _db.close()
+        fs.rm("/tmp/labm8.sql")
+
+    @skipIf(pyarrow is None, "pyarrow not installed")
+    def test_stream_arrow(self):
+        fs.rm("/tmp/labm8.sql")
+        _db = db.Database("/tmp/labm8.sql", {
+            "foo": (("id", "integer"), ("value", "real"), ("name", "text"))
+        })
+        _db.insert_many("foo", ((i, i / 2.0, str(i)) for i in range(10)))
+
+        batches = list(_db.stream("SELECT * FROM foo", batch_size=4,
+                                  format="arrow"))
+        self._test([4, 4, 2], [batch.num_rows for batch in batches])
+        self._test(["id", "value", "name"], batches[0].schema.names)
+        self._test([pyarrow.int64(), pyarrow.float64(), pyarrow.string()],
+                   batches[0].schema.types)
+        self._test([str(i) for i in range(10)],
+                   [name for batch in batches
+                    for name in batch.column(2).to_pylist()])
+        self._test([], list(_db.stream("SELECT * FROM foo WHERE id < 0",
+                                       format="arrow")))
+        _db.close()
+        fs.rm("/tmp/labm8.sql")
+
+    def test_stream_bad_format(self):
+        with self.assertRaises(ValueError) as ctx:
+            self.db.stream("SELECT * FROM names", format="foo")
+
+    # import_csv(), import_jsonl()
+    def test_import_csv(self):
+        fs.rm("/tmp/labm8.sql")
+        _db = db.Database("/tmp/labm8.sql")
+        with open("/tmp/labm8.import.csv", "w") as outfile:
+            outfile.write("id,price,name\n"
+                          "1,1.5,foo\n"
+                          "2,,\"bar, baz\"\n"
+                          "3,2,\n")
+
+        self._test(3, _db.import_csv("foo", "/tmp/labm8.import.csv",
+                                     chunk_size=2))
+        self._test([("foo", (("id", "integer"), ("price", "real"),
+                             ("name", "text")))], _db.schema)
+        self._test([(1, 1.5, "foo"), (2, None, "bar, baz"), (3, 2.0, None)],
+                   _db.execute("SELECT * FROM foo").fetchall())
+
+        # Import into an existing table.
+        self._test(3, _db.import_csv("foo", "/tmp/labm8.import.csv"))
+        self._test(6, _db.num_rows("foo"))
+
+        # Pragmas are restored.
+        self._test(2, _db.pragma("synchronous"))
+
+        # Within a pending transaction, imported rows are part of it.
+        _db.execute("DELETE FROM foo")
+        self._test(3, _db.import_csv("foo", "/tmp/labm8.import.csv"))
+        self._test(3, _db.num_rows("foo"))
+        _db.rollback()
+        self._test(6, _db.num_rows("foo"))
+
+        with self.assertRaises(ValueError) as ctx:
+            _db.import_csv("foo", "/tmp/labm8.import.csv", header=False)
+        _db.close()
+        fs.rm("/tmp/labm8.sql")
+        fs.rm("/tmp/labm8.import.csv")
+
+    def test_import_csv_numbers(self):
+        fs.rm("/tmp/labm8.sql")
+        _db = db.Database("/tmp/labm8.sql")
+        with open("/tmp/labm8.import.csv", "w") as outfile:
+            outfile.write("id,a,b,c,d\n"
+                          "1_2,-1,1e3,nan,1\n"
+                          "3_4,+2,.5, 3,99999999999999999999\n")
+
+        # Only numbers in SQLite's numeric forms are converted.
+        _db.import_csv("foo", "/tmp/labm8.import.csv")
+        self._test([("foo", (("id", "text"), ("a", "integer"), ("b", "real"),
+                             ("c", "text"), ("d", "real")))], _db.schema)
+        self._test([("1_2", -1, 1000.0, "nan", 1.0),
+                    ("3_4", 2, 0.5, " 3", 1e20)],
+                   _db.execute("SELECT * FROM foo").fetchall())
+
+        # Values of numeric columns which are not numbers are kept.
+        _db.execute("DELETE FROM foo")
+        schema = (("id", "integer"), ("a", "real"), ("b", "real"),
+                  ("c", "real"), ("d", "integer"))
+        _db.import_csv("foo", "/tmp/labm8.import.csv", schema=schema)
+        self._test(["1_2", "3_4"], [row[0] for row in _db.execute(
+            "SELECT id FROM foo")])
+        _db.close()
+        fs.rm("/tmp/labm8.sql")
+        fs.rm("/tmp/labm8.import.csv")
+
+    def test_import_csv_bad_rows(self):
+        fs.rm("/tmp/labm8.sql")
+        _db = db.Database("/tmp/labm8.sql")
+
+        # Rows must have a field for every column.
+        with open("/tmp/labm8.import.csv", "w") as outfile:
+            outfile.write("a,b\n1,2\n3,4,EXTRA\n5\n")
+        with self.assertRaises(ValueError) as ctx:
+            _db.import_csv("foo", "/tmp/labm8.import.csv")
+        self.assertIn("Line 3", str(ctx.exception))
+        with self.assertRaises(ValueError) as ctx:
+            _db.import_csv("foo", "/tmp/labm8.import.csv", chunk_size=1)
+        # The table created by the failed import is rolled back.
+        self.assertNotIn("foo", _db.tables)
+        with self.assertRaises(ValueError) as ctx:
+            _db.import_csv("bar", "/tmp/labm8.import.csv",
+                           schema=(("a", "integer"),))
+
+        # Empty lines are skipped, and quoted newlines are kept.
+        with open("/tmp/labm8.import.csv", "w") as outfile:
+            outfile.write('a,b\n1,2\n\n3,"x\r\ny"\n')
+        self._test(2, _db.import_csv("baz", "/tmp/labm8.import.csv"))
+        self._test([(1, "2"), (3, "x\r\ny")],
+                   _db.execute("SELECT * FROM baz").fetchall())
+        _db.close()
+        fs.rm("/tmp/labm8.sql")
+        fs.rm("/tmp/labm8.import.csv")
+
+    def test_import_csv_schema(self):
+        fs.rm("/tmp/labm8.sql")
+        _db = db.Database("/tmp/labm8.sql", {
+            "foo": (("id", "integer primary key"), ("value", "text"))
+        })
+        with open("/tmp/labm8.import.csv", "w") as outfile:
+            outfile.write("1\t001\n"
+                          "1\t002\n")
+
+        # Failed imports insert nothing.
+        schema = (("id", "integer"), ("value", "text"))
+        with self.assertRaises(sql.IntegrityError) as ctx:
+            _db.import_csv("foo", "/tmp/labm8.import.csv", schema=schema,
+                           header=False, delimiter="\t", chunk_size=1)
+        self._test(0, _db.num_rows("foo"))
+
+        _db.execute("DELETE FROM foo")
+        with open("/tmp/labm8.import.csv", "w") as outfile:
+            outfile.write("1\t001\n")
+        _db.import_csv("foo", "/tmp/labm8.import.csv", schema=schema,
+                       header=False, delimiter="\t")
+        self._test((1, "001"), _db.execute("SELECT * FROM foo").fetchone())
+        _db.close()
+        fs.rm("/tmp/labm8.sql")
+        fs.rm("/tmp/labm8.import.csv")
+
+    def test_import_jsonl(self):
+        fs.rm("/tmp/labm8.sql")
+        _db = db.Database("/tmp/labm8.sql")
+        with open("/tmp/labm8.import.jsonl", "w") as outfile:
+            outfile.write('{"id": 1, "price": 1.5, "tags": ["a"]}\n'
+                          '\n'
+                          '{"id": 2, "price": 2, "name": "bar"}\n')
+
+        self._test(2, _db.import_jsonl("foo", "/tmp/labm8.import.jsonl"))
+        self._test([("foo", (("id", "integer"), ("price", "real"),
+                             ("tags", "text"), ("name", "text")))],
+                   _db.schema)
+        self._test([(1, 1.5, '["a"]', None), (2, 2.0, None, "bar")],
+                   _db.execute("SELECT * FROM foo").fetchall())
+        _db.close()
+        fs.rm("/tmp/labm8.sql")
+        fs.rm("/tmp/labm8.import.jsonl")
+
+    # normalize_statement()
+    def test_normalize_statement(self):
+        self._test("SELECT * FROM foo WHERE id IN (...) AND name=?",
+                   db.normalize_statement(
+                       "SELECT *\n  FROM foo WHERE id IN (1, 2.5, 3) "
+                       "AND name='it''s'"))
+        self._test("INSERT INTO t1 VALUES (...)",
+                   db.normalize_statement("INSERT INTO t1 VALUES (?,?)"))
+
+    # enable_profiling()
+    def test_profiling(self):
+        fs.rm("/tmp/labm8.sql")
+        _db = db.Database("/tmp/labm8.sql", {
+            "foo": (("id", "integer"), ("value", "text"))
+        })
+        profiler = _db.enable_profiling()
+
+        _db.executemany("INSERT INTO foo VALUES (?,?)",
+                        [(i, str(i)) for i in range(10)])
+        _db.commit()
+        for i in range(3):
+            _db.execute("SELECT * FROM foo WHERE id < {0}".format(i + 5))
+        self._test(2, len(_db.execute("SELECT * FROM foo WHERE id < 2")
+                          .fetchall()))
+        rows = _db.execute("SELECT * FROM foo WHERE id < 2")
+        self._test([(0, "0"), (1, "1")], list(rows))
+        _db.executescript("DELETE FROM foo; DELETE FROM foo;")
+
+        stats = dict((x["statement"], x) for x in profiler.stats())
+        select = stats["SELECT * FROM foo WHERE id < ?"]
+        self._test(5, select["count"])
+        self._test(4, select["rows"])
+        self.assertTrue(select["p95"] <= select["total"])
+        self._test(10, stats["INSERT INTO foo VALUES (...)"]["rows"])
+        self._test(1, stats["COMMIT"]["count"])
+        self._test(2, stats["DELETE FROM foo"]["count"])
+
+        out = StringIO()
+        profiler.report(n=1, file=out)
+        self._test(2, len(out.getvalue().strip().split("\n")))
+
+        self._test(profiler, _db.disable_profiling())
+        _db.execute("SELECT * FROM foo")
+        self._test(5, stats["SELECT * FROM foo WHERE id < ?"]["count"])
+        _db.close()
+        fs.rm("/tmp/labm8.sql")
+
+    def test_profiling_max_statements(self):
+        profiler = db.QueryProfiler(max_statements=2)
+        profiler.record("SELECT a FROM foo", .1)
+        profiler.record("SELECT b FROM foo", .2)
+        profiler.record("SELECT a FROM foo", .3)
+        profiler.record("SELECT c FROM foo", .5)
+        self._test(["SELECT c FROM foo", "SELECT a FROM foo"],
+                   [x["statement"] for x in profiler.stats()])
+
     # copy_table()
     def test_copy_table(self):
         cmd = 'SELECT first from names_cpy where first="Joe"'
@@ -342,6 +952,24 @@ class TestDatabase(TestCase):
         self._test("",
                    self.db.export_csv("prices", header=False))
 
+    def test_export_csv_batches(self):
+        fs.rm("/tmp/labm8.sql")
+        _db = db.Database("/tmp/labm8.sql", {
+            "foo": (("id", "integer"), ("value", "text"))
+        })
+        _db.insert_many("foo", [(1, "a,b"), (2, None), (3, "c")])
+        self._test("id,value\n"
+                   "1,\"a,b\"\n"
+                   "2,\n"
+                   "3,c\n",
+                   _db.export_csv("foo", batch_size=2))
+        self._test("1\ta,b\n"
+                   "2\t\n"
+                   "3\tc\n",
+                   _db.export_csv("foo", header=False, delimiter="\t"))
+        _db.close()
+        fs.rm("/tmp/labm8.sql")
+
     def test_export_csv_bad_path(self):
         # An error is thrown if we can't write to file.
         with self.assertRaises(IOError) as ctx:
@@ -351,3 +979,39 @@ class TestDatabase(TestCase):
         # An error is thrown if the table is not found.
         with self.assertRaises(db.SchemaError) as ctx:
             self.db.export_csv("foo")
+
+    # export_parquet()
+    @skipIf(pyarrow is None, "pyarrow not installed")
+    def test_export_parquet(self):
+        fs.rm("/tmp/labm8.sql")
+        _db = db.Database("/tmp/labm8.sql", {
+            "foo": (("id", "integer"), ("name", "varchar(10)"),
+                    ("value", "double"), ("data", "blob"))
+        })
+        rows = [(i, None if i == 0 else str(i), i / 2.0, b"x" * i)
+                for i in range(10)]
+        _db.insert_many("foo", rows)
+
+        tmp = "/tmp/labm8.sql.parquet"
+        _db.export_parquet("foo", tmp, batch_size=4)
+        table = pyarrow.parquet.read_table(tmp)
+        self._test(["id", "name", "value", "data"], table.schema.names)
+        self._test([pyarrow.int64(), pyarrow.string(), pyarrow.float64(),
+                    pyarrow.binary()], table.schema.types)
+        self._test(rows, list(zip(*[table.column(i).to_pylist()
+                                    for i in range(4)])))
+        self._test(3, pyarrow.parquet.ParquetFile(tmp).num_row_groups)
+
+        # Types are taken from the schema when there are no rows.
+        _db.execute("DELETE FROM foo")
+        _db.commit()
+        _db.export_parquet("foo", tmp, columns="id,name")
+        table = pyarrow.parquet.read_table(tmp)
+        self._test(0, table.num_rows)
+        self._test([pyarrow.int64(), pyarrow.string()], table.schema.types)
+
+        with self.assertRaises(db.SchemaError) as ctx:
+            _db.export_parquet("bar", tmp)
+        _db.close()
+        fs.rm("/tmp/labm8.sql")
+        fs.rm(tmp)